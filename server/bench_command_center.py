@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+#----------------------
+# Command Center Load Benchmark
+#
+# Starts a Command Center on a temporary socket and database folder, then
+# drives it with synthetic scanner, converter, CLI, and discoverer clients.
+# Reports throughput, latency percentiles, and memory growth per client
+# kind.  Results can be saved as a JSON baseline and later runs compared
+# against it.
+#-----------------------
+
+import libcommand_center as libcc
+import multiprocessing
+import subprocess
+import tempfile
+import shutil
+import random
+import json
+import time
+import sys
+import os
+
+#-----------------
+# Constants
+#-----------------
+
+# Default number of clients of each kind
+DEFAULT_MIX = "cli=4,converter=2,scanner=1,discoverer=1"
+
+# Slowdown (as a fraction) that counts as a regression when comparing
+DEFAULT_TOLERANCE = 0.2
+
+MOVIE_FOLDER = "/mnt/raid/Movies/Features"
+
+# Words used to build synthetic titles
+TITLE_WORDS = ["The","Return","Night","Star","Last","Dark","City","Of",
+	"King","War","Love","Story","Man","Day","Lost","Blue","Red","Secret",
+	"House","River","Ghost","Empire","Island","Summer","Winter","Road"]
+
+
+## Build a Synthetic Library
+#
+# @param count - Number of movies
+# @param seed - Random seed, so every client builds the same library
+# @return - A list of movie dictionaries
+def build_movies(count,seed=0):
+	rand = random.Random(seed)
+	movies = []
+	for i in range(count):
+		title = " ".join(rand.sample(TITLE_WORDS,rand.randint(1,4)))
+		title += " (%d)" % rand.randint(1950,2013)
+		path = "%s/%d/%s.mkv" % (MOVIE_FOLDER,i,title)
+		movies.append({"path":path,"title":title})
+	return movies
+
+## Build Synthetic Devices
+def build_devices(count,rand):
+	devices = []
+	for i in range(count):
+		devices.append({
+			"ip":"10.0.0.%d" % (i+1),
+			"port":"8008",
+			"name":"Chromecast %d" % i,
+			"seen":rand.random()
+			})
+	return devices
+
+#------------------
+# Client Request Generators
+#
+# Each generator returns a function that makes the next request of its kind.
+#------------------
+
+## Scanner: uploads the whole library, with one title changed each time
+def scanner_requests(args,index):
+	movies = build_movies(args.library)
+	rand = random.Random(index)
+	def next_request():
+		i = rand.randrange(len(movies))
+		movies[i] = dict(movies[i],title=movies[i]["title"]+" x")
+		return {"source":"scanner","movies":movies,"tv":[]}
+	return next_request
+
+## Converter: reports progress on the job it leased as fast as it can
+def converter_requests(args,index):
+	state = {"percent":0,"path":None}
+	def next_request():
+		state["percent"] = (state["percent"]+1) % 100
+		return {
+			"source":"converter",
+			"cmd":"update",
+			"worker":"bench-%d" % index,
+			"path":state["path"],
+			"percent":state["percent"],
+			"frame":state["percent"]*24
+			}
+	next_request.state = state
+	return next_request
+
+## CLI: the requests a UI makes while someone browses
+def cli_requests(args,index):
+	rand = random.Random(index)
+	state = {"version":None}
+	def next_request():
+		choice = rand.random()
+		if choice < 0.3:
+			req = {"cmd":"fetch","type":"movies","limit":50,
+				"sort":"title"}
+		elif choice < 0.6:
+			word = rand.choice(TITLE_WORDS).lower()
+			req = {"cmd":"search","query":word[:3],"limit":20}
+		elif choice < 0.8:
+			req = {"cmd":"fetch","type":"movies",
+				"if_version":state["version"]}
+		elif choice < 0.9:
+			req = {"cmd":"fetch","type":"devices"}
+		else:
+			req = {"cmd":"conv_status"}
+		req["source"] = "cli"
+		return req
+	next_request.state = state
+	return next_request
+
+## Discoverer: reports the devices it found
+def discoverer_requests(args,index):
+	rand = random.Random(index)
+	def next_request():
+		return {"source":"discoverer","devices":build_devices(5,rand)}
+	return next_request
+
+CLIENT_KINDS = {
+	"scanner":scanner_requests,
+	"converter":converter_requests,
+	"cli":cli_requests,
+	"discoverer":discoverer_requests
+	}
+
+
+## Run one Synthetic Client
+#
+# Sends requests one after another until the run ends and puts
+# (kind, list of latencies in seconds, error count) on the result queue.
+def run_client(kind,index,args,start,results):
+	next_request = CLIENT_KINDS[kind](args,index)
+	client = libcc.CC_Client(args.socket,timeout=30,
+			encoding=args.encoding)
+	client.connect()
+	if kind == "converter":
+		# Give the converter a job to report on
+		client.request({"source":"cli","cmd":"conv",
+			"path":"/bench/converter-%d.mkv" % index})
+		resp = client.request({"source":"converter","cmd":"fetch",
+			"worker":"bench-%d" % index})
+		next_request.state["path"] = resp["path"]
+
+	# Start together with the other clients
+	time.sleep(max(0,start-time.time()))
+	latencies = []
+	errors = 0
+	end = start+args.duration
+	while time.time() < end:
+		req = next_request()
+		t = time.time()
+		resp = client.request(req)
+		latencies.append(time.time()-t)
+		if resp["message"] not in ["OK","Not Modified"]:
+			errors += 1
+		if "version" in resp and hasattr(next_request,"state"):
+			next_request.state["version"] = resp["version"]
+	client.close()
+	results.put((kind,latencies,errors))
+
+## Read the Memory use of a Process
+#
+# @return - Resident set size in KB
+def rss_kb(pid):
+	with open("/proc/%d/status" % pid) as f:
+		for line in f:
+			if line.startswith("VmRSS:"):
+				return int(line.split()[1])
+	return None
+
+## Get a Percentile
+#
+# @param values - A sorted list
+def percentile(values,q):
+	if len(values) == 0:
+		return None
+	return values[min(len(values)-1,int(q*len(values)))]
+
+## Parse a Client Mix
+#
+# @param text - "kind=count,kind=count"
+# @return - A dict of kind -> count
+def parse_mix(text):
+	mix = {}
+	for part in text.split(","):
+		kind,count = part.split("=")
+		if kind not in CLIENT_KINDS:
+			raise ValueError("Unknown client kind: "+kind)
+		mix[kind] = int(count)
+	return mix
+
+## Start a Command Center
+#
+# @param options - More command line options, which override the defaults
+# @return - The Popen object
+def start_command_center(args,folder,options=()):
+	log = open(os.path.join(folder,"command_center.log"),"w")
+	cmd = [sys.executable,"command_center.py",
+		"--socket",args.socket,
+		"--db-folder",os.path.join(folder,"db"),
+		"--ws-port","0",
+		"--metrics","none",
+		"--no-daemons"]+list(options)
+	here = os.path.dirname(os.path.abspath(__file__))
+	proc = subprocess.Popen(cmd,cwd=here,stdout=log,stderr=subprocess.STDOUT)
+
+	# Wait for it to answer
+	client = libcc.CC_Client(args.socket,timeout=30)
+	client.request({"source":"cli","cmd":"fetch","type":"devices"})
+	client.close()
+	return proc
+
+## Run the Benchmark
+#
+# @return - A dict of results
+def run(args):
+	mix = parse_mix(args.mix)
+	folder = tempfile.mkdtemp(prefix="bench-cc-")
+	args.socket = os.path.join(folder,"cc.sock")
+	proc = start_command_center(args,folder)
+	try:
+		# Load the library once so the CLI clients have data
+		client = libcc.CC_Client(args.socket,timeout=60)
+		client.request({"source":"scanner","tv":[],
+			"movies":build_movies(args.library)})
+		client.close()
+		rss_start = rss_kb(proc.pid)
+
+		results = multiprocessing.Queue()
+		start = time.time()+1.0
+		workers = []
+		for kind,count in sorted(mix.items()):
+			for i in range(count):
+				p = multiprocessing.Process(target=run_client,
+					args=(kind,i,args,start,results))
+				p.start()
+				workers.append(p)
+
+		latencies = dict((kind,[]) for kind in mix)
+		errors = dict((kind,0) for kind in mix)
+		for p in workers:
+			kind,lat,err = results.get()
+			latencies[kind].extend(lat)
+			errors[kind] += err
+		for p in workers:
+			p.join()
+		rss_end = rss_kb(proc.pid)
+	finally:
+		proc.terminate()
+		proc.wait()
+		shutil.rmtree(folder)
+
+	report = {
+		"mix":mix,
+		"duration":args.duration,
+		"library":args.library,
+		"encoding":args.encoding,
+		"rss_start_kb":rss_start,
+		"rss_end_kb":rss_end,
+		"rss_growth_kb":rss_end-rss_start,
+		"kinds":{}
+		}
+	everything = []
+	for kind,lat in latencies.iteritems():
+		lat.sort()
+		everything.extend(lat)
+		report["kinds"][kind] = summarize(lat,args.duration)
+		report["kinds"][kind]["errors"] = errors[kind]
+	everything.sort()
+	report["total"] = summarize(everything,args.duration)
+	return report
+
+## Summarize Sorted Latencies
+def summarize(lat,duration):
+	return {
+		"requests":len(lat),
+		"throughput":len(lat)/float(duration),
+		"p50_ms":ms(percentile(lat,0.5)),
+		"p99_ms":ms(percentile(lat,0.99))
+		}
+
+def ms(seconds):
+	if seconds == None:
+		return None
+	return seconds*1000
+
+## Print a Report
+def print_report(report):
+	print "%d s, %d movies, %s encoding" % (report["duration"],
+		report["library"],report["encoding"])
+	print "%-12s %10s %10s %10s %10s %8s" % ("client","requests","req/s",
+		"p50 ms","p99 ms","errors")
+	rows = sorted(report["kinds"].items())+[("total",report["total"])]
+	for kind,r in rows:
+		print "%-12s %10d %10.1f %10.2f %10.2f %8s" % (kind,r["requests"],
+			r["throughput"],r["p50_ms"] or 0,r["p99_ms"] or 0,
+			r.get("errors",""))
+	print "RSS %d KB -> %d KB (%+d KB)" % (report["rss_start_kb"],
+		report["rss_end_kb"],report["rss_growth_kb"])
+
+## Compare a Report to a Baseline
+#
+# @return - A list of regression descriptions
+def compare(report,baseline,tolerance):
+	regressions = []
+	print "%-12s %-10s %12s %12s %8s" % ("client","metric","baseline",
+		"now","change")
+	kinds = sorted(report["kinds"].items())+[("total",report["total"])]
+	for kind,r in kinds:
+		if kind == "total":
+			base = baseline.get("total")
+		else:
+			base = baseline["kinds"].get(kind)
+		if base == None:
+			continue
+		for metric,higher_is_better in [("throughput",True),
+				("p50_ms",False),("p99_ms",False)]:
+			old = base.get(metric)
+			new = r.get(metric)
+			if not old or new == None:
+				continue
+			change = (new-old)/old
+			flag = ""
+			worse = -change if higher_is_better else change
+			if worse > tolerance:
+				flag = "REGRESSED"
+				regressions.append("%s %s" % (kind,metric))
+			print "%-12s %-10s %12.2f %12.2f %+7.0f%% %s" % (kind,metric,
+				old,new,change*100,flag)
+	return regressions
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(
+		description="Benchmark the Command Center under synthetic load")
+	parser.add_argument("-m","--mix",default=DEFAULT_MIX,
+		help="Clients of each kind, e.g. "+DEFAULT_MIX)
+	parser.add_argument("-d","--duration",type=float,default=10,
+		help="Seconds to run for")
+	parser.add_argument("-n","--library",type=int,default=5000,
+		help="Number of movies the scanner uploads")
+	parser.add_argument("-e","--encoding",default=libcc.ENCODING_JSON,
+		choices=libcc.ENCODINGS)
+	parser.add_argument("-s","--save",metavar="BASELINE.json",
+		help="Save the results as a baseline")
+	parser.add_argument("-c","--compare",metavar="BASELINE.json",
+		help="Compare the results to a saved baseline")
+	parser.add_argument("-t","--tolerance",type=float,
+		default=DEFAULT_TOLERANCE,
+		help="Fraction a metric may get worse before it is a regression")
+	args = parser.parse_args()
+
+	report = run(args)
+	print_report(report)
+	if args.save:
+		with open(args.save,"w") as f:
+			json.dump(report,f,indent=1,sort_keys=True)
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		print
+		regressions = compare(report,baseline,args.tolerance)
+		if len(regressions) > 0:
+			print "Regressions: "+", ".join(regressions)
+			sys.exit(1)
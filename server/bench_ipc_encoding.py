@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+#----------------------
+# IPC Encoding Benchmark
+#
+# Measures encode time, decode time, and bytes on the wire for each IPC
+# encoding using a synthetic movie library.
+#-----------------------
+
+import libcommand_center as libcc
+import random
+import time
+import hashlib
+
+#-----------------
+# Constants
+#-----------------
+
+# Words used to build synthetic movie titles
+TITLE_WORDS = ["The","Return","Night","Star","Last","Dark","City","Of",
+	"King","War","Love","Story","Man","Day","Lost","Blue","Red","Secret",
+	"House","River","Ghost","Empire","Island","Summer","Winter","Road"]
+
+MOVIE_FOLDER = "/mnt/raid/Movies/Features"
+HTTP_SERVER_MEDIA_FOLDER = "/mnt/raid/www/media"
+
+
+## Build a Synthetic Library
+#
+# Creates a "fetch movies" response with the same fields the Media Scanner
+# and Converter produce.
+#
+# @param count - Number of titles to generate
+# @return - A response object like the one the Command Center sends
+def build_response(count):
+	rand = random.Random(count)
+	movies = []
+	for i in range(count):
+		title = " ".join(rand.sample(TITLE_WORDS,rand.randint(1,4)))
+		title += " (%d)" % rand.randint(1950,2013)
+		ext = rand.choice(["mkv","mp4","avi"])
+		path = "%s/%s/%s.%s" % (MOVIE_FOLDER,title,title,ext)
+		entry = {"path":path,"title":title}
+		# About half of the library has been transcoded
+		if rand.random() < 0.5:
+			name = hashlib.sha224(path).hexdigest()
+			entry["transcoded"] = "%s/%s.mp4" % (
+				HTTP_SERVER_MEDIA_FOLDER,name)
+		movies.append(entry)
+
+	return {
+		"source":"command_center",
+		"message":"OK",
+		"id":1,
+		"data":movies
+		}
+
+## Time a function
+#
+# @return - (best time in milliseconds, return value of the last call)
+def best_of(func,repeat):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		ret = func()
+		t = (time.time()-start)*1000
+		if best == None or t < best:
+			best = t
+	return best,ret
+
+## Benchmark one Encoding
+#
+# @return - A dict with the packet size and encode/decode times
+def run(resp,encoding,repeat):
+	enc_ms,pkt = best_of(lambda: libcc.json_to_pkt(resp,encoding),repeat)
+	dec_ms,obj = best_of(lambda: libcc.Frame_Decoder().feed(pkt),repeat)
+	assert obj[0] == resp
+	return {
+		"encoding":encoding,
+		"bytes":len(pkt),
+		"encode_ms":enc_ms,
+		"decode_ms":dec_ms
+		}
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Benchmark IPC encodings")
+	parser.add_argument("-n","--titles",type=int,default=50000)
+	parser.add_argument("-r","--repeat",type=int,default=5)
+	args = parser.parse_args()
+
+	# Round trip through JSON so strings are unicode, like real responses
+	resp = libcc.pkt_to_json(libcc.json_to_pkt(build_response(args.titles)))[0]
+
+	print "%d titles, best of %d" % (args.titles,args.repeat)
+	print "%-10s %12s %12s %12s" % ("encoding","bytes","encode ms","decode ms")
+	for encoding in [libcc.ENCODING_JSON,libcc.ENCODING_COMPACT]:
+		r = run(resp,encoding,args.repeat)
+		print "%-10s %12d %12.1f %12.1f" % (r["encoding"],r["bytes"],
+			r["encode_ms"],r["decode_ms"])
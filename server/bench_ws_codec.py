@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+#----------------------
+# WebSocket Codec Benchmark
+#
+# Measures how fast ws_proxy encodes frames to devices and decodes (and
+# unmasks) frames from devices, in MB/s, next to the byte-at-a-time unmasking
+# the proxy used before.
+#-----------------------
+
+import ws_proxy
+import struct
+import time
+import os
+
+#-----------------
+# Constants
+#-----------------
+
+# Frame sizes to measure, in bytes
+FRAME_SIZES = [1024,64*1024,1024*1024]
+
+
+## Build a Masked Frame, like a Device Sends
+def masked_frame(data,mask):
+	size = len(data)
+	if size < 126:
+		header = struct.pack("!BB",0x81,0x80|size)
+	elif size < 0x10000:
+		header = struct.pack("!BBH",0x81,0x80|126,size)
+	else:
+		header = struct.pack("!BBQ",0x81,0x80|127,size)
+	return header+mask+ws_proxy.unmask(mask,data)
+
+## Unmask one Byte at a Time
+#
+# The loop ws_decode used to run
+def legacy_unmask(mask,data):
+	decoded = ""
+	for i in range(len(data)):
+		decoded += chr(ord(mask[i%4])^ord(data[i]))
+	return decoded
+
+## Measure Throughput
+#
+# Calls the function repeatedly for about the given time (at least once)
+#
+# @return - MB/s
+def throughput(func,size,seconds):
+	count = 0
+	start = time.time()
+	while(1):
+		func()
+		count += 1
+		elapsed = time.time()-start
+		if elapsed >= seconds:
+			break
+	return count*size/elapsed/1e6
+
+## Benchmark one Frame Size
+#
+# @return - A dict of MB/s for each operation
+def run(size,seconds,legacy=True):
+	data = os.urandom(size)
+	mask = os.urandom(4)
+	frame = masked_frame(data,mask)
+	assert ws_proxy.decode_frame(frame)[3] == data
+
+	masked = frame[-size:]
+	result = {
+		"size":size,
+		"encode":throughput(lambda: ws_proxy.encode_frame(data),size,
+			seconds),
+		"decode":throughput(lambda: ws_proxy.decode_frame(frame),size,
+			seconds),
+		"legacy":None
+		}
+	if legacy:
+		result["legacy"] = throughput(lambda: legacy_unmask(mask,masked),
+			size,seconds)
+	return result
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(
+		description="Benchmark the WebSocket frame codec")
+	parser.add_argument("-t","--time",type=float,default=1.0,
+		help="Seconds to spend on each measurement")
+	parser.add_argument("--no-legacy",action="store_true",
+		help="Skip the (slow) byte-at-a-time unmasking")
+	args = parser.parse_args()
+
+	print "%-10s %12s %12s %12s" % ("frame","encode MB/s","decode MB/s",
+		"legacy MB/s")
+	for size in FRAME_SIZES:
+		r = run(size,args.time,not args.no_legacy)
+		legacy = "-"
+		if r["legacy"] != None:
+			legacy = "%.1f" % r["legacy"]
+		print "%-10s %12.1f %12.1f %12s" % ("%d KB" % (size/1024),
+			r["encode"],r["decode"],legacy)
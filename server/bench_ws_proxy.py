@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+#----------------------
+# WebSocket Proxy Load Benchmark
+#
+# Starts a Command Center and connects a swarm of fake Chromecast receivers to
+# its WebSocket proxy, each from its own 127.x.y.z address.  The receivers
+# send bursts of status messages and answer the commands they are sent.  CLI
+# clients send commands through chromecast_command to random receivers.
+#
+# Reports the handshake rate, command round trip latency, memory per
+# connection, and the Command Center's CPU use.  Results can be saved as a
+# JSON baseline and later runs compared against it.
+#-----------------------
+
+import libcommand_center as libcc
+import bench_command_center as bench
+import bench_ws_codec
+import ws_proxy
+import multiprocessing
+import asyncore
+import resource
+import tempfile
+import shutil
+import socket
+import random
+import json
+import zlib
+import time
+import sys
+import os
+
+#-----------------
+# Constants
+#-----------------
+
+DEFAULT_PORT = 50606
+
+# Slowdown (as a fraction) that counts as a regression when comparing
+DEFAULT_TOLERANCE = 0.2
+
+# Commands the CLI clients send.  Status is left out, since it may be
+# answered from the Command Center's memory.
+BENCH_COMMANDS = ["play_pause","skip","load"]
+
+# Seconds to wait for every receiver to connect
+CONNECT_TIMEOUT = 60
+
+HANDSHAKE_TMPL = "GET / HTTP/1.1\r\nHost: 127.0.0.1:{0}\r\n"\
+	"Upgrade: websocket\r\nConnection: Upgrade\r\n"\
+	"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"\
+	"Sec-WebSocket-Version: 13\r\n{1}\r\n"
+
+# Metrics compared against a baseline, and whether higher is better
+COMPARED = [("handshakes_per_sec",True),("commands_per_sec",True),
+	("rtt_p50_ms",False),("rtt_p99_ms",False),("kb_per_connection",False),
+	("cpu_percent",False)]
+
+
+## Get the Address of a Receiver
+#
+# Every receiver needs its own address, since the Command Center keys
+# WebSockets by IP.  All of 127.0.0.0/8 is loopback.
+def receiver_addr(index):
+	return "127.1.%d.%d" % (index/250,index%250+1)
+
+
+## Fake Chromecast Receiver
+#
+# Connects to the proxy, sends status bursts when asked, and answers every
+# command with its "corr_id"
+class Fake_Receiver(asyncore.dispatcher):
+	def __init__(self,addr,args,status):
+		asyncore.dispatcher.__init__(self)
+		self.create_socket(socket.AF_INET,socket.SOCK_STREAM)
+		self.bind((addr,0))
+		self.status = status
+		self.mask = os.urandom(4)
+		self.read_buffer = ""
+		self.open = False
+		self.opened = None
+		self.failed = False
+		self.inflate = None
+		extensions = ""
+		if args.deflate:
+			extensions = "Sec-WebSocket-Extensions: permessage-deflate; "\
+				"client_max_window_bits\r\n"
+		self.write_buffer = HANDSHAKE_TMPL.format(args.port,extensions)
+		self.started = time.time()
+		self.connect(("127.0.0.1",args.port))
+
+	def handle_connect(self):
+		pass
+
+	def writable(self):
+		return len(self.write_buffer) > 0
+
+	def handle_write(self):
+		sent = self.send(self.write_buffer)
+		self.write_buffer = self.write_buffer[sent:]
+
+	def handle_read(self):
+		data = self.recv(65536)
+		if len(data) == 0:
+			return
+		self.read_buffer += data
+		if not self.open:
+			end = self.read_buffer.find("\r\n\r\n")
+			if end == -1:
+				return
+			headers = self.read_buffer[:end]
+			self.read_buffer = self.read_buffer[end+4:]
+			if not headers.startswith("HTTP/1.1 101"):
+				self.failed = True
+				self.close()
+				return
+			if "permessage-deflate" in headers:
+				self.inflate = zlib.decompressobj(-15)
+			self.open = True
+			self.opened = time.time()
+
+		offset = 0
+		while(1):
+			frame = ws_proxy.decode_frame(self.read_buffer,offset)
+			if frame == None:
+				break
+			fin,rsv,opcode,payload,offset = frame
+			if opcode != ws_proxy.OP_TEXT:
+				if opcode == ws_proxy.OP_PING:
+					self.send_frame(payload,ws_proxy.OP_PONG)
+				continue
+			if rsv == ws_proxy.RSV1:
+				payload = self.inflate.decompress(
+					payload+ws_proxy.DEFLATE_TAIL)
+			msg = json.loads(payload)
+			if "corr_id" in msg:
+				self.send_frame(json.dumps({"status":"ok",
+					"cmd":msg["cmd"],"corr_id":msg["corr_id"]}))
+		self.read_buffer = self.read_buffer[offset:]
+
+	def handle_close(self):
+		self.failed = self.failed or not self.open
+		self.open = False
+		self.close()
+
+	## Queue a Masked Frame, like a Device Sends
+	def send_frame(self,data,opcode=ws_proxy.OP_TEXT):
+		frame = bench_ws_codec.masked_frame(data,self.mask)
+		# masked_frame makes text frames
+		if opcode != ws_proxy.OP_TEXT:
+			frame = chr(0x80|opcode)+frame[1:]
+		self.write_buffer += frame
+
+	## Send a Burst of Status Messages
+	def burst(self,count):
+		if self.open:
+			for i in range(count):
+				self.send_frame(self.status)
+
+
+## Run a Group of Receivers
+#
+# Puts ("ready", first connect time, handshake times, failures) on the
+# result queue once every receiver has connected or given up, then sends
+# status bursts until stop is set.
+def run_receivers(indexes,args,stop,results):
+	# A status message of about the requested size
+	status = json.dumps({"type":"status","paused":False,"position":0.0,
+		"pad":""})
+	status = json.dumps({"type":"status","paused":False,"position":0.0,
+		"pad":"x"*max(0,args.frame_size-len(status))})
+
+	receivers = []
+	for i in indexes:
+		receivers.append(Fake_Receiver(receiver_addr(i),args,status))
+	started = min(r.started for r in receivers)
+	deadline = time.time()+CONNECT_TIMEOUT
+	while time.time() < deadline:
+		if all(r.open or r.failed for r in receivers):
+			break
+		asyncore.loop(timeout=0.05,count=1,use_poll=True)
+	connected = [r for r in receivers if r.opened != None]
+	handshakes = [r.opened-r.started for r in connected]
+	finished = max([r.opened for r in connected]+[started])
+	failed = len(receivers)-len(connected)
+	results.put(("ready",started,finished,handshakes,failed))
+
+	next_burst = time.time()
+	while not stop.is_set():
+		now = time.time()
+		if args.burst > 0 and now >= next_burst:
+			for r in receivers:
+				r.burst(args.burst)
+			next_burst = now+args.burst_interval
+		asyncore.loop(timeout=0.05,count=1,use_poll=True)
+	for r in receivers:
+		r.close()
+	results.put(("done",))
+
+## Run one CLI Client
+#
+# Sends commands to random receivers until the run ends and puts
+# ("rtt", list of round trip times, error count) on the result queue.
+def run_client(index,args,start,results):
+	rand = random.Random(index)
+	client = libcc.CC_Client(args.socket,timeout=30)
+	client.connect()
+	time.sleep(max(0,start-time.time()))
+	latencies = []
+	errors = 0
+	end = start+args.duration
+	while time.time() < end:
+		req = {
+			"source":"cli",
+			"cmd":rand.choice(BENCH_COMMANDS),
+			"addr":receiver_addr(rand.randrange(args.receivers)),
+			"percent":50,
+			"src":"http://127.0.0.1/bench.mp4"
+			}
+		t = time.time()
+		resp = client.request(req)
+		latencies.append(time.time()-t)
+		if not isinstance(resp["message"],dict):
+			errors += 1
+	client.close()
+	results.put(("rtt",latencies,errors))
+
+## Read the CPU Time of a Process
+#
+# @return - User plus system CPU seconds
+def cpu_seconds(pid):
+	with open("/proc/%d/stat" % pid) as f:
+		# The command name may hold spaces, so count from after it
+		fields = f.read().rsplit(")",1)[1].split()
+	return (int(fields[11])+int(fields[12]))/float(os.sysconf("SC_CLK_TCK"))
+
+## Allow as many Open Files as the System Does
+#
+# Each receiver is a socket here and another in the Command Center
+def raise_file_limit():
+	soft,hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE,(hard,hard))
+
+## Run the Benchmark
+#
+# @return - A dict of results
+def run(args):
+	raise_file_limit()
+	folder = tempfile.mkdtemp(prefix="bench-ws-")
+	args.socket = os.path.join(folder,"cc.sock")
+	options = ["--ws-port",str(args.port)]
+	if not args.deflate:
+		options += ["--ws-window-bits","0"]
+	proc = bench.start_command_center(args,folder,options)
+	workers = []
+	stop = multiprocessing.Event()
+	try:
+		rss_start = bench.rss_kb(proc.pid)
+		results = multiprocessing.Queue()
+
+		# Connect the receivers, split between worker processes
+		for w in range(args.workers):
+			indexes = range(w,args.receivers,args.workers)
+			p = multiprocessing.Process(target=run_receivers,
+				args=(indexes,args,stop,results))
+			p.start()
+			workers.append(p)
+		handshakes = []
+		failed = 0
+		starts = []
+		ends = []
+		for p in workers:
+			kind,started,ended,times,fails = results.get()
+			starts.append(started)
+			ends.append(ended)
+			handshakes.extend(times)
+			failed += fails
+		connect_time = max(ends)-min(starts)
+		# Let the Command Center settle before measuring its memory
+		time.sleep(0.5)
+		rss_connected = bench.rss_kb(proc.pid)
+
+		# Send commands while the receivers send status bursts
+		start = time.time()+1.0
+		clients = []
+		for i in range(args.clients):
+			p = multiprocessing.Process(target=run_client,
+				args=(i,args,start,results))
+			p.start()
+			clients.append(p)
+		time.sleep(max(0,start-time.time()))
+		cpu_start = cpu_seconds(proc.pid)
+		latencies = []
+		errors = 0
+		for p in clients:
+			kind,lat,err = results.get()
+			latencies.extend(lat)
+			errors += err
+		elapsed = time.time()-start
+		cpu = cpu_seconds(proc.pid)-cpu_start
+		for p in clients:
+			p.join()
+		rss_end = bench.rss_kb(proc.pid)
+	finally:
+		stop.set()
+		for p in workers:
+			p.join()
+		proc.terminate()
+		proc.wait()
+		shutil.rmtree(folder)
+
+	handshakes.sort()
+	latencies.sort()
+	connected = len(handshakes)
+	return {
+		"receivers":args.receivers,
+		"clients":args.clients,
+		"duration":args.duration,
+		"frame_size":args.frame_size,
+		"burst":args.burst,
+		"burst_interval":args.burst_interval,
+		"deflate":args.deflate,
+		"connected":connected,
+		"connect_failures":failed,
+		"handshakes_per_sec":connected/max(connect_time,1e-6),
+		"handshake_p50_ms":bench.ms(bench.percentile(handshakes,0.5)),
+		"handshake_p99_ms":bench.ms(bench.percentile(handshakes,0.99)),
+		"commands":len(latencies),
+		"command_errors":errors,
+		"commands_per_sec":len(latencies)/float(args.duration),
+		"rtt_p50_ms":bench.ms(bench.percentile(latencies,0.5)),
+		"rtt_p99_ms":bench.ms(bench.percentile(latencies,0.99)),
+		"rss_start_kb":rss_start,
+		"rss_connected_kb":rss_connected,
+		"rss_end_kb":rss_end,
+		"kb_per_connection":(rss_connected-rss_start)/float(max(connected,1)),
+		"cpu_percent":100*cpu/elapsed
+		}
+
+## Print a Report
+def print_report(r):
+	print "%d receivers (%d failed), %d clients, %d s, %d byte status x%d "\
+		"every %.1f s, deflate %s" % (r["connected"],r["connect_failures"],
+		r["clients"],r["duration"],r["frame_size"],r["burst"],
+		r["burst_interval"],"on" if r["deflate"] else "off")
+	print "handshakes   %10.1f /s   p50 %8.2f ms   p99 %8.2f ms" % (
+		r["handshakes_per_sec"],r["handshake_p50_ms"] or 0,
+		r["handshake_p99_ms"] or 0)
+	print "commands     %10.1f /s   p50 %8.2f ms   p99 %8.2f ms   "\
+		"errors %d" % (r["commands_per_sec"],r["rtt_p50_ms"] or 0,
+		r["rtt_p99_ms"] or 0,r["command_errors"])
+	print "RSS %d KB -> %d KB connected (%.1f KB per connection) -> %d KB" % (
+		r["rss_start_kb"],r["rss_connected_kb"],r["kb_per_connection"],
+		r["rss_end_kb"])
+	print "Command Center CPU %.1f%%" % r["cpu_percent"]
+
+## Compare a Report to a Baseline
+#
+# @return - A list of regression descriptions
+def compare(report,baseline,tolerance):
+	regressions = []
+	print "%-20s %12s %12s %8s" % ("metric","baseline","now","change")
+	for metric,higher_is_better in COMPARED:
+		old = baseline.get(metric)
+		new = report.get(metric)
+		if not old or new == None:
+			continue
+		change = (new-old)/old
+		flag = ""
+		worse = -change if higher_is_better else change
+		if worse > tolerance:
+			flag = "REGRESSED"
+			regressions.append(metric)
+		print "%-20s %12.2f %12.2f %+7.0f%% %s" % (metric,old,new,
+			change*100,flag)
+	return regressions
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(
+		description="Benchmark the WebSocket proxy with fake Chromecasts")
+	parser.add_argument("-r","--receivers",type=int,default=500,
+		help="Number of fake receivers")
+	parser.add_argument("-w","--workers",type=int,default=4,
+		help="Processes the receivers are split between")
+	parser.add_argument("-n","--clients",type=int,default=4,
+		help="Number of CLI clients sending commands")
+	parser.add_argument("-d","--duration",type=float,default=10,
+		help="Seconds to send commands for")
+	parser.add_argument("-f","--frame-size",type=int,default=256,
+		help="Bytes in each status message")
+	parser.add_argument("-b","--burst",type=int,default=5,
+		help="Status messages each receiver sends per burst")
+	parser.add_argument("-i","--burst-interval",type=float,default=1.0,
+		help="Seconds between status bursts")
+	parser.add_argument("-z","--deflate",action="store_true",
+		help="Negotiate permessage-deflate")
+	parser.add_argument("-p","--port",type=int,default=DEFAULT_PORT,
+		help="WebSocket port for the Command Center")
+	parser.add_argument("-s","--save",metavar="BASELINE.json",
+		help="Save the results as a baseline")
+	parser.add_argument("-c","--compare",metavar="BASELINE.json",
+		help="Compare the results to a saved baseline")
+	parser.add_argument("-t","--tolerance",type=float,
+		default=DEFAULT_TOLERANCE,
+		help="Fraction a metric may get worse before it is a regression")
+	args = parser.parse_args()
+
+	report = run(args)
+	print_report(report)
+	if args.save:
+		with open(args.save,"w") as f:
+			json.dump(report,f,indent=1,sort_keys=True)
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		print
+		regressions = compare(report,baseline,args.tolerance)
+		if len(regressions) > 0:
+			print "Regressions: "+", ".join(regressions)
+			sys.exit(1)
@@ -48,12 +48,16 @@ def play_pause(addr):
 # This function reads the Chromecast's video player status
 #
 # @param addr - A stirng containing the IP address of the Chomecast
+# @param fresh - Ask the device, even if the Command Center has a recent
+#		status in memory
 # @return A JSON boject containing the Player's status
-def status(addr):
+def status(addr,fresh=False):
 	obj = {
 		"cmd":"status",
 		"addr":addr
 	}
+	if fresh:
+		obj["max_age"] = 0
 	resp = cc_communicate(obj)
 	for key in resp["message"]:
 		print key,":",resp["message"][key]
@@ -167,6 +171,51 @@ def exit(addr):
 	return resp["message"]
 
 
+#------------------
+# Group Functions
+#
+# A group is a named list of Chromecasts that can be sent one command
+#------------------
+
+## Create or Change a Group
+#
+# @param name - Group name, such as "living room"
+# @param members - A list of Chromecast IP addresses
+# @return - The response message
+def set_group(name,members):
+	obj = {
+		"cmd":"group_set",
+		"group":name,
+		"members":members
+		}
+	return cc_communicate(obj)["message"]
+
+## Delete a Group
+#
+# @param name - Group name
+# @return - The response message
+def delete_group(name):
+	obj = {
+		"cmd":"group_delete",
+		"group":name
+		}
+	return cc_communicate(obj)["message"]
+
+## Send a Command to every Chromecast in a Group
+#
+# Prints each member's reply
+#
+# @param name - Group name
+# @param obj - The command, as for a single device but without "addr"
+# @return - The response message
+def group_command(name,obj):
+	obj["group"] = name
+	resp = cc_communicate(obj)
+	for addr in sorted(resp.get("data",{})):
+		print addr,":",resp["data"][addr]
+	return resp["message"]
+
+
 ## Prepare Media for Streaming
 #
 # This function tells the Command Center to add the follwing file to the
@@ -197,6 +246,75 @@ def conv_remove(path):
         return resp["message"]
 	
 
+## Run a Batch of Commands
+#
+# Sends a list of request objects to the Command Center in one round trip.
+# Each request gets its own response, even if another one fails.
+#
+# @param reqs - A list of request objects (the source is added for you)
+# @return - A list of response objects, one per request
+def batch(reqs):
+	return libcc.send_batch(reqs,source="cli")
+
+## Print Command Center Metrics
+#
+# Shows request latencies, traffic per source, event loop lag and queue
+# depths
+def stats():
+	resp = cc_communicate({"cmd":"stats"})
+	if resp["message"] != "OK":
+		print resp["message"]
+		return
+	for name in sorted(resp["data"]):
+		value = resp["data"][name]
+		if isinstance(value,dict) and "count" not in value:
+			# Labelled metric
+			print name
+			for label in sorted(value):
+				print "\t",label,":",value[label]
+		else:
+			print name,":",value
+
+## Profile the Command Center
+#
+# Runs the sampling profiler for a while and prints the collapsed stacks,
+# ready for flamegraph.pl
+#
+# @param seconds - How long to profile for
+# @param daemons - True to profile the daemons too
+def profile(seconds,daemons=False):
+	import time,sys
+	resp = cc_communicate({"cmd":"profile_start","daemons":daemons})
+	if resp["message"] != "OK":
+		print resp["message"]
+		return
+	time.sleep(seconds)
+	resp = cc_communicate({"cmd":"profile_stop","daemons":daemons})
+	if resp["message"] != "OK":
+		print resp["message"]
+		return
+	print resp["data"]
+	for name,path in resp.get("daemons",{}).iteritems():
+		sys.stderr.write("%s: %s\n" % (name,path))
+
+## Watch for Changes
+#
+# Subscribes to the given topics and prints every event the Command Center
+# pushes until interrupted.
+#
+# @param topics - A list of topic names (devices, library, transcode_queue,
+#		player)
+def watch(topics):
+	client = libcc.get_client()
+	resp = client.subscribe(topics)
+	if resp["message"] != "OK":
+		print resp["message"]
+		return
+	while(1):
+		event = client.wait_event(timeout=60)
+		if event != None:
+			print event["topic"],":",event["data"]
+
 ## CLI argument Parser
 if __name__ == "__main__":
 	import argparse
@@ -204,22 +322,74 @@ if __name__ == "__main__":
 	parser.add_argument("-u","--url", metavar="/path/to/file")
 	parser.add_argument("-p","--play-pause",action="store_true")
 	parser.add_argument("-s","--status",action="store_true")
+	parser.add_argument("--fresh",action="store_true",
+		help="With --status, ask the device instead of the Command "
+		"Center's last known status")
 	parser.add_argument("-k","--skip", type=float)
 	parser.add_argument("-d","--devices", action="store_true")
 	parser.add_argument("-m","--movies", action="store_true")
 	parser.add_argument("-l","--launch",action="store_true")
 	parser.add_argument("-a","--address",metavar="IP_ADDR")
+	parser.add_argument("-g","--group",metavar="NAME",
+		help="Send the playback command to every Chromecast in a group")
+	parser.add_argument("--set-group",nargs="+",metavar="NAME IP_ADDR",
+		help="Create or change a group")
+	parser.add_argument("--delete-group",metavar="NAME")
+	parser.add_argument("-w","--watch",metavar="TOPIC",action="append",
+		help="Print change events for a topic (repeatable)")
+	parser.add_argument("-b","--batch",metavar="/path/to/requests.json",
+		help="Run a JSON list of requests in one round trip (- for stdin)")
 
 	parser.add_argument("-x","--exit",action="store_true")
+	parser.add_argument("-S","--stats",action="store_true",
+		help="Print Command Center metrics")
+	parser.add_argument("-P","--profile",type=float,metavar="SECONDS",
+		help="Profile the Command Center and print collapsed stacks")
+	parser.add_argument("--daemons",action="store_true",
+		help="With --profile, profile the daemons too")
 
 
 	args = parser.parse_args()
 
 	## Non-Chromecast Specific Commands
-	if args.devices:
+	if args.batch:
+		import json,sys
+		if args.batch == "-":
+			reqs = json.load(sys.stdin)
+		else:
+			reqs = json.load(open(args.batch))
+		print json.dumps(batch(reqs),indent=1)
+	elif args.watch:
+		watch(args.watch)
+	elif args.stats:
+		stats()
+	elif args.profile:
+		profile(args.profile,args.daemons)
+	elif args.devices:
 		devices()
 	elif args.movies:
 		movies()
+	elif args.set_group:
+		print set_group(args.set_group[0],args.set_group[1:])
+	elif args.delete_group:
+		print delete_group(args.delete_group)
+	## Group Commands
+	elif args.group:
+		if args.play_pause:
+			obj = {"cmd":"play_pause"}
+		elif args.status:
+			obj = {"cmd":"status"}
+			if args.fresh:
+				obj["max_age"] = 0
+		elif args.skip:
+			obj = {"cmd":"skip","percent":args.skip}
+		elif args.url:
+			obj = {"cmd":"load","src":args.url}
+		else:
+			obj = None
+			parser.print_help()
+		if obj != None:
+			print group_command(args.group,obj)
 	## Chromecast Specific Commands
 	elif args.address == None:
 		print "You must specify an IP address for some commands"
@@ -231,7 +401,7 @@ if __name__ == "__main__":
 	elif args.play_pause:
 		play_pause(args.address)
 	elif args.status:
-		status(args.address)
+		status(args.address,args.fresh)
 	elif args.skip:
 		skip(args.address,args.skip)
 	elif args.url:
@@ -8,8 +8,117 @@ import ws_proxy
 from socket import timeout as SOCK_TIMEOUT
 from socket import error as SOCK_ERROR
 import os.path
+import atexit
+import signal
+import sys
 import time
+import gc
+import json
+import base64
+import heapq
+import collections
+import itertools
 import dial.rest
+import media_store
+import persistence
+import search_index
+import event_loop
+import metrics
+import profiler
+
+#----------------
+# Constants
+#----------------
+
+# Seconds between watchdog runs
+WATCHDOG_INTERVAL = 10
+
+# Bytes that may wait in a connection's output queue before the overflow
+# policy kicks in.  Events are dropped, oldest first.  A connection that
+# lets responses pile up past this is disconnected.
+OUTPUT_HIGH_WATER = 16*1024*1024
+
+# Queued frames are joined into sends of about this many bytes
+SEND_SIZE = 256*1024
+
+# Chromecast commands that are forwarded over the device's WebSocket and
+# answered by the device
+WS_COMMANDS = ["play_pause","status","load","skip"]
+# Every Chromecast command
+CHROMECAST_COMMANDS = WS_COMMANDS+["launch","exit"]
+
+# Seconds to wait for a Chromecast to answer a command.  This is shorter
+# than the client timeout so the client gets the error.
+CHROMECAST_TIMEOUT = 4
+# A "status" command is answered from the last known player state if it is
+# at most this many seconds old
+STATUS_MAX_AGE = 5
+# A device's status updates go out as "player" events at most this often.
+# The first goes out at once; later ones within the interval are held and
+# only the newest is published when it ends.
+PLAYER_EVENT_INTERVAL = 1
+
+# Seconds a converter worker holds a transcode job.  Each progress update
+# renews it.  A job whose lease runs out (its worker crashed, say) goes back
+# in the queue.
+LEASE_SECONDS = 60
+# A job that has been handed out this many times is not handed out again
+MAX_JOB_ATTEMPTS = 3
+
+# Fetch fields that ask for a single page instead of the whole collection
+PAGE_FIELDS = ["limit","cursor","fields","sort"]
+
+# Collections whose whole-collection fetch is served from the response cache
+CACHED_FETCH_TYPES = ["movies","tv","devices"]
+# Other collections that can be fetched whole
+FETCH_TYPES = CACHED_FETCH_TYPES+["groups"]
+
+# Label values metrics are kept for.  Anything else a client sends is
+# counted as "other", so bad requests can not add series without limit.
+METRIC_SOURCES = ["discoverer","converter","cli","webui","scanner","client",
+	"unknown","none"]
+METRIC_COMMANDS = CHROMECAST_COMMANDS+["hello","batch","kill","fetch",
+	"search","subscribe","unsubscribe","conv","conv_status","conv_cancel",
+	"stats","profile_start","profile_stop","group_set","group_delete",
+	"update","complete","release","none"]
+
+#----------------
+# Metrics
+#----------------
+REQUEST_SECONDS = metrics.REGISTRY.histogram("cc_request_seconds",
+	"Time to build and encode a response",["source","cmd"])
+RECEIVED_BYTES = metrics.REGISTRY.counter("cc_received_bytes_total",
+	"Bytes received from IPC connections",["source"])
+SENT_BYTES = metrics.REGISTRY.counter("cc_sent_bytes_total",
+	"Bytes queued for IPC connections",["source"])
+DROPPED_FRAMES = metrics.REGISTRY.counter("cc_dropped_events_total",
+	"Events dropped because a connection was not reading",["source"])
+OVERFLOW_CLOSES = metrics.REGISTRY.counter("cc_overflow_disconnects_total",
+	"Connections closed because their output queue overflowed",["source"])
+CHROMECAST_SECONDS = metrics.REGISTRY.histogram("cc_chromecast_command_seconds",
+	"Time for a Chromecast to answer a forwarded command",["cmd"])
+CHROMECAST_TIMEOUTS = metrics.REGISTRY.counter(
+	"cc_chromecast_timeouts_total",
+	"Forwarded commands the Chromecast did not answer in time",["cmd"])
+GROUP_SKEW_SECONDS = metrics.REGISTRY.histogram("cc_group_send_skew_seconds",
+	"Time between the first and last member getting a group command")
+PLAYER_COALESCED = metrics.REGISTRY.counter("cc_player_events_coalesced_total",
+	"Chromecast status updates replaced by a newer one before publishing")
+LEASE_EXPIRIES = metrics.REGISTRY.counter("cc_transcode_lease_expiries_total",
+	"Transcode jobs requeued because their worker stopped reporting")
+CYCLE_SECONDS = metrics.REGISTRY.histogram("cc_daemon_cycle_seconds",
+	"Time the scanner and discoverer took for one pass",["daemon"],
+	metrics.CYCLE_BUCKETS)
+# Read from the database when asked for.  The Command Center sets the
+# functions.
+QUEUE_LENGTH = metrics.REGISTRY.gauge("cc_transcode_queue_length",
+	"Jobs in the transcode queue")
+QUEUE_AGE = metrics.REGISTRY.gauge("cc_transcode_queue_oldest_seconds",
+	"Time the oldest transcode job has been queued")
+
+# Topics that clients can subscribe to.  The Command Center pushes an event to
+# every subscriber whenever the matching part of the database changes.
+TOPICS = ["devices","library","transcode_queue","player"]
 
 ## Update Handler
 #
@@ -25,8 +134,17 @@ class Update_Handler(asyncore.dispatcher):
 	def __init__(self,sock,cc):
 		asyncore.dispatcher.__init__(self,sock)
 		# Intitialize the read/write buffers
-		self.read_buffer = ""
-		self.write_buffer = ""
+		self.decoder = libcc.Frame_Decoder()
+		# Output queue of [packet, droppable] frames, the bytes they
+		# hold, and how much of the first frame has been sent
+		self.out = collections.deque()
+		self.out_bytes = 0
+		self.out_offset = 0
+		# Every connection starts with plain JSON.  A client can ask
+		# for a different encoding with the "hello" command.
+		self.encoding = libcc.ENCODING_JSON
+		# Source of the last request, for the byte counters
+		self.source = "unknown"
 
 		# Keep track of the command center and the CC Database
 		self.command_center = cc
@@ -34,62 +152,61 @@ class Update_Handler(asyncore.dispatcher):
 
 	## Check if A Write is pending
 	#
-	# Checks if the writebuffer is empty. Also checks if any of the 
-	# Websockets have new messages in the Inbox
+	# Messages from the Websockets are pushed into the output queue as
+	# they arrive, so only the queue has to be checked.
 	#
 	# @return - True if data is ready to be sent
 	def writable(self):
-		# Check if the current write-buffer is not empty
-		if len(self.write_buffer) > 0:
-			return True
-		# Check if any of the Websockets proxy's have messages waiting
-		ws = self.db["websockets"]
-		for key in ws:
-			if len(ws[key].inbox) > 0:
-				return True		
-
-		# If not data is queued, return false
-		return False
+		return len(self.out) > 0
 
 	## Handles the Write
 	#
-	# This method actually writes a chunk of data
+	# Sends as many queued frames as fit in one send.  Small frames are
+	# joined together.  A large frame is sent straight from the packet
+	# string without copying it.
 	def handle_write(self):
-		# Check the Websockets for pending messages
-		ws = self.db["websockets"]
-		for key in ws:
-			# Check if the Websocket is not empty
-			if len(ws[key].inbox) > 0:
-				# Create a Response object
-				resp = {
-					"source":"command_center",
-					"message":ws[key].recv_msg()
-				}
-				# Add it to the Write Buffer
-				self.write_buffer += libcc.json_to_pkt(resp)
-	
-		# Send a chunk of data from the write buffer
-		sent = self.send(self.write_buffer)
-		# Clear the data the was sent from the buffer
-		self.write_buffer[sent:]
+		head = self.out[0][0]
+		data = buffer(head,self.out_offset)
+		if len(data) < SEND_SIZE and len(self.out) > 1:
+			parts = [str(data)]
+			size = len(data)
+			for pkt,droppable in itertools.islice(self.out,1,None):
+				if size >= SEND_SIZE:
+					break
+				parts.append(pkt)
+				size += len(pkt)
+			data = "".join(parts)
+
+		sent = self.send(data)
+		self.out_bytes -= sent
+		# Drop the frames that were sent
+		while sent > 0:
+			left = len(self.out[0][0])-self.out_offset
+			if sent < left:
+				self.out_offset += sent
+				break
+			sent -= left
+			self.out.popleft()
+			self.out_offset = 0
 
 	## Handle a Read event
 	# 
 	# This function reads a chunk of data and attemps to process it. If
 	# it cannot decode the data, it exits and waits for more data
 	def handle_read(self):
-		# Add new data to the read buffer
-		self.read_buffer += self.recv(1024)
-		# Attempt to decode the packet
-		req, size = libcc.pkt_to_json(self.read_buffer)
-		# If The Request oject is None, return and wait for more data
-		if req == None:
-			return
-		else:
-			# If Request packet is created, prepare a response
+		# Decode every complete packet that has arrived.  Clients may
+		# pipeline several requests over one connection.
+		data = self.recv(libcc.READ_SIZE)
+		for req in self.decoder.feed(data):
+			# A response overflowed the output queue and closed
+			# the connection
+			if not self.connected:
+				break
+			if isinstance(req,dict) and "source" in req:
+				self.source = metric_label(req["source"],
+					METRIC_SOURCES)
 			self.prepare_response(req)
-			# Adjust the read buffer accordingly
-			self.read_buffer = self.read_buffer[size:]
+		RECEIVED_BYTES.inc(len(data),self.source)
 
 	## Prepare a Response
 	# 
@@ -98,6 +215,79 @@ class Update_Handler(asyncore.dispatcher):
 	# If more data is needed before a response can be made, it returns None
 	# and watis for th next chunk of data.
 	def prepare_response(self,req):
+		start = time.time()
+		resp = self.build_response(req)
+		# Echo the request ID so pipelining clients can match the
+		# response to their request
+		if "id" in req:
+			resp["id"] = req["id"]
+
+		#----------------------
+		# Send Response Message
+		#----------------------
+		# If a message was given, respond. 
+		if resp["message"] != None:
+			self.send_packet(resp)
+		# If the message was None, dont sent anying to write buffer
+
+		REQUEST_SECONDS.observe(time.time()-start,
+			metric_label(req.get("source","none"),METRIC_SOURCES),
+			metric_label(req.get("cmd","none"),METRIC_COMMANDS))
+
+	## Queue a Packet for Sending
+	#
+	# If the output queue is over the high-water mark, older droppable
+	# frames are dropped to make room.  If that is not enough, a droppable
+	# frame is dropped itself, and anything else closes the connection.
+	#
+	# @param obj - The JSON object to send
+	# @param droppable - True if the frame can be dropped when the client
+	#		is not keeping up (events), False for responses
+	def send_packet(self,obj,droppable=False):
+		if not self.connected:
+			return
+		pkt = libcc.json_to_pkt(obj,self.encoding)
+		# A single frame larger than the mark is allowed through when
+		# there is nothing else waiting
+		limit = self.command_center.output_high_water
+		if self.out_bytes > 0 and self.out_bytes+len(pkt) > limit:
+			self.drop_events(self.out_bytes+len(pkt)-limit)
+			if self.out_bytes > 0 and self.out_bytes+len(pkt) > limit:
+				if droppable:
+					DROPPED_FRAMES.inc(1,self.source)
+				else:
+					print "Closing connection from %s: output "\
+						"queue overflowed" % self.source
+					OVERFLOW_CLOSES.inc(1,self.source)
+					self.handle_close()
+				return
+
+		self.out.append([pkt,droppable])
+		self.out_bytes += len(pkt)
+		SENT_BYTES.inc(len(pkt),self.source)
+
+	## Drop Queued Events, Oldest First
+	#
+	# The frame that is partly sent is never dropped.
+	#
+	# @param needed - Bytes to free
+	def drop_events(self,needed):
+		kept = collections.deque()
+		if self.out_offset > 0:
+			kept.append(self.out.popleft())
+		for frame in self.out:
+			if needed > 0 and frame[1]:
+				needed -= len(frame[0])
+				self.out_bytes -= len(frame[0])
+				DROPPED_FRAMES.inc(1,self.source)
+			else:
+				kept.append(frame)
+		self.out = kept
+
+	## Build a Response
+	#
+	# Runs the request and returns the response object without sending it.
+	def build_response(self,req):
 		# Setup a default response object. "OK" is the default response
 		# if there is no error with the daemon update.
 		resp = {
@@ -108,8 +298,16 @@ class Update_Handler(asyncore.dispatcher):
 		#------------------------------------------------
 		# Analyze the Request Message and Create Response
 		#------------------------------------------------
+		# Encoding negotiation works the same for every source
+		if req.get("cmd") == "hello":
+			self.handle_hello(req,resp)
+
+		# Batches work the same for every source
+		elif req.get("cmd") == "batch":
+			self.handle_batch(req,resp)
+
 		# Check if a source is not given
-		if "source" not in req:
+		elif "source" not in req:
 			resp["message"] = "Error: Source Field not Provided"
 		
 		# If the request if from the device discoverer daemon
@@ -132,18 +330,244 @@ class Update_Handler(asyncore.dispatcher):
 		else:
 			resp["message"] = "Source is invalid"
 
-		#----------------------
-		# Send Response Message
-		#----------------------
-		# If a message was given, respond. 
-		if resp["message"] != None:
-			self.write_buffer += libcc.json_to_pkt(resp)
-		# If the message was None, dont sent anying to write buffer
+		return resp
+
+	## Run a Batch of Requests
+	#
+	# Runs each request in the "requests" list in order and returns all of
+	# the responses, in the same order, in the "data" field.  Requests
+	# without a source use the batch's source.  An error in one request is
+	# reported in its own response and does not stop the rest of the batch.
+	def handle_batch(self,req,resp):
+		if "requests" not in req:
+			resp["message"] = "Error - No Requests Given"
+			return
+		if not isinstance(req["requests"],list):
+			resp["message"] = "Error - Invalid Requests"
+			return
+
+		results = []
+		for sub in req["requests"]:
+			try:
+				if "source" not in sub and "source" in req:
+					sub["source"] = req["source"]
+				if sub.get("cmd") in WS_COMMANDS:
+					# The answer comes later, outside the batch
+					raise ValueError("Chromecast commands cannot be batched")
+				sub_resp = self.build_response(sub)
+			except Exception as e:
+				sub_resp = {
+					"source":"command_center",
+					"message":"Error - "+repr(e)
+					}
+			results.append(sub_resp)
+		resp["data"] = results
+
+	## Start the Sampling Profiler
+	#
+	# With "daemons" set, the running daemons are told to start profiling
+	# too
+	def profile_start(self,req,resp):
+		if profiler.sampler.running:
+			resp["message"] = "Error - Profiler Already Running"
+			return
+		interval = req.get("interval",profiler.PROFILE_INTERVAL)
+		if not profiler.valid_interval(interval):
+			resp["message"] = "Error - Invalid Interval"
+			return
+		try:
+			profiler.sampler.start(interval)
+		except signal.ItimerError:
+			# Too large for the timer
+			resp["message"] = "Error - Invalid Interval"
+			return
+		if req.get("daemons"):
+			resp["daemons"] = libcc.signal_processes(libcc.processes,
+					profiler.START_SIGNAL)
+
+	## Stop the Sampling Profiler
+	#
+	# Returns the collapsed stacks in the "data" field.  With "daemons"
+	# set, the daemons are told to stop as well and the "daemons" field
+	# gives the file each one writes its stacks to.
+	def profile_stop(self,req,resp):
+		if not profiler.sampler.running:
+			resp["message"] = "Error - Profiler Not Running"
+			return
+		resp["samples"] = profiler.sampler.samples
+		resp["data"] = profiler.sampler.stop()
+		if req.get("daemons"):
+			pids = libcc.signal_processes(libcc.processes,
+					profiler.STOP_SIGNAL)
+			resp["daemons"] = dict((name,profiler.dump_path(pid))
+					for name,pid in pids.iteritems())
+
+	## Fetch a whole Collection
+	#
+	# The encoded collection is cached until it changes, so repeated
+	# fetches do not encode it again.  A client that sends the "version"
+	# of its last fetch as "if_version" gets a "Not Modified" reply with no
+	# data if nothing changed.
+	def fetch_cached(self,req,resp):
+		cc = self.command_center
+		version = cc.version(req["type"])
+		resp["version"] = version
+		if req.get("if_version") == version:
+			resp["message"] = "Not Modified"
+		else:
+			resp["data"] = cc.encoded_data(req["type"],self.encoding)
+
+	## Fetch one Page of Movies or TV Episodes
+	#
+	# Handles the "limit", "cursor", "fields", and "sort" fields of a fetch.
+	# TV is paged by episode.  The "cursor" in the response is passed back
+	# to get the next page, and is None on the last page.
+	def fetch_page(self,req,resp):
+		if req["type"] == "movies":
+			store = self.db["movies"]
+		else:
+			store = self.db["tv"].episodes
+
+		# A leading "-" sorts in descending order
+		sort = req.get("sort")
+		if sort != None and (not isinstance(sort,basestring) or
+				sort in ["","-"]):
+			resp["message"] = "Error - Invalid Sort"
+			return
+		descending = False
+		if sort != None and sort.startswith("-"):
+			sort = sort[1:]
+			descending = True
+
+		limit = req.get("limit")
+		if limit != None and (not isinstance(limit,int) or limit < 1):
+			resp["message"] = "Error - Invalid Limit"
+			return
+
+		fields = req.get("fields")
+		if fields != None and (not isinstance(fields,list) or
+				not all(isinstance(f,basestring) for f in fields)):
+			resp["message"] = "Error - Invalid Fields"
+			return
+
+		after = None
+		epoch = self.command_center.epoch
+		if req.get("cursor") != None:
+			after = decode_cursor(req["cursor"],req.get("sort"),epoch)
+			if after == None:
+				resp["message"] = "Error - Invalid Cursor"
+				return
+
+		items,last = store.page(sort,after,limit,descending)
+
+		if fields != None:
+			items = [dict((f,x[f]) for f in fields if f in x)
+				for x in items]
+
+		resp["data"] = items
+		resp["cursor"] = None
+		if last != None:
+			resp["cursor"] = encode_cursor(last,req.get("sort"),epoch)
+
+	## Search Movies or TV Episodes
+	#
+	# Finds the items whose titles contain every word of the "query" (the
+	# last word may be partly typed) and that match every facet in
+	# "filters".  Results are sorted by title.
+	def search(self,req,resp):
+		kind = req.get("type","movies")
+		if kind not in self.command_center.search:
+			resp["message"] = "Error - Invalid Search Type"
+			return
+		if kind == "movies":
+			store = self.db["movies"]
+		else:
+			store = self.db["tv"].episodes
+
+		try:
+			paths = self.command_center.search[kind].search(
+				req.get("query",""),req.get("filters",{}))
+		except KeyError as e:
+			resp["message"] = "Error - Invalid Filter: %s" % e.args[0]
+			return
+
+		limit = req.get("limit")
+		if limit != None and (not isinstance(limit,int) or limit < 1):
+			resp["message"] = "Error - Invalid Limit"
+			return
+
+		items = [store.get(p) for p in paths]
+		order = lambda x: (x.get("title"),x["path"])
+		if limit != None:
+			items = heapq.nsmallest(limit,items,key=order)
+		else:
+			items.sort(key=order)
+
+		fields = req.get("fields")
+		if fields != None:
+			items = [dict((f,x[f]) for f in fields if f in x)
+				for x in items]
+
+		resp["data"] = items
+		resp["total"] = len(paths)
+
+	## Subscribe to Topics
+	#
+	# Adds this connection to the subscriber list of every topic in the
+	# request.  Events are pushed without an ID until the connection closes
+	# or unsubscribes.
+	def subscribe(self,req,resp):
+		topics = req.get("topics",[])
+		for topic in topics:
+			if topic not in TOPICS:
+				resp["message"] = "Error - Invalid Topic: "+topic
+				return
+		for topic in topics:
+			self.command_center.subscribe(topic,self)
+
+	## Push an Event
+	#
+	# Called by the Command Center when a topic this connection subscribed
+	# to has changed.
+	def push_event(self,event):
+		self.send_packet(event,droppable=True)
+
+	## Close handler
+	#
+	# Stop receiving events before closing the socket
+	def handle_close(self):
+		for topic in TOPICS:
+			self.command_center.unsubscribe(topic,self)
+		self.command_center.cancel_commands(self)
+		self.close()
+
+	## Negotiate the Wire Encoding
+	#
+	# Picks the first encoding in the client's list that the Command Center
+	# supports.  Every later packet on this connection uses it.
+	def handle_hello(self,req,resp):
+		for encoding in req.get("encodings",[]):
+			if encoding in libcc.ENCODINGS:
+				self.encoding = encoding
+				break
+		resp["encoding"] = self.encoding
 
 	def handle_scanner(self,req,resp):
-		# Overwrite the list of movies/tv on the database
-		self.db["movies"] = req["movies"]
-		self.db["tv"] = req["tv"]
+		if "cycle_seconds" in req:
+			CYCLE_SECONDS.observe(req["cycle_seconds"],"scanner")
+
+		event = {}
+		if self.db["tv"].to_list() != req["tv"]:
+			event["tv"] = req["tv"]
+
+		# Overwrite the list of movies/tv on the database.  The stores
+		# report which movies changed.
+		event["movies"] = self.db["movies"].replace(req["movies"])
+		self.db["tv"].replace(req["tv"])
+
+		movies = event["movies"]
+		if movies["added"] or movies["removed"] or "tv" in event:
+			self.command_center.publish("library",event)
 
 	def handle_user(self,req,resp):
 		# If no command was given, return an error
@@ -170,15 +594,63 @@ class Update_Handler(asyncore.dispatcher):
 			# Returns data from the database
 			if "type" not in req:
 				resp["message"] = "Error - No Type Given to Fetch"
-			elif req["type"] == "movies":
-				resp["data"] = self.db["movies"]
-			elif req["type"] == "tv":
-				resp["data"] = self.db["tv"]
-			elif req["type"] == "devices":
-				resp["data"] = self.db["devices"]
+			elif req["type"] in ["movies","tv"] and any(
+					key in req for key in PAGE_FIELDS):
+				self.fetch_page(req,resp)
+			elif req["type"] in CACHED_FETCH_TYPES:
+				self.fetch_cached(req,resp)
+			elif req["type"] == "groups":
+				resp["data"] = self.db["groups"]
 			else:
 				resp["message"] = "Error - Invalide Fetch Type"
 			return
+
+		elif req["cmd"] == "stats":
+			resp["data"] = metrics.REGISTRY.to_json()
+
+		elif req["cmd"] in CHROMECAST_COMMANDS and "group" in req:
+			# None means the devices answer later
+			resp["message"] = self.group_command(req)
+
+		elif req["cmd"] in CHROMECAST_COMMANDS:
+			if "addr" not in req:
+				resp["message"] = "Error - No Address Given"
+				return
+			# None means the device answers later
+			resp["message"] = self.chromecast_command(req)
+
+		elif req["cmd"] == "group_set":
+			if "group" not in req or "members" not in req:
+				resp["message"] = "Error - Group and Members not given"
+				return
+			members = req["members"]
+			if not isinstance(members,list) or not all(
+					isinstance(m,basestring) for m in members):
+				resp["message"] = "Error - Invalid Members"
+				return
+			self.command_center.set_group(req["group"],members)
+
+		elif req["cmd"] == "group_delete":
+			if req.get("group") not in self.db["groups"]:
+				resp["message"] = "Error - Unknown Group"
+				return
+			self.command_center.set_group(req["group"],None)
+
+		elif req["cmd"] == "profile_start":
+			self.profile_start(req,resp)
+
+		elif req["cmd"] == "profile_stop":
+			self.profile_stop(req,resp)
+
+		elif req["cmd"] == "search":
+			self.search(req,resp)
+
+		elif req["cmd"] == "subscribe":
+			self.subscribe(req,resp)
+
+		elif req["cmd"] == "unsubscribe":
+			for topic in req.get("topics",TOPICS):
+				self.command_center.unsubscribe(topic,self)
 		elif req["cmd"] == "conv":
 			if "path" not in req:
 				resp["message"] = "Error - Path not given"
@@ -186,12 +658,15 @@ class Update_Handler(asyncore.dispatcher):
 			else:
 				item = {
 					"path":req["path"],
-					"progress":0
+					"progress":0,
+					"queued":time.time()
 					}
-				self.db["transcode_queue"].append(item)
+				self.db["transcode_queue"].add(item)
+				self.command_center.publish("transcode_queue",
+					{"action":"add","item":item})
 
 		elif req["cmd"] == "conv_status":
-			resp["data"] = self.db["transcode_queue"]
+			resp["data"] = self.db["transcode_queue"].to_list()
 			return
 
 		elif req["cmd"] == "conv_cancel":
@@ -199,19 +674,32 @@ class Update_Handler(asyncore.dispatcher):
 				resp["message"] = "Error - Path Not Given"
 				return
 			else:
-				for c in self.db["transcode_queue"]:
-					if req["path"] == c["path"]:
-						self.db["transcode_queue"].remove(c)
-						break
+				c = self.db["transcode_queue"].remove(req["path"])
+				# The worker converting it finds out on its next update
+				self.command_center.end_lease(req["path"])
+				if c != None:
+					self.command_center.publish("transcode_queue",
+						{"action":"remove","item":c})
 				return
 						
 
 	def handle_discoverer(self,req,resp):
+		if "cycle_seconds" in req:
+			CYCLE_SECONDS.observe(req["cycle_seconds"],"discoverer")
 		# Add each device to the Command Center Database
+		changed = False
 		for d in req["devices"]:
 			# use the IP address as the dictonary key to avoid 
 			# multiple entries with the same IP
+			if self.db["devices"].get(d["ip"]) == d:
+				continue
 			self.db["devices"][d["ip"]] = d
+			self.command_center.journal.record("devices",d["ip"],d)
+			changed = True
+		# A report of the same devices keeps cached fetches valid
+		if changed:
+			self.command_center.devices_version += 1
+			self.command_center.publish("devices",req["devices"])
 		# As of now, there is no error checking so the resp wont be
 		# modified	
 
@@ -221,42 +709,61 @@ class Update_Handler(asyncore.dispatcher):
 			resp["message"] = "Error: No Command Provided"
 		# Fetch Command
 		elif req["cmd"] == "fetch":
-			resp["path"] = self.db["transcode_queue"][0]["path"]
+			job = self.command_center.lease_job(self.worker(req))
+			if job != None:
+				resp["path"] = job["path"]
+				resp["lease"] = LEASE_SECONDS
 		# Update Command
 		elif req["cmd"] == "update":
-			self.transcode_update(req)
-		# Complete Command
+			if not self.command_center.renew_lease(req["path"],
+					self.worker(req)):
+				resp["message"] = "Error - Job Not Leased"
+				return
+			self.converter_update(req)
+		# Complete Command.  The work is done, so it counts even if the
+		# lease ran out.
 		elif req["cmd"] == "complete":
-			self.transcode_complete(req)
+			self.command_center.end_lease(req["path"])
+			self.converter_complete(req)
+		# Release Command: the worker gives up on the job
+		elif req["cmd"] == "release":
+			if not self.command_center.end_lease(req["path"],
+					self.worker(req)):
+				resp["message"] = "Error - Job Not Leased"
+				return
+			self.command_center.requeue(req["path"],
+				req.get("error","Released"))
 		else:
 			resp["message"] = "Error: Invalid Converter Command"
 
+	## Get the Worker a Converter Request is from
+	#
+	# A converter that does not name itself is a single worker
+	def worker(self,req):
+		return req.get("worker","converter")
+
 	def converter_complete(self,req):
-		# Find the Item in the Transcode Queue to remove
-		for x in self.db["transcode_queue"]:
-			if req["path"] == x["path"]:
-				self.db["transcode_queue"].remove(x)
-
-		# Add the Transcoded path to the Movie Database
-		for x in self.db["movies"]:
-			if x["path"] == req["path"]:
-				x["transcoded"] = req["out"]
-
-		# Add the Transcoded path to the TV database
-		for show in self.db["tv"]:
-			for ep in show:
-				if ep["path"] == req["path"]:
-					ep["transcoded"] = req["out"]
-					
+		# Remove the Item from the Transcode Queue
+		x = self.db["transcode_queue"].remove(req["path"])
+		if x != None:
+			self.command_center.publish("transcode_queue",
+				{"action":"complete","item":x,"out":req["out"]})
+
+		# Add the Transcoded path to the Movie and TV databases
+		fields = {"transcoded":req["out"]}
+		self.db["movies"].update(req["path"],fields)
+		self.db["tv"].episodes.update(req["path"],fields)
 
 	def converter_update(self,req):
 		# Find the item in the "Transcoding Queue"
-		for x in self.db["transcode_queue"]:
-			if req["path"] == x["path"]:
-				# Update the info
-				x["frame"] = req["frame"]
-				x["time"] = req["time"]
-				x["conversion_time"] = req["convversion_time"]
+		fields = {"worker":self.worker(req)}
+		for key in ["frame","time","percent","conversion_time"]:
+			if key in req:
+				fields[key] = req[key]
+		x = self.db["transcode_queue"].update(req["path"],fields)
+		if x != None:
+			self.command_center.publish("transcode_queue",
+				{"action":"update","item":x})
 
 
 	## Chromecast Specific Commands
@@ -308,21 +815,81 @@ class Update_Handler(asyncore.dispatcher):
 				# If not, the websocket the app is likely not 
 				# launched yet
 				return "App has not been launched yet"
-			else:
-				# Forward the command through the websocket proxy
-				ws.send_msg(req)
-				# Return None.  The response will go t the WS's
-				# inbox so we will check that later.  
-				return None 
+			# A recent status can be answered without asking the
+			# device
+			if cmd == "status":
+				state = self.command_center.player_state(addr,
+					req.get("max_age",STATUS_MAX_AGE))
+				if state != None:
+					return state
+			# Forward the command through the websocket proxy.
+			# The reply is sent to this connection when the
+			# device answers, or an error when it does not.
+			self.command_center.forward_command(ws,req,self)
+			return None 
+
+	## Send a Chromecast Command to a Group
+	#
+	# The command goes to every member of the named group at once.  The
+	# response comes when all of them have answered, or at the deadline.
+	def group_command(self,req):
+		group = self.db["groups"].get(req["group"])
+		if group == None:
+			return "Error - Unknown Group"
+		if req["cmd"] not in WS_COMMANDS:
+			return "Error - Only %s can be sent to a group" % (
+				", ".join(WS_COMMANDS))
+		self.command_center.forward_group(group,req,self)
+		return None
 		
 
 
+## A Command Forwarded to a Chromecast
+#
+# Kept until the device answers or the deadline passes
+class Pending_Command(object):
+	def __init__(self,corr_id,addr,req,handler,timer):
+		self.corr_id = corr_id
+		self.addr = addr
+		self.req = req
+		self.handler = handler
+		self.timer = timer
+		self.start = time.time()
+		# Every device the command was sent to
+		self.addrs = [addr]
+
+
+## A Converter Worker's Hold on a Transcode Job
+class Lease(object):
+	def __init__(self,path,worker):
+		self.path = path
+		self.worker = worker
+
+
+## A Command Forwarded to every Chromecast in a Group
+#
+# Kept until every member answers or the group's deadline passes
+class Pending_Group(Pending_Command):
+	def __init__(self,corr_id,group,req,handler,timer):
+		Pending_Command.__init__(self,corr_id,None,req,handler,timer)
+		self.group = group
+		self.addrs = []
+		# Member address -> its reply, or an error
+		self.results = {}
+		# Members that have not answered yet
+		self.waiting = 0
+
+
 ## Main Command Center Unix Socket Server
 #
 # This is the main Command Center server.  It maintains a database and waits 
 # for Unix Socket connections.  It also creates a WebSocket Server object
 class Command_Center(asyncore.dispatcher):
-	def __init__(self):
+	## Constructor
+	#
+	# @param metrics_path - Unix socket path to serve Prometheus metrics
+	#		on, or None for no metrics socket
+	def __init__(self,metrics_path=None):
 		# Init the generic dispatcher
 		asyncore.dispatcher.__init__(self)
 
@@ -338,11 +905,66 @@ class Command_Center(asyncore.dispatcher):
 		# sub processes
 		self.db = {
 			"devices":{},	# Dict of Chromecast Devices found
-			"movies":[],	# List of Movies On Server
-			"tv":[],	# List of TV series on Server
-			"transcode_queue":[], # List of Videos to Transcode
+			# Movies On Server, keyed by path
+			"movies":media_store.Media_Store(),
+			# TV series on Server (episodes are indexed)
+			"tv":media_store.TV_Store(),
+			# Videos to Transcode, in order, keyed by path
+			"transcode_queue":media_store.Media_Store(),
 			"websockets":{}, # Dict of currently Open WebSockets
+			# Named groups of Chromecasts, keyed by name
+			"groups":{}
+			}
+		# Connections subscribed to each topic
+		self.subscribers = dict((topic,set()) for topic in TOPICS)
+		# Correlation ID -> Pending_Command, for commands forwarded to a
+		# Chromecast that have not been answered yet
+		self.pending_commands = {}
+		# Device address -> correlation IDs, oldest first
+		self.device_commands = {}
+		# Device address -> (time, last known player state)
+		self.player_states = {}
+		# Device address -> status update waiting for the end of its
+		# PLAYER_EVENT_INTERVAL, or None if none has come since the last
+		# was published
+		self.player_events = {}
+		# Transcode job path -> Lease.  Leases are not saved; after a
+		# restart they are rebuilt from each job's "worker" field.
+		self.leases = {}
+		# Renewed on every progress update, so keep the expiries on a
+		# wheel rather than piling cancelled timers on the heap
+		self.lease_timers = event_loop.Timer_Wheel(1.0,64,
+			self.lease_expired)
+		self.next_corr_id = 1
+		# Most bytes a connection may have waiting to be sent
+		self.output_high_water = OUTPUT_HIGH_WATER
+
+		# Versions are stamped with the start time, so a version from
+		# before a restart never matches one from after it
+		self.epoch = "%x" % int(time.time()*1000)
+		# The devices dict has no version of its own
+		self.devices_version = 0
+		# (collection, encoding) -> (version, Encoded_Data)
+		self.response_cache = {}
+
+		# Load the saved database and record every change from now on
+		self._read_db()
+
+		# Search indexes follow every change to the library.  They are
+		# built at the first search, not here, so start up stays fast.
+		self.search = {
+			"movies":search_index.Search_Index(self.db["movies"]),
+			"tv":search_index.Search_Index(self.db["tv"].episodes)
 			}
+		self.db["movies"].listeners.append(self.search["movies"].update)
+		self.db["tv"].episodes.listeners.append(self.search["tv"].update)
+		self._restore_leases()
+
+		# Point the database gauges at this Command Center
+		QUEUE_LENGTH.func = lambda: {():len(self.db["transcode_queue"])}
+		QUEUE_AGE.func = self._queue_age
+		if metrics_path != None:
+			metrics.Metrics_Server(metrics_path)
 
 		# Start the Websocket Proxy
 		self.start_websocket_proxy()
@@ -353,10 +975,150 @@ class Command_Center(asyncore.dispatcher):
 		sock,addr = self.accept()
 		Update_Handler(sock,self)
 
+	## Read the Database from Disk
+	#
+	# Fills the database with the saved snapshot and journal, then starts
+	# journaling changes.
+	def _read_db(self):
+		# Loading creates a lot of objects at once.  Pause the cyclic
+		# garbage collector, or it keeps rescanning all of them.
+		gc.disable()
+		try:
+			state = persistence.load(persistence.DB_FOLDER)
+			self.db["devices"].update(state["devices"])
+			self.db["movies"].replace([v for k,v in state["movies"]])
+			self.db["tv"].replace(dict(state["tv"]).get("shows",[]))
+			self.db["transcode_queue"].replace(
+				[v for k,v in state["transcode_queue"]])
+			self.db["groups"].update(state["groups"])
+		finally:
+			gc.enable()
+
+		self.journal = persistence.Journal(persistence.DB_FOLDER)
+		# Save the last changes when the process exits
+		atexit.register(self.journal.close)
+		for name in ["movies","tv","transcode_queue"]:
+			self.db[name].listeners.append(self.journal.listener(name))
+
+	## Give Running Jobs back to their Workers
+	#
+	# A worker keeps converting while the Command Center restarts, so a
+	# job that was leased gets a fresh lease for the worker it names.  The
+	# worker's next update renews it.  If the worker is gone too, the
+	# lease runs out and the job is requeued.
+	def _restore_leases(self):
+		for job in self.db["transcode_queue"]:
+			if job.get("worker") != None:
+				self.leases[job["path"]] = Lease(job["path"],job["worker"])
+				self.lease_timers.schedule(job["path"],LEASE_SECONDS)
+
 	# Write the Memory database to disk
 	def _write_db(self):
-		# We will do nothing for now
-		pass	
+		# Changes are written by a background thread, so this does not
+		# block the event loop
+		self.journal.flush()
+
+	## Get the Age of the Oldest Transcode Job
+	def _queue_age(self):
+		job = self.db["transcode_queue"].first()
+		if job == None or "queued" not in job:
+			return {}
+		return {():time.time()-job["queued"]}
+
+	## Lease the Next Transcode Job
+	#
+	# Hands out the first job that is not leased and has not failed too
+	# often
+	#
+	# @param worker - Name of the converter worker
+	# @return - The job, or None if there is nothing to hand out
+	def lease_job(self,worker):
+		queue = self.db["transcode_queue"]
+		for job in queue:
+			attempts = job.get("attempts",0)
+			if job["path"] in self.leases or attempts >= MAX_JOB_ATTEMPTS:
+				continue
+			self.leases[job["path"]] = Lease(job["path"],worker)
+			self.lease_timers.schedule(job["path"],LEASE_SECONDS)
+			job = queue.update(job["path"],{
+				"worker":worker,
+				"attempts":attempts+1,
+				"leased":time.time()
+				})
+			self.publish("transcode_queue",{"action":"lease","item":job})
+			return job
+		return None
+
+	## Renew a Worker's Lease
+	#
+	# @return - True if the worker holds the lease on the job
+	def renew_lease(self,path,worker):
+		lease = self.leases.get(path)
+		if lease == None or lease.worker != worker:
+			return False
+		self.lease_timers.schedule(path,LEASE_SECONDS)
+		return True
+
+	## End the Lease on a Job
+	#
+	# @param worker - Only end it if this worker holds it.  None ends it
+	#		whoever holds it.
+	# @return - True if a lease was ended
+	def end_lease(self,path,worker=None):
+		lease = self.leases.get(path)
+		if lease == None or (worker != None and lease.worker != worker):
+			return False
+		self.lease_timers.cancel(path)
+		del self.leases[path]
+		return True
+
+	## A Worker Stopped Reporting on its Job
+	def lease_expired(self,path):
+		lease = self.leases.pop(path,None)
+		if lease == None:
+			return
+		LEASE_EXPIRIES.inc()
+		print "Lease of %s by %s expired" % (path,lease.worker)
+		self.requeue(path,"Lease Expired")
+
+	## Put a Job back in the Queue
+	#
+	# @param error - Why the last attempt ended
+	def requeue(self,path,error):
+		job = self.db["transcode_queue"].update(path,
+			{"worker":None,"error":error})
+		if job != None:
+			self.publish("transcode_queue",{"action":"requeue","item":job})
+
+	## Get the Version of a Collection
+	#
+	# @param kind - "movies", "tv", or "devices"
+	# @return - A string that changes every time the collection does
+	def version(self,kind):
+		if kind == "devices":
+			count = self.devices_version
+		else:
+			count = self.db[kind].version
+		return "%s.%d" % (self.epoch,count)
+
+	## Get a Collection Encoded for a Response
+	#
+	# @param kind - "movies", "tv", or "devices"
+	# @param encoding - The IPC encoding of the connection
+	# @return - A libcc.Encoded_Data of the whole collection
+	def encoded_data(self,kind,encoding):
+		version = self.version(kind)
+		cached = self.response_cache.get((kind,encoding))
+		if cached != None and cached[0] == version:
+			return cached[1]
+
+		if kind == "devices":
+			data = self.db["devices"]
+		else:
+			data = self.db[kind].to_list()
+		encoded = libcc.encode_data(data,encoding)
+		self.response_cache[(kind,encoding)] = (version,encoded)
+		return encoded
 
 	## Add a WebSocket to the Database
 	#
@@ -370,7 +1132,308 @@ class Command_Center(asyncore.dispatcher):
 	# When a Websocket Proxy is closed, this should be called to remove
 	# it from the command center database
 	def remove_websocket(self,addr):
-		del self.db["websockets"][addr]
+		# A socket can report its close more than once
+		if self.db["websockets"].pop(addr,None) == None:
+			return
+		self.player_states.pop(addr,None)
+		self.player_events.pop(addr,None)
+		# The device can no longer answer
+		for corr_id in list(self.device_commands.get(addr,[])):
+			self.device_reply(corr_id,addr,"Error - Chromecast Disconnected")
+
+	## Create, Change, or Delete a Group
+	#
+	# @param name - Group name
+	# @param members - List of device addresses, or None to delete it.  An
+	#		address listed twice is kept once, in its first place.
+	def set_group(self,name,members):
+		if members == None:
+			self.db["groups"].pop(name,None)
+			group = None
+		else:
+			unique = []
+			for addr in members:
+				if addr not in unique:
+					unique.append(addr)
+			group = self.db["groups"][name] = {
+				"name":name,
+				"members":unique
+				}
+		self.journal.record("groups",name,group)
+
+	## Subscribe a Connection to a Topic
+	def subscribe(self,topic,handler):
+		self.subscribers[topic].add(handler)
+
+	## Unsubscribe a Connection from a Topic
+	def unsubscribe(self,topic,handler):
+		self.subscribers[topic].discard(handler)
+
+	## Publish an Event
+	#
+	# Pushes a change event to every connection subscribed to the topic.
+	#
+	# @param topic - One of TOPICS
+	# @param data - A JSON object describing the change
+	def publish(self,topic,data):
+		event = {
+			"source":"command_center",
+			"message":"event",
+			"topic":topic,
+			"data":data
+			}
+		for handler in self.subscribers[topic]:
+			handler.push_event(event)
+
+	## Forward a Command to a Chromecast
+	#
+	# The command is sent with a "corr_id" field, which the device copies
+	# into its reply.  The reply goes back only to the connection that sent
+	# the command.  If it does not come before the deadline, the connection
+	# gets a timeout error instead.
+	#
+	# @param ws - The device's WS_Handler
+	# @param req - The IPC request
+	# @param handler - The Update_Handler it came from
+	def forward_command(self,ws,req,handler):
+		corr_id = self.next_corr_id
+		self.next_corr_id += 1
+		addr = req["addr"]
+
+		msg = dict(req,corr_id=corr_id)
+		msg.pop("id",None)
+		timeout = req.get("timeout",CHROMECAST_TIMEOUT)
+		timer = event_loop.call_later(timeout,self.command_timeout,corr_id)
+		self.pending_commands[corr_id] = Pending_Command(corr_id,addr,
+				req,handler,timer)
+		self._track(corr_id,addr)
+		ws.send_msg(msg)
+
+	## Forward a Command to every Chromecast in a Group
+	#
+	# Members with no WebSocket fail right away, and a "status" is answered
+	# from a member's recent player state where there is one.  The rest get
+	# the same message, with one "corr_id", encoded once and written to
+	# all of them together.  The response lists every member's reply in
+	# its "data" field, once all have answered or at the group's deadline.
+	#
+	# @param group - The group, from db["groups"]
+	# @param req - The IPC request
+	# @param handler - The Update_Handler it came from
+	def forward_group(self,group,req,handler):
+		corr_id = self.next_corr_id
+		self.next_corr_id += 1
+
+		msg = dict(req,corr_id=corr_id)
+		msg.pop("id",None)
+		timeout = req.get("timeout",CHROMECAST_TIMEOUT)
+		timer = event_loop.call_later(timeout,self.command_timeout,corr_id)
+		pending = Pending_Group(corr_id,group["name"],req,handler,timer)
+		self.pending_commands[corr_id] = pending
+
+		handlers = []
+		for addr in group["members"]:
+			# Groups saved before members were deduplicated
+			if addr in pending.results or addr in pending.addrs:
+				continue
+			ws = self.db["websockets"].get(addr)
+			state = None
+			if req["cmd"] == "status":
+				state = self.player_state(addr,
+					req.get("max_age",STATUS_MAX_AGE))
+			if ws == None:
+				pending.results[addr] = "App has not been launched yet"
+			elif state != None:
+				pending.results[addr] = state
+			else:
+				pending.addrs.append(addr)
+				pending.waiting += 1
+				handlers.append(ws)
+				self._track(corr_id,addr)
+
+		if len(handlers) == 0:
+			self.finish_group(pending)
+			return
+		# Register everything first.  A write that fails removes its
+		# device, which answers for that member.
+		GROUP_SKEW_SECONDS.observe(ws_proxy.broadcast(handlers,msg))
+
+	## Remember which Device owes an Answer
+	def _track(self,corr_id,addr):
+		self.device_commands.setdefault(addr,collections.deque()).append(
+				corr_id)
+
+	## Forget that a Device owes an Answer
+	def _untrack(self,corr_id,addr):
+		queue = self.device_commands.get(addr)
+		if queue != None and corr_id in queue:
+			queue.remove(corr_id)
+			if len(queue) == 0:
+				del self.device_commands[addr]
+
+	## Handle a Device's Answer to a Forwarded Command
+	#
+	# @param corr_id - Correlation ID of the command
+	# @param addr - The device that answered
+	# @param message - Its reply, or an error
+	# @return - The Pending_Command, or None if it already finished
+	def device_reply(self,corr_id,addr,message):
+		pending = self.pending_commands.get(corr_id)
+		if pending == None:
+			return None
+		if not isinstance(pending,Pending_Group):
+			return self.finish_command(corr_id,message)
+		if addr in pending.results:
+			return pending
+		pending.results[addr] = message
+		pending.waiting -= 1
+		self._untrack(corr_id,addr)
+		if pending.waiting == 0:
+			self.finish_group(pending)
+		return pending
+
+	## Send the Response of a Group Command
+	#
+	# Members that have not answered are given a timeout error
+	def finish_group(self,pending):
+		for addr in pending.addrs:
+			if addr not in pending.results:
+				pending.results[addr] = "Error - Chromecast Timeout"
+				CHROMECAST_TIMEOUTS.inc(1,pending.req["cmd"])
+		# Device replies are objects.  A string is the Command Center's
+		# own error for that member.
+		failed = len([r for r in pending.results.values()
+			if isinstance(r,basestring)])
+		message = "OK"
+		if failed > 0:
+			message = "Error - %d of %d Chromecasts Failed" % (failed,
+				len(pending.results))
+		self.finish_command(pending.corr_id,message,pending.results)
+
+	## Finish a Forwarded Command
+	#
+	# @param corr_id - Correlation ID of the command
+	# @param message - The "message" of the response to send
+	# @param data - Optional "data" of the response
+	# @return - The Pending_Command, or None if it already finished
+	def finish_command(self,corr_id,message,data=None):
+		pending = self.pending_commands.pop(corr_id,None)
+		if pending == None:
+			return None
+		pending.timer.cancel()
+		for addr in pending.addrs:
+			self._untrack(corr_id,addr)
+
+		resp = {
+			"source":"command_center",
+			"message":message
+			}
+		if data != None:
+			resp["data"] = data
+		if "id" in pending.req:
+			resp["id"] = pending.req["id"]
+		pending.handler.send_packet(resp)
+		return pending
+
+	## A Chromecast did not Answer in Time
+	def command_timeout(self,corr_id):
+		pending = self.pending_commands.get(corr_id)
+		if isinstance(pending,Pending_Group):
+			self.finish_group(pending)
+			return
+		pending = self.finish_command(corr_id,"Error - Chromecast Timeout")
+		if pending != None:
+			CHROMECAST_TIMEOUTS.inc(1,pending.req["cmd"])
+
+	## Drop the Commands of a Closed Connection
+	def cancel_commands(self,handler):
+		for corr_id,pending in self.pending_commands.items():
+			if pending.handler is handler:
+				pending.timer.cancel()
+				del self.pending_commands[corr_id]
+				for addr in pending.addrs:
+					self._untrack(corr_id,addr)
+
+	## Forward a WebSocket Message
+	#
+	# The WebSocket proxy calls this for every message a Chromecast sends.
+	# The message goes to subscribers of the "player" topic.  A reply to a
+	# forwarded command also goes to the connection that sent it.  Replies
+	# are matched by "corr_id".  For devices that do not send it back, a
+	# status update answers the oldest pending command if that is a
+	# "status" command.  Nothing else is taken as a reply, so a status
+	# pushed by the device never finishes a load or skip.  Status updates
+	# and replies to "status" become the device's last known player state.
+	#
+	# @return - True if the message was delivered as a reply
+	def websocket_message(self,addr,msg):
+		status = ws_proxy.is_status(msg)
+		if status:
+			self.player_states[addr] = (time.time(),msg)
+			self.publish_status(addr,msg)
+		else:
+			self.publish("player",{"addr":addr,"message":msg})
+
+		corr_id = None
+		if isinstance(msg,dict) and "corr_id" in msg:
+			corr_id = msg.pop("corr_id")
+		elif status and addr in self.device_commands:
+			oldest = self.device_commands[addr][0]
+			pending = self.pending_commands.get(oldest)
+			if pending != None and pending.req["cmd"] == "status":
+				corr_id = oldest
+		if corr_id not in self.pending_commands:
+			return False
+
+		pending = self.device_reply(corr_id,addr,msg)
+		CHROMECAST_SECONDS.observe(time.time()-pending.start,
+				pending.req["cmd"])
+		if pending.req["cmd"] == "status":
+			self.player_states[addr] = (time.time(),msg)
+		return True
+
+	## Publish a Device's Status Update
+	#
+	# Devices that report their progress often would flood subscribers,
+	# so updates are coalesced over PLAYER_EVENT_INTERVAL, newest wins.
+	#
+	# @param addr - Device address
+	# @param msg - The status update
+	def publish_status(self,addr,msg):
+		if addr in self.player_events:
+			if self.player_events[addr] != None:
+				PLAYER_COALESCED.inc()
+			self.player_events[addr] = msg
+			return
+		self.publish("player",{"addr":addr,"message":msg})
+		self.player_events[addr] = None
+		event_loop.call_later(PLAYER_EVENT_INTERVAL,
+			self.publish_held_status,addr)
+
+	## Publish the Status Update Held for a Device
+	#
+	# Called at the end of the device's PLAYER_EVENT_INTERVAL
+	#
+	# @param addr - Device address
+	def publish_held_status(self,addr):
+		msg = self.player_events.pop(addr,None)
+		if msg != None:
+			self.publish_status(addr,msg)
+
+	## Get a Device's Last Known Player State
+	#
+	# @param addr - Device address
+	# @param max_age - Oldest state, in seconds, worth returning
+	# @return - The state, with "cached" and its "age" in seconds added, or
+	#		None if there is none that recent
+	def player_state(self,addr,max_age=STATUS_MAX_AGE):
+		if addr not in self.player_states:
+			return None
+		when,state = self.player_states[addr]
+		age = time.time()-when
+		if age > max_age or not isinstance(state,dict):
+			return None
+		return dict(state,cached=True,age=age)
 
 	## Starts the WebSocket Proxy Server
 	def start_websocket_proxy(self):
@@ -380,32 +1443,117 @@ class Command_Center(asyncore.dispatcher):
 		ws_proxy.WS_Server(self)
 	
 
+## Get a Metric Label for a Client Value
+#
+# @param value - A source or command name from a request
+# @param known - The values that get their own series
+# @return - The value, or "other"
+def metric_label(value,known):
+	if isinstance(value,basestring) and value in known:
+		return unicode(value)
+	return u"other"
+
+## Encode a Page Cursor
+#
+# @param last - (sort value, ID) of the last item on the page
+# @param sort - The "sort" field of the request
+# @param epoch - The Command Center's epoch
+# @return - An opaque string
+def encode_cursor(last,sort,epoch):
+	data = json.dumps({"sort":sort,"after":list(last),"epoch":epoch})
+	return base64.urlsafe_b64encode(data)
+
+## Decode a Page Cursor
+#
+# @param cursor - A string made by encode_cursor
+# @param sort - The "sort" field of the request.  It must match the cursor.
+# @param epoch - The Command Center's epoch.  Item IDs are only good until
+#		a restart, so a cursor from before one is not valid.
+# @return - (sort value, ID), or None if the cursor is not valid
+def decode_cursor(cursor,sort,epoch):
+	try:
+		data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+		value,item_id = data["after"]
+	except (TypeError,ValueError,KeyError):
+		return None
+	if data.get("sort") != sort or data.get("epoch") != epoch:
+		return None
+	return (value,item_id)
+
+
 # Start the Command center when this script is run indepen
+## Watchdog
+#
+# Restarts stopped daemons and flushes the database journal
+#
+# @param cc - The Command Center
+# @param ps - The process list from libcc.get_process_list
+def watchdog(cc,ps):
+	# Check processes and write to db
+	libcc.check_processes(ps)
+	cc._write_db()
+
+	# Print DB stats
+	print "Current DB stats:"
+	for key in cc.db:
+		print "\t"+key+": "+str(len(cc.db[key]))
+
+
 if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description="Chromecast Server Hub")
+	parser.add_argument("--socket",default=libcc.UNIX_SOCKET_PATH,
+		help="Unix socket to listen for IPC on")
+	parser.add_argument("--db-folder",default=persistence.DB_FOLDER,
+		help="Folder to keep the database in")
+	parser.add_argument("--ws-port",type=int,
+		default=ws_proxy.CHROMECAST_IP_PORT[1],
+		help="TCP port for Chromecast WebSockets (0 for any free port)")
+	parser.add_argument("--metrics",default=libcc.METRICS_SOCKET_PATH,
+		help="Unix socket for Prometheus metrics (\"none\" to disable)")
+	parser.add_argument("--output-limit",type=int,
+		default=OUTPUT_HIGH_WATER/(1024*1024),metavar="MB",
+		help="Most output a slow connection may have queued")
+	parser.add_argument("--ws-ping-interval",type=float,
+		default=ws_proxy.PING_INTERVAL,metavar="SECONDS",
+		help="Ping Chromecasts that are quiet this long (0 to disable)")
+	parser.add_argument("--ws-window-bits",type=int,
+		default=ws_proxy.DEFLATE_WINDOW_BITS,choices=[0]+range(9,16),
+		help="Window bits for WebSocket compression (0 to disable)")
+	parser.add_argument("--ws-compress-threshold",type=int,
+		default=ws_proxy.DEFLATE_THRESHOLD,metavar="BYTES",
+		help="Smallest WebSocket message worth compressing")
+	parser.add_argument("--ws-no-context-takeover",action="store_true",
+		help="Compress every WebSocket message on its own")
+	parser.add_argument("--no-daemons",action="store_true",
+		help="Do not start the scanner, discoverer, and converter")
+	args = parser.parse_args()
+
+	libcc.UNIX_SOCKET_PATH = args.socket
+	persistence.DB_FOLDER = args.db_folder
+	ws_proxy.CHROMECAST_IP_PORT = (ws_proxy.CHROMECAST_IP_PORT[0],
+			args.ws_port)
+	ws_proxy.PING_INTERVAL = args.ws_ping_interval
+	ws_proxy.DEFLATE_WINDOW_BITS = args.ws_window_bits
+	ws_proxy.DEFLATE_THRESHOLD = args.ws_compress_threshold
+	ws_proxy.DEFLATE_CONTEXT_TAKEOVER = not args.ws_no_context_takeover
+	if args.metrics == "none":
+		args.metrics = None
+
 	# Create a Command Center Object
-	cc = Command_Center()
+	cc = Command_Center(args.metrics)
+	cc.output_high_water = args.output_limit*1024*1024
 
 	# Initialize the list of processes
-	ps = libcc.get_process_list()
+	if args.no_daemons:
+		ps = []
+	else:
+		ps = libcc.get_process_list()
 	
-	# Server Forever
-	watchdog_length = 10
-	watchdog_time = time.time() + watchdog_length 
-	while(1):
-		# Timeout after at most 10 seconds
-		asyncore.loop(timeout=1,count=10)
-		# Verify that the timeout is at least 10 seconds
-		if time.time() > watchdog_time:
-			# Update the watchdog
-			watchdog_time = time.time()+watchdog_length
-			# Check processes and write to db
-			libcc.check_processes(ps)
-			cc._write_db()
-
-			# Print DB stats
-			print "Current DB stats:"
-			for key in cc.db:
-				print "\t"+key+": "+str(len(cc.db[key]))
-
-
+	# Exit cleanly when terminated, so the journal is flushed
+	signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
 
+	# Serve Forever.  The loop sleeps until a socket is ready or the
+	# watchdog is due.
+	event_loop.call_every(WATCHDOG_INTERVAL,watchdog,cc,ps)
+	event_loop.run()
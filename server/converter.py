@@ -1,8 +1,16 @@
 #!/usr/bin/env python
 
 import libcommand_center as libcc
+import profiler
+import multiprocessing
 import hashlib
 import subprocess
+import Queue
+import shutil
+import signal
+import socket
+import sys
+import os
 import re
 import time
 
@@ -13,6 +21,45 @@ import time
 
 HTTP_SERVER_MEDIA_FOLDER = "/mnt/raid/www/media"
 
+# Encoder and prober to run.  Setting these in the environment swaps in
+# other builds, or stubs for testing.
+AVCONV = os.environ.get("CONVERTER_AVCONV","avconv")
+AVPROBE = os.environ.get("CONVERTER_AVPROBE","avprobe")
+
+# Threads each encoder may use.  The number of workers defaults to the number
+# of cores divided by this, so the workers together keep every core busy
+# without fighting over them.
+THREADS_PER_JOB = 4
+
+# Full transcodes are split at keyframes into segments of about this many
+# seconds, which are encoded at once and joined.  0 transcodes in one piece.
+SEGMENT_SECONDS = 0
+
+# Segments of one job encoded at once.  None uses job_cores().
+SEGMENT_PROCESSES = None
+
+# Workers running jobs at once.  Each job's segments share its part of the
+# cores.
+WORKERS = 1
+
+# Seconds between progress updates, which also renew the job's lease
+PROGRESS_INTERVAL = 10
+
+# Seconds an idle worker waits before asking for a job again
+POLL_INTERVAL = 10
+
+# Seconds between checks that every worker is still running
+SUPERVISE_INTERVAL = 5
+
+# Name this process leases jobs under.  Each worker sets its own.
+worker_name = None
+
+# The encoder this worker is running, so it can be stopped with the worker
+current_process = None
+
+# Where a segment process sends (segment, seconds encoded)
+progress_queue = None
+
 
 ## Convert to a Chromecast Friendly format
 #
@@ -20,7 +67,7 @@ HTTP_SERVER_MEDIA_FOLDER = "/mnt/raid/www/media"
 # not, it converts them and put a copy in the video server folder
 #
 # @param infile - A path to the input file (video being converted)
-# @return - None
+# @return - True if the conversion worked
 def convert(infile):
 
 	# Create a Hash of the inFile path and use that as the filename for
@@ -29,7 +76,7 @@ def convert(infile):
 	outfile = "%s/%s.mp4" % (HTTP_SERVER_MEDIA_FOLDER,name)
 
 	# CHeck codecs and packaging
-	p = subprocess.Popen(["avconv","-i",infile],stderr=subprocess.PIPE)
+	p = subprocess.Popen([AVCONV,"-i",infile],stderr=subprocess.PIPE)
 	vid_info = p.stderr.read()
 
 	print "Input Path: "+infile
@@ -58,16 +105,24 @@ def convert(infile):
 	if vc == "h264":
 		if ac == "aac":
 			if cont in ["mov","mp4"]:
-				link(infile,outfile)
+				ret_code = link(infile,outfile)
 			else:
-				repackage(infile,outfile,duration)
+				ret_code = repackage(infile,outfile,duration)
 		else:
-			audio_repackage(infile,outfile,duration)
+			ret_code = audio_repackage(infile,outfile,duration)
+	elif SEGMENT_SECONDS > 0 and duration >= 2*SEGMENT_SECONDS:
+		ret_code = segmented_repackage(infile,outfile,duration)
 	else:
-		video_audio_repackage(infile,outfile,duration)
+		ret_code = video_audio_repackage(infile,outfile,duration)
+
+	# If the conversion failed (or the job was taken away), give the job
+	# back so it can be tried again
+	if ret_code != 0:
+		release(infile,"Conversion failed: %r" % ret_code)
+		return False
+
 	# When the convertion is complete, tell the command center to remove
 	# this item from the queue
-
 	req = {
 		"cmd":"complete",
 		"path":infile,
@@ -75,6 +130,19 @@ def convert(infile):
 		}
 
 	cc_communicate(req)
+	return True
+
+## Give a Job Back to the Queue
+#
+# @param path - The job's input file
+# @param error - Why it was given back
+def release(path,error):
+	req = {
+		"cmd":"release",
+		"path":path,
+		"error":error
+		}
+	cc_communicate(req)
 
 
 ## Link file to Video Server
@@ -105,7 +173,7 @@ def repackage(infile,outfile,duration):
 	
 	print "Repackaging File"
 
-	ret_code = run_with_progress(["avconv",
+	ret_code = run_with_progress([AVCONV,
 			"-y", # Overwrite Output File
 			"-i",infile, # Specify Input File
 			"-c:a","copy", # Set Audio/Video codecs to Copy
@@ -126,12 +194,13 @@ def repackage(infile,outfile,duration):
 def audio_repackage(infile,outfile,duration):
 	print "Convering Audio and Repackaging"
 
-	ret_code = run_with_progress(	["avconv",
+	ret_code = run_with_progress(	[AVCONV,
 				"-y", # Overvite output File
 				"-i",infile, # Specify Infile
 				"-c:a",	"libfdk_aac", # Sepecify Audio Codec
 				"-vbr","3", # Specify Audio Quality
 				"-c:v","copy", # Copy Video Stream
+				"-threads",str(THREADS_PER_JOB),
 				outfile], # Specify Output File
 				duration) # Specify Duration
 	return ret_code
@@ -147,54 +216,286 @@ def audio_repackage(infile,outfile,duration):
 def video_audio_repackage(infile,outfile,duration):
 	print "Convering Audio/Video and Repackaging"
 
-	ret_code = run_with_progress(	["avconv",
+	ret_code = run_with_progress(	[AVCONV,
 				"-y",	# Overwrite Output File
-				"-i",infile, # Specify Input File
-				"-c:a",	"libfdk_aac", # AAC Audio Codec
-				"-vbr","3", # Set Audio Quality to 3
-				"-c:v","libx264", # h264 Video codec
-				"-cbr","23", # Set Video Quality to 23
-				outfile], # Specify Output File
+				"-i",infile]+ # Specify Input File
+				video_audio_codecs()+
+				[outfile], # Specify Output File
 				duration) # Specify Duration
 	print ret_code
 
 	return ret_code
 
+## Get the Codec Arguments of a Full Transcode
+#
+# @param threads - Threads the encoder may use, or None for THREADS_PER_JOB
+def video_audio_codecs(threads=None):
+	if threads == None:
+		threads = THREADS_PER_JOB
+	return ["-c:a",	"libfdk_aac", # AAC Audio Codec
+		"-vbr","3", # Set Audio Quality to 3
+		"-c:v","libx264", # h264 Video codec
+		"-cbr","23", # Set Video Quality to 23
+		"-threads",str(threads)]
+
+#----------------
+# Segmented Transcoding
+#
+# A long title is split at keyframes into segments, the segments are
+# transcoded by a pool of processes at once, and then joined without
+# re-encoding by the concat demuxer.
+#----------------
+
+## Transcode Audio and Video in Segments
+#
+# Like video_audio_repackage, but the segments are encoded at once.  Falls
+# back to one piece if the input has too few keyframes to split.
+#
+# @param infile - Input file being transcoded
+# @param outfile - Ouput file path and name
+# @param duration - Duration of Input Video File (used for Percent Calculation)
+# @return return code of the convertion, or None if it was stopped
+def segmented_repackage(infile,outfile,duration):
+	segments = split_segments(probe_keyframes(infile),duration,
+		SEGMENT_SECONDS)
+	if len(segments) < 2:
+		return video_audio_repackage(infile,outfile,duration)
+	print "Convering Audio/Video in %d Segments" % len(segments)
+
+	# Next to the output, so the join does not cross filesystems
+	folder = outfile+".parts"
+	if not os.path.isdir(folder):
+		os.makedirs(folder)
+	try:
+		ret_code = transcode_segments(infile,folder,segments,duration)
+		if ret_code == 0:
+			ret_code = concat_segments(infile,folder,len(segments),
+				outfile)
+	finally:
+		shutil.rmtree(folder,True)
+	print ret_code
+	return ret_code
+
+## Find the Keyframes of a Video
+#
+# @param infile - The video
+# @return - Sorted keyframe times of the first video stream, in seconds
+def probe_keyframes(infile):
+	p = subprocess.Popen([AVPROBE,"-show_packets","-select_streams","v:0",
+		infile],stdout=subprocess.PIPE,stderr=open(os.devnull,"w"))
+	keyframes = []
+	fields = {}
+	# Packets are printed as [PACKET] key=value ... [/PACKET] blocks
+	for line in p.stdout:
+		line = line.strip()
+		if line == "[/PACKET]":
+			if fields.get("codec_type","video") == "video" and \
+					"K" in fields.get("flags",""):
+				try:
+					keyframes.append(float(fields["pts_time"]))
+				except (KeyError,ValueError):
+					# No timestamp ("N/A")
+					pass
+			fields = {}
+		elif "=" in line:
+			key,value = line.split("=",1)
+			fields[key] = value
+	p.wait()
+	keyframes.sort()
+	return keyframes
+
+## Split a Video at Keyframes
+#
+# Each segment starts on a keyframe (or at 0) at least segment_seconds
+# after the last one.  A last segment shorter than half that is left
+# joined to the one before it.
+#
+# @param keyframes - Sorted keyframe times, in seconds
+# @param duration - Length of the video, in seconds
+# @param segment_seconds - Shortest segment
+# @return - A list of (start, end) times
+def split_segments(keyframes,duration,segment_seconds):
+	starts = [0.0]
+	for t in keyframes:
+		if t-starts[-1] >= segment_seconds and \
+				duration-t >= segment_seconds/2.0:
+			starts.append(t)
+	ends = starts[1:]+[duration]
+	return zip(starts,ends)
+
+## Get the Path of a Segment
+def segment_path(folder,index):
+	return os.path.join(folder,"segment-%05d.mp4" % index)
+
+## Transcode every Segment
+#
+# Runs the segments on a process pool and reports their combined progress.
+# Each update renews the lease, and a lost lease stops every segment.  The
+# segments split the job's cores between them, so the other workers' jobs
+# keep theirs.
+#
+# @return - 0, the first failed segment's return code, or None if stopped
+def transcode_segments(infile,folder,segments,duration):
+	processes = SEGMENT_PROCESSES
+	if processes == None:
+		processes = job_cores()
+	threads = max(1,job_cores()/processes)
+	queue = multiprocessing.Queue()
+	pool = multiprocessing.Pool(processes,segment_init,(queue,))
+	try:
+		tasks = [(i,infile,start,end-start,segment_path(folder,i),threads)
+			for i,(start,end) in enumerate(segments)]
+		results = pool.map_async(transcode_segment,tasks,1)
+
+		# Seconds encoded of each segment
+		done = [0.0]*len(segments)
+		start_time = time.time()
+		last_update = start_time
+		while not results.ready():
+			try:
+				i,t = queue.get(True,0.5)
+				done[i] = min(t,segments[i][1]-segments[i][0])
+			except Queue.Empty:
+				pass
+			if time.time()-last_update >= PROGRESS_INTERVAL:
+				last_update = time.time()
+				if not report_progress(infile,sum(done),duration,
+						start_time):
+					return None
+		for ret_code in results.get():
+			if ret_code != 0:
+				return ret_code
+		return 0
+	finally:
+		# Stops any segment still running
+		pool.terminate()
+		pool.join()
+
+## Set up a Segment Process
+#
+# @param queue - Where to send progress
+def segment_init(queue):
+	global progress_queue
+	progress_queue = queue
+	signal.signal(signal.SIGTERM,stop_on_signal)
+
+## Transcode one Segment
+#
+# Runs in a segment process
+#
+# @param task - (index, infile, start, length, segment path, threads)
+# @return - The encoder's return code
+def transcode_segment(task):
+	global current_process
+	index,infile,start,length,path,threads = task
+	# Seeking before the input starts decoding at the keyframe
+	p = subprocess.Popen([AVCONV,
+		"-y", # Overwrite Output File
+		"-ss","%.3f" % start, # Start of the Segment
+		"-i",infile, # Specify Input File
+		"-t","%.3f" % length]+ # Length of the Segment
+		video_audio_codecs(threads)+
+		[path],stderr=subprocess.PIPE)
+	current_process = p
+	fd = p.stderr.fileno()
+	while(1):
+		out = os.read(fd,4096)
+		if out == "":
+			break
+		times = re.findall("time=\s*([\.\d]+)",out)
+		if len(times) > 0:
+			progress_queue.put((index,float(times[-1])))
+	current_process = None
+	return p.wait()
+
+## Join the Segments
+#
+# Copies the streams of every segment, in order, into the output
+#
+# @return - The return code of the join, or None if it was stopped
+def concat_segments(infile,folder,count,outfile):
+	global current_process
+	listfile = os.path.join(folder,"segments.txt")
+	with open(listfile,"w") as f:
+		for i in range(count):
+			f.write("file '%s'\n" % os.path.basename(
+				segment_path(folder,i)))
+	p = subprocess.Popen([AVCONV,
+		"-y", # Overwrite Output File
+		"-f","concat", # Read the List of Segments
+		"-i",listfile,
+		"-c","copy", # Copy the Streams
+		"-movflags","+faststart", # Index first, so casting can start
+		outfile],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+	current_process = p
+	start_time = time.time()
+	# Keep the lease while the segments are joined
+	while(p.poll() == None):
+		timed_read(p,PROGRESS_INTERVAL)
+		if p.poll() == None and not report_progress(infile,None,None,
+				start_time):
+			stop_process(p)
+			current_process = None
+			return None
+	current_process = None
+	return p.poll()
+
 ## Runs a command and gets progress.
 #
 # Runs the command given in the cmd list.  Every 10 seconds, it parses the 
-# STDOUT and figure out how much time is left.
+# STDOUT and figure out how much time is left.  Each update also renews the
+# worker's lease on the job.  If the lease has been lost, the conversion is
+# stopped.
 #
 # @param cmd - A list of command line program and arguments
-# @return return code of the convertion process
+# @return return code of the convertion process, or None if it was stopped
 def run_with_progress(cmd,duration):
+	global current_process
 	# Start the process
 	p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+	current_process = p
 	# Record when the process started
 	start_time = time.time()
 	# Continue this loop until the process is complete.
 	while(p.poll() == None):
 		# Read the STDERR for 10 seconds
-		out = timed_read(p,10)
-		# Create a progress object
-		req = {"cmd":"update"}
-		req["path"] = cmd[3]
-		# Use RE to parse frames and time
+		out = timed_read(p,PROGRESS_INTERVAL)
+		# Use RE to parse frames and time.  Without them, the update
+		# still renews the lease.
+		t = None
 		m = re.search("time=\s*([\.\d]*)",out)
 		if (m):	
 			t = float(m.group(1))	
-			req["time"] = t
-			req["percent"] = t/duration*100
-			req["conversion_time"] = int(time.time()-start_time)  
-		else:
-			# If you cant read the input
-			continue
-		# Send progress to Command Center, discard the response
-		cc_communicate(req)
+		# Send progress to Command Center
+		if not report_progress(cmd[3],t,duration,start_time):
+			stop_process(p)
+			current_process = None
+			return None
+	current_process = None
 	print "Process done: "+repr(p.poll())
 	# Return the REturn Code
 	return p.poll() 
 
+## Send Progress to the Command Center
+#
+# @param path - The job's input file
+# @param t - Seconds of video converted, or None to only renew the lease
+# @param duration - Duration of the video
+# @param start_time - When the conversion started
+# @return - False if the worker has lost its lease on the job
+def report_progress(path,t,duration,start_time):
+	req = {"cmd":"update"}
+	req["path"] = path
+	if t != None:
+		req["time"] = t
+		req["percent"] = t/duration*100
+		req["conversion_time"] = int(time.time()-start_time)  
+	resp = cc_communicate(req)
+	if resp.get("message") == "Error - Job Not Leased":
+		print "Lost the lease on "+path
+		return False
+	return True
+
 
 ## Timed File Read
 #
@@ -233,25 +534,156 @@ def check_queue():
 
 	return resp
 
+## Kill an Encoder
+#
+# @param p - The Popen object, which may have exited already
+def stop_process(p):
+	try:
+		p.kill()
+	except OSError:
+		pass
+	p.wait()
+
+## Send a Request to the Command Center
+#
+# Requests are tagged with the worker's name, which its job leases are
+# held under
 def cc_communicate(req):
 	req["source"] = "converter"
-	print req
-	# resp = libcc.send_recv(req)
-	#return resp
+	if worker_name != None:
+		req["worker"] = worker_name
+	return libcc.send_recv(req)
 
 
+## Convert Jobs until Stopped
 def loop_forever():
 	while(1):
 		# Ask if there are any jobs
 		resp = check_queue()
 
-		# If so, convert them
-		if "infile" in resp:
-			convert(resp["infile"])
+		# If so, convert them and ask for the next one right away
+		if "path" in resp:
+			try:
+				convert(resp["path"])
+			except Exception as e:
+				# Bad probe output, missing encoder, and so on
+				print "Converting %s failed: %r" % (resp["path"],e)
+				release(resp["path"],repr(e))
+			continue
 
 		# Wait 10 seconds before queueing the queu again
-		time.sleep(10)
+		libcc.sleep(POLL_INTERVAL)
+
+#----------------
+# Worker Pool
+#----------------
+
+## Pick the Number of Workers
+#
+# @param threads_per_job - Threads each encoder uses
+# @return - Cores divided by threads per job, at least 1
+def default_workers(threads_per_job=THREADS_PER_JOB):
+	return max(1,multiprocessing.cpu_count()/threads_per_job)
+
+## Get the Cores one Job may Use
+#
+# @return - Cores divided by the number of workers, at least 1
+def job_cores():
+	return max(1,multiprocessing.cpu_count()/WORKERS)
+
+## Stop a Worker or Segment Process, and its Encoder
+def stop_on_signal(signum,frame):
+	if current_process != None:
+		stop_process(current_process)
+	sys.exit(0)
+
+## Run one Worker
+#
+# The body of a worker process.  A stopped worker stops its encoder too.
+#
+# @param index - The worker's number
+def worker_main(index):
+	global worker_name
+	worker_name = "%s:%d" % (socket.gethostname(),os.getpid())
+	# Never share the supervisor's connection, if it had one
+	libcc.clients.clear()
+	signal.signal(signal.SIGTERM,stop_on_signal)
+	# Profiled along with the supervisor, into its own dump file
+	profiler.sampler.stop()
+	profiler.install_signal_handlers()
+	print "Worker %d started as %s" % (index,worker_name)
+	loop_forever()
+
+## Converter Supervisor
+#
+# Runs a pool of worker processes and restarts any that exit.  Each worker
+# leases its own jobs from the Command Center, so a crashed worker's job is
+# handed out again once its lease runs out.
+class Supervisor(object):
+	## Constructor
+	#
+	# @param count - Number of workers
+	def __init__(self,count):
+		self.workers = [None]*count
+
+	## Start the Worker in a Slot
+	def start_worker(self,index):
+		p = multiprocessing.Process(target=worker_main,args=(index,),
+			name="converter-%d" % index)
+		p.start()
+		self.workers[index] = p
+
+	## Run the Workers until Stopped
+	def run(self):
+		# Let the Command Center turn on the profiler.  The Command
+		# Center signals the workers itself.
+		profiler.install_signal_handlers()
+		for i in range(len(self.workers)):
+			self.start_worker(i)
+		while(1):
+			libcc.sleep(SUPERVISE_INTERVAL)
+			for i,p in enumerate(self.workers):
+				if not p.is_alive():
+					print "Worker %d exited with %r, restarting" % (i,
+						p.exitcode)
+					p.join()
+					self.start_worker(i)
+
+	## Stop every Worker
+	def stop(self):
+		for p in self.workers:
+			if p != None and p.is_alive():
+				p.terminate()
+		for p in self.workers:
+			if p != None:
+				p.join()
 		
 
 if __name__ == "__main__":
-	loop_forever()
+	import argparse
+	parser = argparse.ArgumentParser(description="Transcode queued videos")
+	parser.add_argument("-t","--threads-per-job",type=int,
+		default=THREADS_PER_JOB,help="Threads each encoder may use")
+	parser.add_argument("-w","--workers",type=int,
+		help="Jobs to run at once (default: cores / threads per job)")
+	parser.add_argument("-s","--segment-seconds",type=float,
+		default=SEGMENT_SECONDS,
+		help="Transcode long titles in segments of about this length")
+	parser.add_argument("-p","--segment-processes",type=int,
+		help="Segments of a job to encode at once (default: cores / workers)")
+	args = parser.parse_args()
+	THREADS_PER_JOB = args.threads_per_job
+	SEGMENT_SECONDS = args.segment_seconds
+	SEGMENT_PROCESSES = args.segment_processes
+	if args.workers == None:
+		args.workers = default_workers(THREADS_PER_JOB)
+	WORKERS = args.workers
+
+	supervisor = Supervisor(args.workers)
+	# Stop the workers, and their encoders, along with the supervisor
+	def stop(signum,frame):
+		supervisor.stop()
+		sys.exit(0)
+	signal.signal(signal.SIGTERM,stop)
+	signal.signal(signal.SIGINT,stop)
+	supervisor.run()
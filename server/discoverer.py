@@ -9,26 +9,32 @@
 
 import dial.discover
 import libcommand_center as libcc
+import profiler
 import time
 
 def loop_forever():
 	while(1):
 		# Create a message to send to the Command Center
+		start = time.time()
 		msg = {}
 		msg["source"] = "discoverer"
 		msg["devices"]= dial.discover.discover_devices()
+		# Report how long the search took
+		msg["cycle_seconds"] = time.time()-start
 
 		# Send message to devices
 		resp = libcc.send_recv(msg)
 
 		if resp["message"] == "OK":
 			# If everything went well, sleep for an hour
-			time.sleep(60*60)
+			libcc.sleep(60*60)
 		else:
 			# If there was an error, try again in 10
-			time.sleep(10)
+			libcc.sleep(10)
 
 
 if __name__ == "__main__":
+	# Let the Command Center turn on the profiler
+	profiler.install_signal_handlers()
 	loop_forever()
 
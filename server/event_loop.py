@@ -0,0 +1,229 @@
+#------------------
+# Event Loop
+#
+# Runs the asyncore sockets and a heap of timers on one thread.  The loop
+# sleeps in poll() until a socket is ready or the next timer is due, so an
+# idle Command Center does not wake up at all between timers.
+#-------------------
+
+import asyncore
+import select
+import errno
+import heapq
+import math
+import time
+import metrics
+
+#-----------------
+# Constants
+#-----------------
+
+# Longest time to sleep in poll() when no timer is pending.  None sleeps
+# until a socket is ready.
+IDLE_TIMEOUT = None
+
+# How late timers run.  This grows when a handler blocks the loop.
+LOOP_LAG = metrics.REGISTRY.histogram("cc_event_loop_lag_seconds",
+	"Delay between a timer being due and it running")
+# Time spent handling the sockets that were ready in one pass
+LOOP_BUSY = metrics.REGISTRY.histogram("cc_event_loop_busy_seconds",
+	"Time spent handling ready sockets in one loop pass")
+
+
+## Scheduled Call
+#
+# Returned by call_later() so the call can be cancelled
+class Timer(object):
+	def __init__(self,when,func,args):
+		self.when = when
+		self.func = func
+		self.args = args
+		self.cancelled = False
+
+	## Stop the Call from Happening
+	def cancel(self):
+		self.cancelled = True
+
+	def __lt__(self,other):
+		return self.when < other.when
+
+
+# Heap of pending Timers, soonest first
+_timers = []
+
+
+## Call a Function Later
+#
+# @param delay - Seconds to wait
+# @param func - Function to call
+# @param args - Arguments to call it with
+# @return - A Timer that can be cancelled
+def call_later(delay,func,*args):
+	timer = Timer(time.time()+delay,func,args)
+	heapq.heappush(_timers,timer)
+	return timer
+
+## Call a Function every few Seconds
+#
+# @param interval - Seconds between calls
+# @param func - Function to call
+# @param args - Arguments to call it with
+# @return - The Timer of the next call.  Cancelling it stops the calls.
+def call_every(interval,func,*args):
+	timer = Timer(time.time()+interval,func,args)
+	def repeat(*args):
+		# Reuse the same Timer, so the caller's reference stays valid
+		timer.when += interval
+		heapq.heappush(_timers,timer)
+		func(*args)
+	timer.func = repeat
+	heapq.heappush(_timers,timer)
+	return timer
+
+## Run the Timers that are Due
+#
+# @return - Seconds until the next timer, or None if there are none
+def run_timers():
+	while len(_timers) > 0:
+		timer = _timers[0]
+		if timer.cancelled:
+			heapq.heappop(_timers)
+			continue
+		now = time.time()
+		if timer.when > now:
+			return timer.when-now
+		heapq.heappop(_timers)
+		LOOP_LAG.observe(now-timer.when)
+		timer.func(*timer.args)
+	return None
+
+## Timer Wheel
+#
+# Holds many timeouts that need not be exact, such as one per connection.
+# Delays are rounded up to whole ticks and kept in a ring of slots, so
+# scheduling or cancelling a timeout is O(1), and a tick only looks at the
+# one slot it lands on.  A single repeating timer turns the wheel while it
+# has timeouts in it.
+class Timer_Wheel(object):
+	## Constructor
+	#
+	# @param tick - Seconds per slot
+	# @param slots - Number of slots.  A delay longer than one turn of the
+	#		wheel waits in its slot for the extra turns.
+	# @param func - Called with the key of each timeout that expires
+	def __init__(self,tick,slots,func):
+		self.tick = tick
+		# Each slot maps a key to the turns left before it expires
+		self.slots = [{} for i in range(slots)]
+		self.position = 0
+		self.func = func
+		# Key -> index of the slot it is in
+		self.where = {}
+		self.timer = None
+
+	## Set a Key's Timeout
+	#
+	# Replaces the key's earlier timeout, if it had one
+	#
+	# @param key - Any hashable object, passed to func when it expires
+	# @param delay - Seconds until it expires
+	def schedule(self,key,delay):
+		self.cancel(key)
+		ticks = max(1,int(math.ceil(delay/self.tick)))
+		index = (self.position+ticks) % len(self.slots)
+		self.slots[index][key] = (ticks-1)/len(self.slots)
+		self.where[key] = index
+		if self.timer == None:
+			self.timer = call_every(self.tick,self._advance)
+
+	## Remove a Key's Timeout
+	def cancel(self,key):
+		index = self.where.pop(key,None)
+		if index != None:
+			del self.slots[index][key]
+			self._stop_if_empty()
+
+	def __len__(self):
+		return len(self.where)
+
+	## Stop Turning while there is Nothing to Time
+	def _stop_if_empty(self):
+		if len(self.where) == 0 and self.timer != None:
+			self.timer.cancel()
+			self.timer = None
+
+	## Move to the Next Slot and Expire its Timeouts
+	def _advance(self):
+		self.position = (self.position+1) % len(self.slots)
+		slot = self.slots[self.position]
+		expired = []
+		for key,turns in slot.items():
+			if turns > 0:
+				slot[key] = turns-1
+			else:
+				expired.append(key)
+		for key in expired:
+			del slot[key]
+			del self.where[key]
+		self._stop_if_empty()
+		# Called last, since func may schedule the key again
+		for key in expired:
+			self.func(key)
+
+## Wait for Sockets and Handle them
+#
+# The same as asyncore.poll2, but it times the handlers
+def poll(timeout,socket_map):
+	pollster = select.poll()
+	for fd,obj in socket_map.items():
+		flags = 0
+		if obj.readable():
+			flags |= select.POLLIN | select.POLLPRI
+		# Listening sockets never become writable
+		if obj.writable() and not obj.accepting:
+			flags |= select.POLLOUT
+		if flags:
+			flags |= select.POLLERR | select.POLLHUP | select.POLLNVAL
+			pollster.register(fd,flags)
+
+	if timeout != None:
+		timeout = int(timeout*1000)
+	try:
+		ready = pollster.poll(timeout)
+	except select.error as e:
+		# A signal interrupted the wait
+		if e.args[0] != errno.EINTR:
+			raise
+		ready = []
+
+	start = time.time()
+	for fd,flags in ready:
+		obj = socket_map.get(fd)
+		if obj != None:
+			asyncore.readwrite(obj,flags)
+	if len(ready) > 0:
+		LOOP_BUSY.observe(time.time()-start)
+
+## Run One Pass of the Loop
+#
+# Handles the sockets that are ready, then the timers that are due
+def run_once(socket_map=None):
+	timeout = run_timers()
+	if timeout == None:
+		timeout = IDLE_TIMEOUT
+	else:
+		# poll() counts whole milliseconds.  Round up so a timer that
+		# is almost due does not make the loop spin.
+		timeout += 0.001
+	if socket_map == None:
+		socket_map = asyncore.socket_map
+	if len(socket_map) > 0:
+		poll(timeout,socket_map)
+	elif timeout != None:
+		time.sleep(timeout)
+	run_timers()
+
+## Run Forever
+def run(socket_map=None):
+	while(1):
+		run_once(socket_map)
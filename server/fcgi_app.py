@@ -30,6 +30,28 @@ def app():
 	# Look at path and call appropriate function
 	pass
 
+## Fetch Everything a Page Needs
+#
+# Asks the Command Center for the devices, movies, and transcoding status in
+# a single round trip.
+#
+# @return - A dict with "devices", "movies", and "conv_status" keys
+def fetch_page_data():
+	reqs = [
+		{"cmd":"fetch","type":"devices"},
+		{"cmd":"fetch","type":"movies"},
+		{"cmd":"conv_status"}
+		]
+	resps = libcc.send_batch(reqs,source="webui")
+	# An error object comes back instead of a list on failure
+	if isinstance(resps,dict):
+		return resps
+
+	page = {}
+	for key,resp in zip(["devices","movies","conv_status"],resps):
+		page[key] = resp.get("data")
+	return page
+
 # TODO Import the CLI to do the following functions
 
 # Creates a list of movies.
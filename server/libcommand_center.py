@@ -7,10 +7,13 @@
 
 import socket
 import struct
+import threading
 import subprocess
 import os
 import json
 import time
+import zlib
+import binascii
 
 #----------------
 # Constants
@@ -18,13 +21,40 @@ import time
 
 # Socket Constants
 UNIX_SOCKET_PATH = "/tmp/CommandCenterSocket"
+# The Command Center writes its metrics to anything that connects here
+METRICS_SOCKET_PATH = "/tmp/CommandCenterMetrics"
 SERVER_TIMEOUT = 5
 CLIENT_TIMEOUT = 5
 SERVER_CONNECTIONS = 10
 CHUNK_SIZE = 4096
+# Bytes requested from a socket per read
+READ_SIZE = 65536
+# Seconds to wait between reconnect attempts
+RECONNECT_DELAY = 0.1
+# Times a request is sent before giving up on it.  A request that makes the
+# Command Center drop the connection every time would otherwise be resent
+# forever.
+MAX_SENDS = 3
 
+# Wire Encodings.  The plain JSON encoding is always available.  The compact
+# encoding is only used after a connection has negotiated it.
+ENCODING_JSON = "json"
+ENCODING_COMPACT = "compact"
+ENCODINGS = [ENCODING_COMPACT,ENCODING_JSON]
+# Header bit that marks a compact payload.  The remaining 31 bits hold the
+# payload length, so plain JSON packets are unchanged.
+COMPACT_FLAG = 0x80000000
+SIZE_MASK = 0x7FFFFFFF
+# zlib level used by the compact encoding (favor speed over size)
+COMPACT_ZLIB_LEVEL = 1
+# Markers used inside compact payloads.  Filesystem paths and titles can not
+# contain a NUL character, so these never collide with real data.
+TABLE_TAG = u"\x00t"
+LIST_TAG = u"\x00l"
 
-# List of Daemon Processes
+
+# List of Daemon Processes.  "workers" marks a daemon that runs its work in
+# child processes, which are signalled along with it.
 processes = [
 		{
 			"name":"Media Scanner",
@@ -34,71 +64,381 @@ processes = [
 			"name":"Device Discoverer",
 			"cmd":["./discoverer.py"],
 			"proc":None
-		}	
+		},{
+			"name":"Converter",
+			"cmd":["./converter.py"],
+			"proc":None,
+			"workers":True
+		}
 	]
 
 #--------------
 # Socket Client Functions
 #---------------
 
+# Long-lived clients, keyed by socket path
+clients = {}
+clients_lock = threading.Lock()
+
+## Command Center Client
+#
+# A long-lived connection to the Command Center.  Every request is tagged with
+# an "id" field so that many requests can be pipelined over one socket and the
+# responses can be matched back to their callers.  If the Command Center
+# restarts, the client reconnects and resends every request that has not been
+# answered yet, up to MAX_SENDS times.  A client can be shared by several threads.  Whichever thread
+# reads the socket hands the other threads their responses.
+class CC_Client(object):
+	## Constructor
+	#
+	# @param path - Path to the Command Center's Unix socket
+	# @param timeout - Seconds to wait for the socket before giving up
+	# @param encoding - Wire encoding to ask for when connecting
+	def __init__(self,path=UNIX_SOCKET_PATH,timeout=CLIENT_TIMEOUT,
+			encoding=ENCODING_JSON):
+		self.path = path
+		self.timeout = timeout
+		self.preferred_encoding = encoding
+		# Encoding in use on the current connection
+		self.encoding = ENCODING_JSON
+		self.sock = None
+		self.decoder = Frame_Decoder()
+		# ID given to the next request
+		self.next_id = 1
+		# Requests that were sent but not answered yet, keyed by ID
+		self.pending = {}
+		# Times each pending request has been sent, keyed by ID
+		self.sends = {}
+		# Responses that were received but not claimed yet, keyed by ID
+		self.responses = {}
+		# Unsolicited messages (messages without an ID)
+		self.events = []
+		# Subscribe requests to renew after a reconnect
+		self.subscriptions = []
+		# Held while using the socket or the state above.  Connecting
+		# happens inside send() and reads, so it is reentrant.
+		self.lock = threading.RLock()
+
+	## Connect to the Command Center
+	#
+	# Opens the socket and resends any request that is still waiting on a
+	# response.  If the Command Center is restarting, the connection is
+	# retried until the timeout runs out.
+	def connect(self):
+		self.close()
+		deadline = time.time() + self.timeout
+		while(1):
+			s = socket.socket(socket.AF_UNIX,
+					socket.SOCK_STREAM)
+			s.settimeout(self.timeout)
+			try:
+				s.connect(self.path)
+				break
+			except socket.error:
+				s.close()
+				# Give up once the timeout has run out
+				if time.time() > deadline:
+					raise
+				time.sleep(RECONNECT_DELAY)
+
+		self.sock = s
+		self.encoding = ENCODING_JSON
+		if self.preferred_encoding != ENCODING_JSON:
+			self.negotiate()
+
+		# Renew subscriptions.  The ID matches no request, so the
+		# responses are dropped.
+		for msg in self.subscriptions:
+			msg = dict(msg,id=-1)
+			self.sock.sendall(json_to_pkt(msg,self.encoding))
+
+		# Resend the unanswered requests in the order they were made.
+		# One that has been sent too often is answered with an error.
+		for req_id in sorted(self.pending):
+			sends = self.sends.get(req_id,0)+1
+			if sends > MAX_SENDS:
+				self._forget(req_id)
+				self.responses[req_id] = {
+					"source":"command_center",
+					"message":"Error - Connection Lost",
+					"id":req_id
+					}
+				continue
+			self.sends[req_id] = sends
+			self.sock.sendall(json_to_pkt(self.pending[req_id],
+					self.encoding))
+
+	## Negotiate the Wire Encoding
+	#
+	# Sends a "hello" request listing the encodings this client can use and
+	# waits for the answer.  A Command Center that does not know about
+	# encodings leaves the "encoding" field out, so the connection stays
+	# on plain JSON.
+	def negotiate(self):
+		hello = {
+			"source":"client",
+			"cmd":"hello",
+			"id":0,
+			"encodings":[self.preferred_encoding,ENCODING_JSON]
+			}
+		self.sock.sendall(json_to_pkt(hello))
+		while(1):
+			data = self.sock.recv(READ_SIZE)
+			if data == "":
+				raise socket.error("Connection closed while negotiating")
+			for msg in self.decoder.feed(data):
+				if msg.get("id") == 0:
+					self.encoding = msg.get("encoding",
+							ENCODING_JSON)
+					return
+				self._dispatch(msg)
+
+	## Close the connection
+	#
+	# Pending requests are kept so they can be resent on the next connect
+	def close(self):
+		if self.sock != None:
+			self.sock.close()
+		self.sock = None
+		self.decoder = Frame_Decoder()
+
+	## Send a Request
+	#
+	# Tags the request with an ID and sends it without waiting for the
+	# response.  Several requests can be sent before reading any responses.
+	#
+	# @param msg - A JSON object
+	# @return - The request ID used to collect the response with recv()
+	def send(self,msg):
+		msg = dict(msg)
+		with self.lock:
+			req_id = self.next_id
+			self.next_id += 1
+			msg["id"] = req_id
+			self.pending[req_id] = msg
+
+			if self.sock != None:
+				try:
+					self.sock.sendall(json_to_pkt(msg,
+						self.encoding))
+					self.sends[req_id] = 1
+					return req_id
+				except socket.error:
+					self.close()
+			# Connecting resends every pending request, including
+			# this one
+			try:
+				self.connect()
+			except socket.error:
+				self._forget(req_id)
+				raise
+			return req_id
+
+	## Receive a Response
+	#
+	# Reads from the socket until the response to the given request ID
+	# arrives.  Responses to other requests are saved for their callers.
+	#
+	# @param req_id - An ID returned by send()
+	# @return - A JSON object response from the command center.
+	def recv(self,req_id):
+		while(1):
+			with self.lock:
+				if req_id in self.responses:
+					return self.responses.pop(req_id)
+				try:
+					self._read()
+				except socket.error:
+					# Timed out, or could not reconnect.  Forget
+					# the request so a late answer is dropped.
+					self._forget(req_id)
+					self.close()
+					raise
+
+	## Subscribe to Topics
+	#
+	# Asks the Command Center to push change events for the given topics.
+	# The subscription is renewed automatically after a reconnect.
+	#
+	# @param topics - A list of topic names (devices, library, ...)
+	# @param source - Source to send the request as
+	# @return - The Command Center's response
+	def subscribe(self,topics,source="cli"):
+		msg = {"source":source,"cmd":"subscribe","topics":topics}
+		resp = self.request(msg)
+		if resp.get("message") == "OK":
+			self.subscriptions.append(msg)
+		return resp
+
+	## Wait for an Event
+	#
+	# Returns the oldest unsolicited message, reading from the socket until
+	# one arrives.
+	#
+	# @param timeout - Seconds to wait, or None to use the client timeout
+	# @return - A JSON object, or None if the timeout ran out
+	def wait_event(self,timeout=None):
+		with self.lock:
+			if len(self.events) == 0:
+				if self.sock == None:
+					self.connect()
+				if timeout != None:
+					self.sock.settimeout(timeout)
+				try:
+					while len(self.events) == 0:
+						self._read()
+				except socket.timeout:
+					pass
+				finally:
+					if self.sock != None:
+						self.sock.settimeout(self.timeout)
+			if len(self.events) == 0:
+				return None
+			return self.events.pop(0)
+
+	## Read and Dispatch one Chunk
+	#
+	# If the Command Center went away, reconnect and resend everything
+	# that was not answered.
+	def _read(self):
+		if self.sock == None:
+			self.connect()
+		try:
+			data = self.sock.recv(READ_SIZE)
+		except socket.timeout:
+			raise
+		except socket.error:
+			data = ""
+		if data == "":
+			self.connect()
+			return
+
+		for msg in self.decoder.feed(data):
+			self._dispatch(msg)
+
+	## Send a Request and wait for its Response
+	#
+	# @param msg - A JSON object
+	# @return - A JSON object response from the command center.
+	def request(self,msg):
+		return self.recv(self.send(msg))
+
+	## Stop Waiting on a Request
+	def _forget(self,req_id):
+		self.pending.pop(req_id,None)
+		self.sends.pop(req_id,None)
+
+	## Match a Received message to its Request
+	def _dispatch(self,msg):
+		req_id = msg.get("id")
+		if req_id in self.pending:
+			self._forget(req_id)
+			self.responses[req_id] = msg
+		elif req_id == None:
+			self.events.append(msg)
+		# Anything else answers a request that already timed out
+
+## Get the Shared Client
+#
+# Returns the long-lived client for the given socket path, creating it on
+# first use.
+def get_client(path=UNIX_SOCKET_PATH):
+	with clients_lock:
+		if path not in clients:
+			clients[path] = CC_Client(path)
+		return clients[path]
+
 ## Send and Recieve JSON to Command Center
 #
-# Main Client function for communicating with the Command Center.  JSON object
-# is converted to string, a size header is added, and the string is transmitted
-# using TCP.  The rerse happens when a packet is received. 
+# Main Client function for communicating with the Command Center.  The request
+# is sent over the shared long-lived connection for the given path, so repeated
+# calls do not pay for a new connection each time.
 #
 # @param msg - A JSOn Object
 # @return - A JSON Object response form the command center.
 def send_recv(msg,path=UNIX_SOCKET_PATH):
-	s = socket.socket(socket.AF_UNIX,
-			socket.SOCK_STREAM)
-	s.settimeout(5)
-
 	try:
-		# Connect to the Socket
-		s.connect(path)
+		return get_client(path).request(msg)
+	except socket.timeout:
+		return {"error":"Unix Socket Timeout"}
+	except socket.error:
+		return {"error":"Unix Socket Error"}
 
-		# Convert JSON object to a packet
-		pkt = json_to_pkt(msg)
-		# Send message to Command Center
-		while(1):
-			# Send part (if not all) of the packet
-			sent = s.send(pkt)
-			if sent >= len(pkt):
-				# If the whole packet was sent, break the loop
-				break
-			else:
-				# If More is left, discard the sent characters
-				# and try again
-				pkt = pkt[sent:]
+## Send a Batch of Requests
+#
+# Sends several requests to the Command Center in one round trip.  The
+# requests run in order and an error in one does not stop the others.
+#
+# @param reqs - A list of JSON objects
+# @param source - Source used for requests that do not have one
+# @return - A list with one response per request, or an error object
+def send_batch(reqs,source=None,path=UNIX_SOCKET_PATH):
+	msg = {"cmd":"batch","requests":reqs}
+	if source != None:
+		msg["source"] = source
+	resp = send_recv(msg,path)
+	if "data" not in resp:
+		return resp
+	return resp["data"]
 
-		# Read Loop
-		pkt = ""
-		while(1):
-			pkt += s.recv(1024)
-			# Attempt to decode the packet
-			msg,size = pkt_to_json(pkt)
-			# If a proper Msg was created, return
-			if msg != None:
-				return msg
-			# If msg == none, continue the loop
-				
+## IPC Frame Decoder
+#
+# Decodes a stream of IPC packets as the bytes arrive.  Data is appended to a
+# bytearray and every complete packet in it is decoded in one pass, so a burst
+# of pipelined packets is handled by a single read.  Consumed bytes are dropped
+# once per pass, which keeps large uploads linear in cost.
+class Frame_Decoder(object):
+	def __init__(self):
+		self.buffer = bytearray()
 
+	## Number of bytes waiting to be decoded
+	def __len__(self):
+		return len(self.buffer)
 
+	## Add data and decode it
+	#
+	# @param data - A string of bytes read from a socket
+	# @return - A list of every JSON object completed by this data
+	def feed(self,data):
+		self.buffer += data
+		return self.decode()
+
+	## Decode every complete packet in the buffer
+	#
+	# @return - A list of JSON objects.  Incomplete packets stay buffered.
+	def decode(self):
+		buf = self.buffer
+		view = memoryview(buf)
+		msgs = []
+		offset = 0
+		while len(buf) - offset >= 4:
+			header = struct.unpack_from("<I",buf,offset)[0]
+			end = offset+4+(header & SIZE_MASK)
+			# Wait for the rest of the packet
+			if len(buf) < end:
+				break
+			payload = view[offset+4:end].tobytes()
+			if header & COMPACT_FLAG:
+				msgs.append(compact_loads(payload))
+			else:
+				msgs.append(json.loads(payload))
+			offset = end
+		# The view must be gone before the buffer can be resized
+		del view
+		if offset > 0:
+			del buf[:offset]
+		return msgs
 
-	except socket.timeout:
-		return {"error":"Unix Socket Timeout"}
- 
 ## Convert IPC Packet to JSON object
 #
 # This function converts a n IPC packet into a JSON object.  The first 4 bytes
-# contains the totle packet size.  
+# contains the totle packet size.  Use Frame_Decoder to decode a stream.
 def pkt_to_json(pkt):
 	# Grab the pkt length from the first 4 bytes
 	if len(pkt) < 4:
 		return (None, 0 )
-	header = pkt[0:4]
-	size = struct.unpack("<I",header)[0]
+	header = struct.unpack("<I",pkt[0:4])[0]
+	size = header & SIZE_MASK
 
 	# If the packet is shorter than the expected length, return None,0
 	if len(pkt) < size+4:
@@ -106,7 +446,10 @@ def pkt_to_json(pkt):
 
 	# Convert the packet to JSON object
 	payload = pkt[4:4+size]	
-	obj = json.loads(payload)
+	if header & COMPACT_FLAG:
+		obj = compact_loads(payload)
+	else:
+		obj = json.loads(payload)
 	# Return how much of the string buffer was used
 	return (obj,size+4)	
 
@@ -114,14 +457,161 @@ def pkt_to_json(pkt):
 #
 # Stringify's the JSON object and adds a 4byte unsigned interger to the 
 # beginning of the packet to idenfiy the length
-def json_to_pkt(obj):
-	pkt = json.dumps(obj)
-
-	header = struct.pack("<I",len(pkt))
+#
+# @param obj - A JSON object
+# @param encoding - ENCODING_JSON or ENCODING_COMPACT
+def json_to_pkt(obj,encoding=ENCODING_JSON):
+	if encoding == ENCODING_COMPACT:
+		pkt = compact_dumps(obj)
+		header = struct.pack("<I",len(pkt) | COMPACT_FLAG)
+	else:
+		pkt = _dumps(obj)
+		header = struct.pack("<I",len(pkt))
 
 	pkt = header+pkt
 	return pkt
 
+#---------------------------
+# Pre-Encoded Data
+#
+# A large value (such as the whole movie list) can be encoded once with
+# encode_data() and placed in any number of responses.  json_to_pkt splices
+# the encoded text in instead of encoding the value again.
+#---------------------------
+
+## Encoded Value
+#
+# Holds the JSON text of a value, already encoded for one IPC encoding
+class Encoded_Data(object):
+	def __init__(self,text,encoding):
+		self.text = text
+		self.encoding = encoding
+
+## Encode a Value once for use in many Packets
+#
+# @param obj - A JSON object
+# @param encoding - The encoding of the packets it will be sent in
+# @return - An Encoded_Data
+def encode_data(obj,encoding=ENCODING_JSON):
+	if encoding == ENCODING_COMPACT:
+		text = json.dumps(_pack(obj),separators=(",",":"))
+	else:
+		text = json.dumps(obj)
+	return Encoded_Data(text,encoding)
+
+# Marks where Encoded_Data goes in the JSON text.  The random part keeps it
+# from matching a real string.
+_SPLICE_ID = binascii.hexlify(os.urandom(8))
+_SPLICE_MARK = '"\\u0000splice-%s-' % _SPLICE_ID
+
+## JSON encode an object that may hold Encoded_Data
+def _dumps(obj,**kwargs):
+	spliced = []
+	def placeholder(o):
+		if not isinstance(o,Encoded_Data):
+			raise TypeError(repr(o)+" is not JSON serializable")
+		spliced.append(o.text)
+		return u"\x00splice-%s-%d" % (_SPLICE_ID,len(spliced)-1)
+	text = json.dumps(obj,default=placeholder,**kwargs)
+	if len(spliced) == 0:
+		return text
+
+	# Each placeholder is a quoted string.  Swap it for the encoded text.
+	parts = text.split(_SPLICE_MARK)
+	out = [parts[0]]
+	for part in parts[1:]:
+		index,rest = part.split('"',1)
+		out.append(spliced[int(index)])
+		out.append(rest)
+	return "".join(out)
+
+#---------------------------
+# Compact Encoding
+#
+# The compact encoding interns dictionary keys and compresses the result.  A
+# list of dictionaries (such as the movie list) becomes a table:
+#
+#	[TABLE_TAG, [key lists], [[key list index, value, value, ...], ...]]
+#
+# so keys like "path" and "title" are written once per table instead of once
+# per item.  The table is then JSON encoded and zlib compressed.
+#---------------------------
+
+## Encode an object with the Compact Encoding
+#
+# @param obj - A JSON object
+# @return - A string of compressed bytes
+def compact_dumps(obj):
+	data = _dumps(_pack(obj),separators=(",",":"))
+	return zlib.compress(data,COMPACT_ZLIB_LEVEL)
+
+## Decode an object from the Compact Encoding
+#
+# @param data - A string of bytes made by compact_dumps
+# @return - A JSON object
+def compact_loads(data):
+	return _unpack(json.loads(zlib.decompress(data)))
+
+# Types that _pack and _unpack have to recurse into
+_CONTAINERS = (dict,list)
+
+## Replace lists of dictionaries with key-interned tables
+def _pack(obj):
+	t = type(obj)
+	if t is dict:
+		return dict((k, _pack(v) if type(v) in _CONTAINERS else v)
+				for k,v in obj.iteritems())
+	if t is not list:
+		return obj
+
+	if len(obj) > 0 and all(type(x) is dict for x in obj):
+		# Every distinct key list is stored once
+		shapes = {}
+		keysets = []
+		rows = []
+		for d in obj:
+			keys = tuple(d)
+			idx = shapes.get(keys)
+			if idx == None:
+				idx = shapes[keys] = len(keysets)
+				keysets.append(keys)
+			row = [idx]
+			for v in d.itervalues():
+				if type(v) in _CONTAINERS:
+					v = _pack(v)
+				row.append(v)
+			rows.append(row)
+		return [TABLE_TAG,keysets,rows]
+
+	out = [_pack(v) if type(v) in _CONTAINERS else v for v in obj]
+	# Escape plain lists that happen to start with a marker
+	if (len(out) > 0 and isinstance(out[0],basestring)
+			and out[0][:1] == u"\x00"):
+		out.insert(0,LIST_TAG)
+	return out
+
+## Undo _pack
+def _unpack(obj):
+	t = type(obj)
+	if t is dict:
+		return dict((k, _unpack(v) if type(v) in _CONTAINERS else v)
+				for k,v in obj.iteritems())
+	if t is not list:
+		return obj
+
+	if len(obj) > 0 and obj[0] == TABLE_TAG:
+		keysets = obj[1]
+		out = []
+		for row in obj[2]:
+			vals = [_unpack(v) if type(v) in _CONTAINERS else v
+					for v in row[1:]]
+			out.append(dict(zip(keysets[row[0]],vals)))
+		return out
+
+	if len(obj) > 0 and obj[0] == LIST_TAG:
+		obj = obj[1:]
+	return [_unpack(v) if type(v) in _CONTAINERS else v for v in obj]
+
 #---------------------------
 # Daemon Launcher Functions
 #----------------------------
@@ -161,6 +651,57 @@ def start(process):
 	process["proc"] = p
 
 
+## Send a Signal to every Running Daemon
+#
+# @param ps - The process list
+# @param signum - The signal to send
+# @return - A dict of process name -> process ID for each process signalled
+def signal_processes(ps,signum):
+	sent = {}
+	for p in ps:
+		if running(p):
+			p["proc"].send_signal(signum)
+			sent[p["name"]] = p["proc"].pid
+			if p.get("workers"):
+				for pid in child_pids(p["proc"].pid):
+					os.kill(pid,signum)
+					sent["%s %d" % (p["name"],pid)] = pid
+	return sent
+
+## List the Child Processes of a Process
+#
+# Reads /proc, so this only finds them on Linux
+#
+# @return - A list of process IDs
+def child_pids(pid):
+	pids = []
+	for name in os.listdir("/proc"):
+		if not name.isdigit():
+			continue
+		try:
+			with open("/proc/%s/stat" % name) as f:
+				stat = f.read()
+		except IOError:
+			# It exited
+			continue
+		# The parent follows the state, after the (command name),
+		# which may contain spaces
+		if int(stat.rsplit(")",1)[1].split()[1]) == pid:
+			pids.append(int(name))
+	return pids
+
+## Sleep for the Whole Time
+#
+# time.sleep returns early when a signal arrives, which would cut short a
+# daemon's wait between cycles whenever it is profiled
+def sleep(seconds):
+	end = time.time()+seconds
+	while(1):
+		left = end-time.time()
+		if left <= 0:
+			return
+		time.sleep(left)
+
 def terminate(process):
 	print "Terminating %s"%process["name"]
 	process["proc"].terminate()
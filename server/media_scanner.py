@@ -2,6 +2,7 @@
 
 import os
 import libcommand_center as libcc
+import profiler
 import time
 
 #-----------------
@@ -65,6 +66,7 @@ def scan_pictures(db):
 
 def loop_forever():
 	while(1):
+		start = time.time()
 		# Create an Empty Database object
 		db = {
 			"source":"scanner",
@@ -86,18 +88,23 @@ def loop_forever():
 		# Scan the Picutre Folder
 		scan_pictures(db["pictures"])
 
+		# Report how long the scan took
+		db["cycle_seconds"] = time.time()-start
+
 		# Send database to the command cetner
 		ret = libcc.send_recv(db)
 		if ret["message"] == "OK":
 			# if succesful, Wait 10 minutes before the next scan
-			time.sleep(60*10)
+			libcc.sleep(60*10)
 		else:
 			# If it doesnt work out, sleep for 10 seconds
-			time.sleep(10)
+			libcc.sleep(10)
 		
 
 	return -1
 
 if __name__ == "__main__":
+	# Let the Command Center turn on the profiler
+	profiler.install_signal_handlers()
 	loop_forever()
 
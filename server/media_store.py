@@ -0,0 +1,313 @@
+#------------------
+# Media Store
+#
+# Indexed in-memory collections for the Command Center database.  Items are
+# media dictionaries (movies, episodes, transcode jobs) keyed by their path.
+#-------------------
+
+import bisect
+
+
+## Indexed Media Store
+#
+# Keeps a list of media dictionaries in order, keyed by path.  Every path is
+# given an integer ID that stays the same for as long as the Command Center
+# runs, even if the item is removed and added again.  The IDs break ties in
+# sorted pages, so page cursors stay stable.  (Title search and facets are
+# kept by search_index.Search_Index, as a listener.)
+#
+# The order is kept in a plain list of paths.  Removing an item leaves a dead
+# entry in the list, which is skipped and cleared out once dead entries make
+# up half of the list.  (collections.OrderedDict does the same job but is
+# written in Python and is several times slower to fill.)
+class Media_Store(object):
+	def __init__(self):
+		# Path -> Item
+		self.items = {}
+		# Paths in list order, and Path -> position of its live entry
+		self.order = []
+		self.slots = {}
+		# Dead entries in the order list, and the first entry that
+		# might be live
+		self.dead = 0
+		self.head = 0
+		# Path -> ID and ID -> Path
+		self.ids = {}
+		self.paths = {}
+		self.next_id = 1
+		# Functions(path,item) called for every change.  The item is
+		# None when it was removed.
+		self.listeners = []
+		# Goes up by one for every change
+		self.version = 0
+		# Sort field -> (version, sorted list of (value, ID))
+		self.sorted_keys = {}
+
+	def __len__(self):
+		return len(self.items)
+
+	def __iter__(self):
+		return iter(self.to_list())
+
+	def __contains__(self,path):
+		return path in self.items
+
+	## Get an Item by Path
+	#
+	# @return - The item, or None if the path is not in the store
+	def get(self,path):
+		return self.items.get(path)
+
+	## Get the First Item
+	#
+	# @return - The oldest item, or None if the store is empty
+	def first(self):
+		order = self.order
+		slots = self.slots
+		# Dead entries at the front never come back to life
+		while self.head < len(order):
+			path = order[self.head]
+			if slots.get(path) == self.head:
+				return self.items[path]
+			self.head += 1
+		return None
+
+	## Add or Replace an Item
+	#
+	# A new path is added to the end of the list.  An existing path keeps
+	# its position.
+	def add(self,item):
+		path = item["path"]
+		if path not in self.items:
+			if path not in self.ids:
+				self.ids[path] = self.next_id
+				self.paths[self.next_id] = path
+				self.next_id += 1
+			self.slots[path] = len(self.order)
+			self.order.append(path)
+		self.items[path] = item
+		self._changed(path,item)
+
+	## Remove an Item
+	#
+	# @return - The removed item, or None if the path is not in the store
+	def remove(self,path):
+		item = self.items.pop(path,None)
+		if item != None:
+			del self.slots[path]
+			self.dead += 1
+			if self.dead > len(self.order)/2:
+				self._compact()
+			self._changed(path,None)
+		return item
+
+	## Update Fields of an Item
+	#
+	# @param path - Path of the item to update
+	# @param fields - A dict of fields to set on the item
+	# @return - The updated item, or None if the path is not in the store
+	def update(self,path,fields):
+		item = self.items.get(path)
+		if item == None:
+			return None
+		item.update(fields)
+		self._changed(path,item)
+		return item
+
+	## Replace the whole Collection
+	#
+	# Items that did not change are not reported to the listeners, so a
+	# rescan that finds the same library does very little work.
+	#
+	# @param items - The new list of items
+	# @return - A dict with the "added" (or changed) items and the
+	#		"removed" paths
+	def replace(self,items):
+		old = self.items
+		self._clear()
+		if len(old) == 0:
+			return self._load(items)
+
+		added = []
+		for item in items:
+			path = item["path"]
+			prev = old.pop(path,None)
+			if prev == item:
+				# Unchanged.  Keep the old dictionary.
+				self.slots[path] = len(self.order)
+				self.order.append(path)
+				self.items[path] = prev
+				continue
+			self.add(item)
+			added.append(item)
+
+		# Whatever is left over was not in the new list
+		for path in old:
+			self._changed(path,None)
+		return {"added":added,"removed":old.keys()}
+
+	## Get one Page of Items
+	#
+	# Pages are keyed by the sort value and ID of the last item returned
+	# (not by position), so adding or removing other items between two
+	# calls does not make the next page skip or repeat anything.
+	#
+	# @param sort - Field to sort by, or None to sort by ID (the order
+	#		paths were first added in)
+	# @param after - (value, ID) of the last item on the previous page, or
+	#		None for the first page
+	# @param limit - Largest number of items to return, or None for all
+	# @param descending - True to walk the sort order backwards
+	# @return - (list of items, (value, ID) of the last item or None if
+	#		there are no more pages)
+	def page(self,sort=None,after=None,limit=None,descending=False):
+		keys = self._sorted(sort)
+		if limit == None:
+			limit = len(keys)
+
+		if descending:
+			end = len(keys)
+			if after != None:
+				end = bisect.bisect_left(keys,tuple(after))
+			begin = max(0,end-limit)
+			chosen = keys[begin:end]
+			chosen.reverse()
+			more = begin > 0
+		else:
+			begin = 0
+			if after != None:
+				begin = bisect.bisect_right(keys,tuple(after))
+			chosen = keys[begin:begin+limit]
+			more = begin+limit < len(keys)
+
+		items = [self.items[self.paths[i]] for value,i in chosen]
+		if more and len(chosen) > 0:
+			return items,chosen[-1]
+		return items,None
+
+	## Get the (value, ID) Keys in Sorted Order
+	#
+	# The sorted list is cached until the store changes
+	def _sorted(self,sort):
+		cached = self.sorted_keys.get(sort)
+		if cached != None and cached[0] == self.version:
+			return cached[1]
+		if sort == None:
+			keys = [(None,self.ids[p]) for p in self.items]
+		else:
+			keys = [(item.get(sort),self.ids[p])
+				for p,item in self.items.iteritems()]
+		keys.sort()
+		self.sorted_keys[sort] = (self.version,keys)
+		return keys
+
+	## Get the Items as a List
+	def to_list(self):
+		items = self.items
+		if self.dead == 0:
+			return [items[p] for p in self.order]
+		slots = self.slots
+		return [items[p] for i,p in enumerate(self.order)
+			if slots.get(p) == i]
+
+	## Empty the Store, keeping the IDs
+	def _clear(self):
+		self.items = {}
+		self.order = []
+		self.slots = {}
+		self.dead = 0
+		self.head = 0
+
+	## Drop the Dead Entries from the Order List
+	def _compact(self):
+		self.order = [p for i,p in enumerate(self.order)
+			if self.slots.get(p) == i]
+		self.slots = dict((p,i) for i,p in enumerate(self.order))
+		self.dead = 0
+		self.head = 0
+
+	## Fill an Empty Store
+	#
+	# Same as replace() but faster, for loading a whole library at once
+	def _load(self,items):
+		ids = self.ids
+		store = self.items
+		order = self.order
+		for item in items:
+			path = item["path"]
+			if path not in ids:
+				ids[path] = self.next_id
+				self.paths[self.next_id] = path
+				self.next_id += 1
+			if path not in store:
+				order.append(path)
+			store[path] = item
+		self.slots = dict((p,i) for i,p in enumerate(order))
+
+		added = self.to_list()
+		self.version += 1
+		for listener in self.listeners:
+			for item in added:
+				listener(item["path"],item)
+		return {"added":added,"removed":[]}
+
+	def _changed(self,path,item):
+		self.version += 1
+		for listener in self.listeners:
+			listener(path,item)
+
+
+## TV Store
+#
+# The scanner reports TV as a list of shows.  Fetches return that list
+# unchanged, while the episodes inside it are kept in a Media_Store (the
+# same dictionaries, so updating an episode updates the show list too).
+class TV_Store(object):
+	def __init__(self):
+		self.shows = []
+		self.episodes = Media_Store()
+		self.episodes.listeners.append(self._changed)
+		# Functions(key,shows) called when the show list changes.  The
+		# key is always "shows".
+		self.listeners = []
+		# Goes up every time the show list changes
+		self.version = 0
+
+	## Number of Shows
+	def __len__(self):
+		return len(self.shows)
+
+	## Replace the Show List
+	#
+	# An identical show list changes nothing, not even the version
+	#
+	# @return - The same diff as Media_Store.replace, for the episodes
+	def replace(self,shows):
+		if shows == self.shows:
+			return {"added":[],"removed":[]}
+		self.shows = shows
+		self._changed("shows",shows)
+		episodes = []
+		for show in shows:
+			episodes.extend(show_episodes(show))
+		return self.episodes.replace(episodes)
+
+	## Get the Shows as a List
+	def to_list(self):
+		return self.shows
+
+	## An Episode Changed, so the Show List did too
+	def _changed(self,path,item):
+		self.version += 1
+		for listener in self.listeners:
+			listener("shows",self.shows)
+
+
+## List the Episodes of a Show
+#
+# A show is either a list of episode dictionaries or a dictionary with an
+# "episodes" list.
+def show_episodes(show):
+	if isinstance(show,dict):
+		return show.get("episodes",[])
+	return show
@@ -0,0 +1,270 @@
+#------------------
+# Metrics
+#
+# Counters, gauges and latency histograms for the Command Center.  Metrics
+# are kept in a registry that can be returned as JSON (the "stats" command)
+# or written in the Prometheus text format (the metrics socket).
+#-------------------
+
+import asyncore
+import socket
+import os
+import bisect
+
+#-----------------
+# Constants
+#-----------------
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,
+	1.0,2.5,5.0,10.0]
+
+# Upper bounds (in seconds) for slow jobs such as a library scan
+CYCLE_BUCKETS = [0.1,0.5,1.0,5.0,10.0,30.0,60.0,300.0,600.0,1800.0,3600.0]
+
+
+## Format Label Values for the Prometheus Text Format
+def _label_text(names,values):
+	if len(names) == 0:
+		return ""
+	pairs = []
+	for name,value in zip(names,values):
+		value = unicode(value).replace("\\","\\\\").replace('"','\\"')
+		pairs.append('%s="%s"' % (name,value.replace("\n","\\n")))
+	return "{"+",".join(pairs)+"}"
+
+## Base Metric
+#
+# Values are kept per tuple of label values
+class Metric(object):
+	kind = None
+
+	## Constructor
+	#
+	# @param name - Metric name, such as "cc_requests_total"
+	# @param doc - One line description
+	# @param labels - List of label names
+	def __init__(self,name,doc,labels=()):
+		self.name = name
+		self.doc = doc
+		self.labels = tuple(labels)
+		self.values = {}
+
+	## Get the Values
+	#
+	# @return - A list of (label values, value)
+	def collect(self):
+		return sorted(self.values.items())
+
+	## Get the Values as JSON
+	#
+	# @return - The value if there are no labels, otherwise a dict of
+	#		"label=value,..." to value
+	def to_json(self):
+		values = self.collect()
+		if len(self.labels) == 0:
+			if len(values) == 0:
+				return None
+			return self._json_value(values[0][1])
+		out = {}
+		for key,value in values:
+			name = ",".join("%s=%s" % pair for pair in zip(self.labels,key))
+			out[name] = self._json_value(value)
+		return out
+
+	def _json_value(self,value):
+		return value
+
+	## Write the Prometheus Text Lines
+	def to_prometheus(self):
+		lines = ["# HELP %s %s" % (self.name,self.doc),
+			"# TYPE %s %s" % (self.name,self.kind)]
+		for key,value in self.collect():
+			lines.append("%s%s %s" % (self.name,
+				_label_text(self.labels,key),repr(float(value))))
+		return lines
+
+
+## Counter
+#
+# A number that only goes up
+class Counter(Metric):
+	kind = "counter"
+
+	def inc(self,amount=1,*labels):
+		self.values[labels] = self.values.get(labels,0)+amount
+
+
+## Gauge
+#
+# A number that goes up and down.  Either set() it, or give a function that
+# returns a dict of label values -> value when the gauge is read.
+class Gauge(Metric):
+	kind = "gauge"
+
+	def __init__(self,name,doc,labels=(),func=None):
+		Metric.__init__(self,name,doc,labels)
+		self.func = func
+
+	def set(self,value,*labels):
+		self.values[labels] = value
+
+	def collect(self):
+		if self.func != None:
+			return sorted(self.func().items())
+		return Metric.collect(self)
+
+
+## Histogram
+#
+# Counts observations in buckets, for latencies
+class Histogram(Metric):
+	kind = "histogram"
+
+	def __init__(self,name,doc,labels=(),buckets=LATENCY_BUCKETS):
+		Metric.__init__(self,name,doc,labels)
+		self.buckets = list(buckets)
+
+	## Record one Observation
+	#
+	# @param value - The observed value, usually seconds
+	# @param labels - Label values, in the order of the label names
+	def observe(self,value,*labels):
+		h = self.values.get(labels)
+		if h == None:
+			# [count per bucket (last is +Inf), sum, largest]
+			h = self.values[labels] = [[0]*(len(self.buckets)+1),0.0,0.0]
+		h[0][bisect.bisect_left(self.buckets,value)] += 1
+		h[1] += value
+		if value > h[2]:
+			h[2] = value
+
+	## Estimate a Quantile from the Buckets
+	#
+	# @return - The upper bound of the bucket holding the quantile
+	def quantile(self,q,*labels):
+		h = self.values.get(labels)
+		if h == None:
+			return None
+		return self._quantile(h,q)
+
+	def _quantile(self,h,q):
+		total = sum(h[0])
+		seen = 0
+		for i,count in enumerate(h[0]):
+			seen += count
+			if seen >= q*total:
+				if i < len(self.buckets):
+					return self.buckets[i]
+				break
+		# Past the last bucket.  The largest value is the best guess.
+		return h[2]
+
+	def _json_value(self,h):
+		count = sum(h[0])
+		return {
+			"count":count,
+			"sum":h[1],
+			"max":h[2],
+			"p50":self._quantile(h,0.5),
+			"p99":self._quantile(h,0.99)
+			}
+
+	def to_prometheus(self):
+		lines = ["# HELP %s %s" % (self.name,self.doc),
+			"# TYPE %s histogram" % self.name]
+		names = self.labels+("le",)
+		for key,h in self.collect():
+			seen = 0
+			bounds = [repr(b) for b in self.buckets]+["+Inf"]
+			for bound,count in zip(bounds,h[0]):
+				seen += count
+				lines.append("%s_bucket%s %d" % (self.name,
+					_label_text(names,key+(bound,)),seen))
+			text = _label_text(self.labels,key)
+			lines.append("%s_sum%s %r" % (self.name,text,h[1]))
+			lines.append("%s_count%s %d" % (self.name,text,seen))
+		return lines
+
+
+## Metric Registry
+class Registry(object):
+	def __init__(self):
+		self.metrics = []
+		self.by_name = {}
+
+	def add(self,metric):
+		self.metrics.append(metric)
+		self.by_name[metric.name] = metric
+		return metric
+
+	def counter(self,name,doc,labels=()):
+		return self.add(Counter(name,doc,labels))
+
+	def gauge(self,name,doc,labels=(),func=None):
+		return self.add(Gauge(name,doc,labels,func))
+
+	def histogram(self,name,doc,labels=(),buckets=LATENCY_BUCKETS):
+		return self.add(Histogram(name,doc,labels,buckets))
+
+	## Get every Metric as JSON
+	#
+	# @return - A dict of metric name -> Metric.to_json()
+	def to_json(self):
+		return dict((m.name,m.to_json()) for m in self.metrics)
+
+	## Get every Metric in the Prometheus Text Format
+	def to_prometheus(self):
+		lines = []
+		for m in self.metrics:
+			lines.extend(m.to_prometheus())
+		return "\n".join(lines).encode("utf-8")+"\n"
+
+
+# The registry every Command Center module adds its metrics to
+REGISTRY = Registry()
+
+
+## Metrics Socket
+#
+# Writes the registry in the Prometheus text format to every connection on
+# a unix socket, then closes it.  Read it with, for example:
+#
+#	socat - UNIX-CONNECT:/tmp/CommandCenterMetrics
+class Metrics_Server(asyncore.dispatcher):
+	def __init__(self,path,registry=REGISTRY):
+		asyncore.dispatcher.__init__(self)
+		if os.path.exists(path):
+			os.remove(path)
+		self.create_socket(socket.AF_UNIX,socket.SOCK_STREAM)
+		self.bind(path)
+		self.listen(5)
+		self.registry = registry
+
+	def handle_accept(self):
+		pair = self.accept()
+		if pair == None:
+			return
+		Metrics_Handler(pair[0],self.registry.to_prometheus())
+
+
+## Sends one Metrics Dump
+class Metrics_Handler(asyncore.dispatcher):
+	def __init__(self,sock,text):
+		asyncore.dispatcher.__init__(self,sock)
+		self.write_buffer = text
+
+	def readable(self):
+		return False
+
+	def writable(self):
+		return True
+
+	def handle_write(self):
+		sent = self.send(self.write_buffer)
+		self.write_buffer = self.write_buffer[sent:]
+		if len(self.write_buffer) == 0:
+			self.close()
+
+	def handle_close(self):
+		self.close()
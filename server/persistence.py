@@ -0,0 +1,246 @@
+#------------------
+# Persistence
+#
+# Keeps a copy of the Command Center database on disk so a restart does not
+# lose the device list, the library, or the transcode queue.  The data is kept
+# as a snapshot plus an append-only journal of changes made since the
+# snapshot.  All disk I/O happens on a background thread.
+#-------------------
+
+import os
+import json
+import threading
+import Queue
+import collections
+
+#-----------------
+# Constants
+#-----------------
+
+# Set with the Command Center's --db-folder option
+DB_FOLDER = os.path.expanduser("~/.chromecast-server")
+SNAPSHOT_NAME = "snapshot.json"
+JOURNAL_NAME = "journal.log"
+
+# Write a new snapshot once the journal holds this many records, or when
+# the journal has not been compacted for this many seconds
+JOURNAL_MAX_RECORDS = 10000
+SNAPSHOT_INTERVAL = 60*10
+
+# Collections that are saved.  Each one maps keys to JSON values.
+COLLECTIONS = ["devices","movies","tv","transcode_queue","groups"]
+
+
+## Load the Saved Database
+#
+# Parses the snapshot and replays the journal on top.  A
+# partly written record at the end of the journal (from a crash) is ignored.
+#
+# @param folder - Folder holding the snapshot and journal
+# @return - A dict of collection name to a list of [key, value] pairs, in
+#		the order they were added
+def load(folder):
+	# The snapshot stores each collection as a list of [key, value] pairs
+	# so the order survives without a slow ordered JSON parse
+	snapshot = {}
+	path = os.path.join(folder,SNAPSHOT_NAME)
+	if os.path.exists(path) and os.path.getsize(path) > 0:
+		with open(path,"rb") as f:
+			snapshot = json.loads(f.read())
+
+	# Collect the journal's changes per collection.  A value of None
+	# means the key was deleted.  An update keeps the key's place; only
+	# a new (or re-added) key goes last.
+	changes = dict((name,collections.OrderedDict()) for name in COLLECTIONS)
+	# Keys deleted at some point, which lose their place in the snapshot
+	deleted = dict((name,set()) for name in COLLECTIONS)
+	path = os.path.join(folder,JOURNAL_NAME)
+	if os.path.exists(path):
+		with open(path,"rb") as f:
+			for line in f:
+				try:
+					name,key,value = json.loads(line)
+				except ValueError:
+					# Half written record.  Nothing after it
+					# was written either.
+					break
+				if changes[name].get(key) == None:
+					changes[name].pop(key,None)
+				changes[name][key] = value
+				if value == None:
+					deleted[name].add(key)
+
+	state = {}
+	for name in COLLECTIONS:
+		pairs = snapshot.get(name,[])
+		changed = changes[name]
+		if len(changed) > 0:
+			# Changed keys keep their place, new keys go last
+			merged = []
+			for pair in pairs:
+				key = pair[0]
+				if key in deleted[name]:
+					continue
+				elif key in changed:
+					value = changed.pop(key)
+					if value != None:
+						merged.append([key,value])
+				else:
+					merged.append(pair)
+			for key,value in changed.iteritems():
+				if value != None:
+					merged.append([key,value])
+			pairs = merged
+		state[name] = pairs
+	return state
+
+## Database Journal
+#
+# Collects changes from the Command Center and hands them to a background
+# writer.  Changes to the same key between two flushes are coalesced, so a
+# transcode job that reports progress many times is written once per flush.
+class Journal(object):
+	## Constructor
+	#
+	# @param folder - Folder holding the snapshot and journal
+	def __init__(self,folder):
+		self.folder = folder
+		# (collection, key) -> latest value, in the order changed
+		self.pending = collections.OrderedDict()
+		self.writer = Journal_Writer(folder)
+		self.writer.start()
+
+	## Record a Change
+	#
+	# The value is not serialized until the next flush, so only the
+	# latest version of it is written.  It is written in the place of the
+	# key's first change, so the journal keeps the order keys were added.
+	#
+	# @param name - Collection name
+	# @param key - Key of the changed value
+	# @param value - The new value, or None if it was deleted
+	def record(self,name,key,value):
+		if self.pending.get((name,key)) == None:
+			self.pending.pop((name,key),None)
+		self.pending[(name,key)] = value
+
+	## Flush Pending Changes
+	#
+	# Serializes the pending changes and queues them for the writer.  This
+	# never touches the disk, so it is safe to call from the event loop.
+	def flush(self):
+		if len(self.pending) == 0:
+			return
+		records = []
+		for (name,key),value in self.pending.iteritems():
+			records.append((name,key,json.dumps(value)))
+		self.pending = collections.OrderedDict()
+		self.writer.queue.put(records)
+
+	## Get a Change Listener for a Collection
+	#
+	# @return - A function(key,value) that records changes to the collection
+	def listener(self,name):
+		return lambda key,value: self.record(name,key,value)
+
+	## Write the Pending Changes and Stop the Writer
+	#
+	# Waits for the writer, so nothing is lost when the process exits
+	def close(self):
+		self.flush()
+		self.writer.queue.put(None)
+		self.writer.join()
+
+
+## Journal Writer Thread
+#
+# Appends journal records and writes snapshots.  For the snapshots it keeps
+# its own copy of the database as serialized values.  The copy is read from
+# disk at the first snapshot, not at start up, so a restart only parses the
+# database once (on the main thread).  The Command Center's live objects are
+# never touched from this thread.
+class Journal_Writer(threading.Thread):
+	def __init__(self,folder):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.folder = folder
+		self.queue = Queue.Queue()
+		self.records = 0
+		# Collection name -> (key -> serialized value), or None until
+		# the first snapshot
+		self.state = None
+
+	def run(self):
+		if not os.path.exists(self.folder):
+			os.makedirs(self.folder)
+
+		path = os.path.join(self.folder,JOURNAL_NAME)
+		self.journal = open(path,"ab")
+		while(1):
+			try:
+				records = self.queue.get(timeout=SNAPSHOT_INTERVAL)
+			except Queue.Empty:
+				# Quiet for a while.  Compact what there is.
+				if self.records > 0:
+					self.snapshot()
+				continue
+			# Told to stop
+			if records == None:
+				self.journal.close()
+				return
+			self.append(records)
+			if self.records >= JOURNAL_MAX_RECORDS:
+				self.snapshot()
+
+	## Append Records to the Journal
+	#
+	# @param records - A list of (collection, key, serialized value)
+	def append(self,records):
+		lines = []
+		for name,key,value in records:
+			lines.append("[%s,%s,%s]\n" % (json.dumps(name),
+				json.dumps(key),value))
+			if self.state == None:
+				continue
+			if value == "null":
+				self.state[name].pop(key,None)
+			else:
+				self.state[name][key] = value
+
+		self.journal.write("".join(lines))
+		self.journal.flush()
+		os.fsync(self.journal.fileno())
+		self.records += len(lines)
+
+	## Write a Snapshot and start a new Journal
+	#
+	# The snapshot is written to a temporary file and renamed into place.
+	# If the process dies before the journal is truncated, replaying the
+	# old journal on top of the new snapshot gives the same result.
+	def snapshot(self):
+		if self.state == None:
+			# Every record so far has been written, so the files
+			# hold the whole database
+			self.state = dict((name,collections.OrderedDict())
+					for name in COLLECTIONS)
+			for name,pairs in load(self.folder).iteritems():
+				for key,value in pairs:
+					self.state[name][key] = json.dumps(value)
+
+		path = os.path.join(self.folder,SNAPSHOT_NAME)
+		tmp = path+".tmp"
+		with open(tmp,"wb") as f:
+			parts = []
+			for name in COLLECTIONS:
+				items = ["[%s,%s]" % (json.dumps(key),value)
+					for key,value in self.state[name].iteritems()]
+				parts.append("%s:[%s]" % (json.dumps(name),
+					",".join(items)))
+			f.write("{"+",".join(parts)+"}")
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tmp,path)
+
+		self.journal.close()
+		self.journal = open(os.path.join(self.folder,JOURNAL_NAME),"wb")
+		self.records = 0
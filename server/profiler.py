@@ -0,0 +1,143 @@
+#------------------
+# Sampling Profiler
+#
+# A low overhead profiler that can be turned on in a running process.  A
+# SIGPROF timer interrupts the process every few milliseconds of CPU time and
+# the current stack is counted.  The result is in the collapsed stack format
+# used by flamegraph.pl and speedscope:
+#
+#	main (command_center.py:900);run (event_loop.py:120);... 42
+#
+# Only the main thread is sampled, since that is the one the signal handler
+# runs on.
+#-------------------
+
+import os
+import signal
+import atexit
+
+#-----------------
+# Constants
+#-----------------
+
+# Seconds of CPU time between samples
+PROFILE_INTERVAL = 0.005
+
+# Daemons write their dumps here when told to stop profiling
+PROFILE_DUMP_TMPL = "/tmp/chromecast-profile-%d.folded"
+
+# Signals that start and stop the profiler in a daemon
+START_SIGNAL = signal.SIGUSR1
+STOP_SIGNAL = signal.SIGUSR2
+
+
+## Check a Sampling Interval
+#
+# @return - True if it is a positive number of seconds
+def valid_interval(interval):
+	return isinstance(interval,(int,long,float)) and \
+		not isinstance(interval,bool) and interval > 0
+
+
+## Sampling Profiler
+class Sampler(object):
+	def __init__(self):
+		# Tuple of code objects (outermost first) -> samples
+		self.stacks = {}
+		self.samples = 0
+		self.running = False
+
+	## Start Sampling
+	#
+	# Must be called from the main thread
+	#
+	# @param interval - Seconds of CPU time between samples
+	# @throws ValueError - If the interval is not a positive number
+	def start(self,interval=PROFILE_INTERVAL):
+		if self.running:
+			return
+		if not valid_interval(interval):
+			raise ValueError("Invalid profile interval: %r" % (interval,))
+		self.stacks = {}
+		self.samples = 0
+		signal.signal(signal.SIGPROF,self._sample)
+		# Restart system calls the signal lands in, rather than
+		# failing them with EINTR
+		signal.siginterrupt(signal.SIGPROF,False)
+		try:
+			signal.setitimer(signal.ITIMER_PROF,interval,interval)
+		except signal.ItimerError:
+			signal.signal(signal.SIGPROF,signal.SIG_IGN)
+			raise
+		# Only running once the timer is armed
+		self.running = True
+
+	## Stop Sampling
+	#
+	# @return - The collapsed stacks, one "stack count" line each
+	def stop(self):
+		if self.running:
+			signal.setitimer(signal.ITIMER_PROF,0,0)
+			signal.signal(signal.SIGPROF,signal.SIG_IGN)
+			self.running = False
+		return self.collapsed()
+
+	## Format the Samples as Collapsed Stacks
+	def collapsed(self):
+		names = {}
+		lines = []
+		for stack,count in self.stacks.iteritems():
+			frames = []
+			for code in stack:
+				name = names.get(code)
+				if name == None:
+					name = names[code] = "%s (%s:%d)" % (code.co_name,
+						os.path.basename(code.co_filename),
+						code.co_firstlineno)
+				frames.append(name)
+			lines.append("%s %d" % (";".join(frames),count))
+		lines.sort()
+		return "\n".join(lines)
+
+	## SIGPROF Handler
+	#
+	# Keeps the work to a tuple of code objects.  Names are only built
+	# when the dump is made.
+	def _sample(self,signum,frame):
+		codes = []
+		while frame != None:
+			codes.append(frame.f_code)
+			frame = frame.f_back
+		codes.reverse()
+		key = tuple(codes)
+		self.stacks[key] = self.stacks.get(key,0)+1
+		self.samples += 1
+
+
+## Profiler of this Process
+sampler = Sampler()
+
+## Get the Dump File of a Daemon
+#
+# @param pid - Process ID of the daemon
+def dump_path(pid):
+	return PROFILE_DUMP_TMPL % pid
+
+## Let a Daemon be Profiled with Signals
+#
+# START_SIGNAL starts the profiler and STOP_SIGNAL stops it and writes the
+# collapsed stacks to dump_path(pid).  The Command Center sends these to the
+# daemons it started when profiling is asked for.
+def install_signal_handlers():
+	def start(signum,frame):
+		sampler.start()
+	def stop(signum,frame):
+		text = sampler.stop()
+		with open(dump_path(os.getpid()),"w") as f:
+			f.write(text+"\n")
+	signal.signal(START_SIGNAL,start)
+	signal.signal(STOP_SIGNAL,stop)
+	# A SIGPROF arriving while the interpreter shuts down would kill it
+	atexit.register(sampler.stop)
+	for signum in [START_SIGNAL,STOP_SIGNAL]:
+		signal.siginterrupt(signum,False)
@@ -0,0 +1,198 @@
+#------------------
+# Search Index
+#
+# Incrementally maintained search indexes over a Media_Store.  Titles are
+# split into lowercase words.  Every word goes into an inverted index
+# (word -> paths) and a prefix trie, and each item is filed under a few
+# facets (file extension, codec, transcoded state) so results can be
+# filtered without scanning the library.
+#-------------------
+
+import re
+
+#-----------------
+# Constants
+#-----------------
+
+# Regular expression for the words in a title
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+## Facets an item can be filtered by
+#
+# Maps a facet name to a function that returns the item's value for it
+FACETS = {
+	"ext":lambda item: item["path"].rsplit(".",1)[-1].lower(),
+	"codec":lambda item: item.get("codec"),
+	"transcoded":lambda item: "transcoded" in item
+	}
+
+# Trie key that marks the end of a word.  Words only contain [a-z0-9], so this
+# can never clash with a letter.
+END = None
+
+
+## Split a String into Words
+def tokenize(text):
+	return WORD_RE.findall(text.lower())
+
+
+## Search Index
+#
+# Attach update() to a Media_Store's listeners and the index follows every
+# change to the store.  The index is not built until the first search, so
+# loading a large library at start up does not pay for it.
+class Search_Index(object):
+	## Constructor
+	#
+	# @param store - The Media_Store to index
+	def __init__(self,store):
+		self.store = store
+		# False until the first search builds the index
+		self.built = False
+		# Word -> set of paths
+		self.words = {}
+		# Nested dicts of characters.  END marks the end of a word.
+		self.trie = {}
+		# Facet name -> (value -> set of paths)
+		self.facets = dict((name,{}) for name in FACETS)
+		# Path -> (words, facet values) the item was indexed with, so
+		# it can be removed again
+		self.entries = {}
+
+	def __len__(self):
+		self.build()
+		return len(self.entries)
+
+	## Index every Item in the Store
+	#
+	# Does nothing once the index is built
+	def build(self):
+		if self.built:
+			return
+		self.built = True
+		for path,item in self.store.items.iteritems():
+			self.add(path,item)
+
+	## Store Listener
+	#
+	# Changes before the index is built are picked up by build()
+	#
+	# @param path - Path of the item that changed
+	# @param item - The item, or None if it was removed
+	def update(self,path,item):
+		if not self.built:
+			return
+		self.remove(path)
+		if item != None:
+			self.add(path,item)
+
+	## Index an Item
+	def add(self,path,item):
+		words = set(tokenize(item.get("title") or ""))
+		for word in words:
+			paths = self.words.get(word)
+			if paths == None:
+				paths = self.words[word] = set()
+				self._trie_add(word)
+			paths.add(path)
+
+		values = {}
+		for name,func in FACETS.iteritems():
+			value = func(item)
+			values[name] = value
+			self.facets[name].setdefault(value,set()).add(path)
+
+		self.entries[path] = (words,values)
+
+	## Remove an Item from the Index
+	def remove(self,path):
+		entry = self.entries.pop(path,None)
+		if entry == None:
+			return
+		words,values = entry
+		for word in words:
+			paths = self.words[word]
+			paths.discard(path)
+			if len(paths) == 0:
+				del self.words[word]
+				self._trie_remove(word)
+
+		for name,value in values.iteritems():
+			paths = self.facets[name][value]
+			paths.discard(path)
+			if len(paths) == 0:
+				del self.facets[name][value]
+
+	## Search
+	#
+	# Every word of the query must appear in the title.  The last word only
+	# has to be the start of a title word, so partly typed queries work.
+	#
+	# @param query - Text typed by the user
+	# @param filters - A dict of facet name -> required value
+	# @return - A set of matching paths
+	def search(self,query,filters={}):
+		self.build()
+		sets = []
+		words = tokenize(query)
+		if len(words) > 0:
+			for word in words[:-1]:
+				sets.append(self.words.get(word,set()))
+			if query[-1:].isalnum():
+				sets.append(self.prefix(words[-1]))
+			else:
+				# The last word was finished with a space
+				sets.append(self.words.get(words[-1],set()))
+
+		for name,value in filters.iteritems():
+			if name not in self.facets:
+				raise KeyError(name)
+			sets.append(self.facets[name].get(value,set()))
+
+		# No query and no filters matches everything
+		if len(sets) == 0:
+			return set(self.entries)
+
+		# Intersect starting with the smallest set
+		sets.sort(key=len)
+		return sets[0].intersection(*sets[1:])
+
+	## Find Items with a Word starting with a Prefix
+	#
+	# @return - A set of paths
+	def prefix(self,text):
+		self.build()
+		node = self.trie
+		for c in text:
+			node = node.get(c)
+			if node == None:
+				return set()
+
+		# Collect every word below this node
+		result = set()
+		stack = [(node,text)]
+		while len(stack) > 0:
+			node,word = stack.pop()
+			for c,child in node.iteritems():
+				if c == END:
+					result |= self.words[word]
+				else:
+					stack.append((child,word+c))
+		return result
+
+	def _trie_add(self,word):
+		node = self.trie
+		for c in word:
+			node = node.setdefault(c,{})
+		node[END] = True
+
+	def _trie_remove(self,word):
+		# Walk down, remembering the path, then prune empty nodes
+		nodes = [self.trie]
+		for c in word:
+			nodes.append(nodes[-1][c])
+		del nodes[-1][END]
+		for i in range(len(word)-1,-1,-1):
+			if len(nodes[i+1]) > 0:
+				break
+			del nodes[i][word[i]]
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+
+#----------------------
+# Command Center Tests
+#
+# Each test runs a Command Center on a temporary socket and database
+# folder.  Run with: python -m unittest test_command_center
+#-----------------------
+
+import libcommand_center as libcc
+import command_center
+import persistence
+import ws_proxy
+import profiler
+import metrics
+import asyncore
+import unittest
+import json
+import tempfile
+import shutil
+import socket
+import struct
+import time
+import os
+
+
+## Base of the Tests that need a Command Center
+class Command_Center_Test(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		persistence.DB_FOLDER = self.folder
+		libcc.UNIX_SOCKET_PATH = os.path.join(self.folder,"cc.sock")
+		ws_proxy.CHROMECAST_IP_PORT = ("127.0.0.1",0)
+		self.cc = command_center.Command_Center()
+		self.handler = None
+
+	def tearDown(self):
+		self.cc.journal.close()
+		asyncore.close_all()
+		shutil.rmtree(self.folder)
+
+	## Stop the Command Center and Start a New One on the same Database
+	def restart(self):
+		self.cc.journal.close()
+		asyncore.close_all()
+		self.cc = command_center.Command_Center()
+		self.handler = None
+
+	## Run a Request as if a Client had sent it
+	#
+	# @return - The response, before it is encoded
+	def request(self,req):
+		if self.handler == None:
+			sock,other = socket.socketpair()
+			self.peer = other
+			self.handler = command_center.Update_Handler(sock,self.cc)
+		return self.handler.build_response(req)
+
+
+class Lease_Restart_Test(Command_Center_Test):
+	def setUp(self):
+		Command_Center_Test.setUp(self)
+		queue = self.cc.db["transcode_queue"]
+		queue.add({"path":"/movies/a.mkv","progress":0})
+		queue.add({"path":"/movies/b.mkv","progress":0})
+
+	def test_running_job_keeps_its_worker(self):
+		job = self.cc.lease_job("host:1")
+		self.assertEqual(job["path"],"/movies/a.mkv")
+		self.restart()
+
+		# The running job is not handed out again
+		job = self.cc.lease_job("host:2")
+		self.assertEqual(job["path"],"/movies/b.mkv")
+		self.assertEqual(self.cc.lease_job("host:3"),None)
+
+		# Only the worker it was leased to can report on it
+		self.assertFalse(self.cc.renew_lease("/movies/a.mkv","host:2"))
+		self.assertTrue(self.cc.renew_lease("/movies/a.mkv","host:1"))
+
+	def test_restored_lease_runs_out(self):
+		self.cc.lease_job("host:1")
+		self.restart()
+
+		# The worker did not come back, so the job is requeued
+		self.cc.lease_expired("/movies/a.mkv")
+		job = self.cc.db["transcode_queue"].get("/movies/a.mkv")
+		self.assertEqual(job["worker"],None)
+		self.assertEqual(job["error"],"Lease Expired")
+		job = self.cc.lease_job("host:2")
+		self.assertEqual(job["path"],"/movies/a.mkv")
+		self.assertEqual(job["attempts"],2)
+
+	def test_unleased_jobs_stay_free(self):
+		self.restart()
+		self.assertEqual(self.cc.leases,{})
+
+
+class Fetch_Page_Test(Command_Center_Test):
+	def setUp(self):
+		Command_Center_Test.setUp(self)
+		self.cc.db["movies"].replace([
+			{"path":"/movies/%d.mkv" % i,"title":"Movie %02d" % (9-i)}
+			for i in range(10)])
+
+	## Fetch every Page
+	#
+	# @return - The titles, in the order they were returned
+	def fetch_all(self,**fields):
+		req = dict(source="cli",cmd="fetch",type="movies",**fields)
+		titles = []
+		while(1):
+			resp = self.request(req)
+			self.assertEqual(resp["message"],"OK")
+			titles += [x["title"] for x in resp["data"]]
+			if resp["cursor"] == None:
+				return titles
+			req["cursor"] = resp["cursor"]
+
+	def test_pages_follow_the_sort(self):
+		titles = ["Movie %02d" % i for i in range(10)]
+		self.assertEqual(self.fetch_all(limit=3,sort="title"),titles)
+		titles.reverse()
+		self.assertEqual(self.fetch_all(limit=4,sort="-title"),titles)
+		# Unsorted pages come in the order the movies were added
+		self.assertEqual(self.fetch_all(limit=3),titles)
+
+	def test_fields(self):
+		resp = self.request({"source":"cli","cmd":"fetch","type":"movies",
+			"limit":1,"fields":["title"]})
+		self.assertEqual(resp["data"],[{"title":"Movie 09"}])
+
+	def test_invalid_requests(self):
+		req = {"source":"cli","cmd":"fetch","type":"movies","limit":2}
+		for fields,message in [
+				({"sort":5},"Error - Invalid Sort"),
+				({"sort":"-"},"Error - Invalid Sort"),
+				({"fields":"title"},"Error - Invalid Fields"),
+				({"fields":[1]},"Error - Invalid Fields"),
+				({"limit":0},"Error - Invalid Limit"),
+				({"cursor":"nonsense"},"Error - Invalid Cursor")]:
+			resp = self.request(dict(req,**fields))
+			self.assertEqual(resp["message"],message)
+
+	def test_cursor_needs_the_same_sort(self):
+		req = {"source":"cli","cmd":"fetch","type":"movies","limit":2}
+		cursor = self.request(dict(req,sort="title"))["cursor"]
+		resp = self.request(dict(req,sort="-title",cursor=cursor))
+		self.assertEqual(resp["message"],"Error - Invalid Cursor")
+
+	def test_cursor_from_before_a_restart(self):
+		req = {"source":"cli","cmd":"fetch","type":"movies","limit":2}
+		cursor = self.request(req)["cursor"]
+		self.cc.journal.flush()
+		self.restart()
+		resp = self.request(dict(req,cursor=cursor))
+		self.assertEqual(resp["message"],"Error - Invalid Cursor")
+
+
+class Search_Test(Command_Center_Test):
+	## Search Movies
+	#
+	# @return - The titles found, sorted
+	def search(self,query):
+		resp = self.request({"source":"cli","cmd":"search",
+			"type":"movies","query":query})
+		return sorted(x["title"] for x in resp["data"])
+
+	def test_index_is_built_at_the_first_search(self):
+		movies = self.cc.db["movies"]
+		movies.add({"path":"/movies/a.mkv","title":"Night Road"})
+		self.cc.journal.flush()
+		self.restart()
+		self.assertFalse(self.cc.search["movies"].built)
+
+		# Changes before and after the build are both found
+		movies = self.cc.db["movies"]
+		movies.add({"path":"/movies/b.mkv","title":"Night City"})
+		self.assertEqual(self.search("nig"),["Night City","Night Road"])
+		movies.remove("/movies/a.mkv")
+		movies.add({"path":"/movies/c.mkv","title":"Nightfall"})
+		self.assertEqual(self.search("nig"),["Night City","Nightfall"])
+
+
+## A Chromecast's WebSocket that Keeps what is Sent to it
+class Fake_Device(object):
+	def __init__(self,addr):
+		self.addr = (addr,0)
+		self.write_buffer = ""
+		self.connected = True
+
+	def compresses(self,data):
+		return False
+
+	def writable(self):
+		return False
+
+	## Get the Messages Sent to the Device
+	def messages(self):
+		msgs = []
+		offset = 0
+		while(1):
+			frame = ws_proxy.decode_frame(self.write_buffer,offset)
+			if frame == None:
+				return msgs
+			fin,rsv,opcode,payload,offset = frame
+			msgs.append(json.loads(payload))
+
+
+class Group_Test(Command_Center_Test):
+	## Get the Responses Queued for the Test's Connection
+	def responses(self):
+		decoder = libcc.Frame_Decoder()
+		return decoder.feed("".join(pkt for pkt,droppable in
+			self.handler.out))
+
+	def test_members_are_validated(self):
+		for members in ["1.2.3.4",[1],None]:
+			resp = self.request({"source":"cli","cmd":"group_set",
+				"group":"den","members":members})
+			self.assertEqual(resp["message"],"Error - Invalid Members")
+		self.assertEqual(self.cc.db["groups"],{})
+
+	def test_duplicate_members(self):
+		resp = self.request({"source":"cli","cmd":"group_set",
+			"group":"den","members":["10.0.0.2","10.0.0.3","10.0.0.2"]})
+		self.assertEqual(resp["message"],"OK")
+		self.assertEqual(self.cc.db["groups"]["den"]["members"],
+			["10.0.0.2","10.0.0.3"])
+
+		devices = [Fake_Device("10.0.0.2"),Fake_Device("10.0.0.3")]
+		for ws in devices:
+			self.cc.add_websocket(ws.addr[0],ws)
+		resp = self.request({"source":"cli","cmd":"play_pause",
+			"group":"den","id":7})
+		self.assertEqual(resp["message"],None)
+
+		# Once each member answers, the response goes out without
+		# waiting for the deadline
+		for ws in devices:
+			msgs = ws.messages()
+			self.assertEqual(len(msgs),1)
+			self.cc.websocket_message(ws.addr[0],{"corr_id":
+				msgs[0]["corr_id"],"status":"ok"})
+		responses = self.responses()
+		self.assertEqual(len(responses),1)
+		self.assertEqual(responses[0]["message"],"OK")
+		self.assertEqual(sorted(responses[0]["data"]),
+			["10.0.0.2","10.0.0.3"])
+
+
+class Profile_Test(Command_Center_Test):
+	def tearDown(self):
+		profiler.sampler.stop()
+		Command_Center_Test.tearDown(self)
+
+	def test_invalid_interval(self):
+		for interval in [0,-1,"fast",True,None,1e300]:
+			resp = self.request({"source":"cli","cmd":"profile_start",
+				"interval":interval})
+			self.assertEqual(resp["message"],"Error - Invalid Interval")
+			self.assertFalse(profiler.sampler.running)
+
+	def test_start_and_stop(self):
+		resp = self.request({"source":"cli","cmd":"profile_start",
+			"interval":0.001})
+		self.assertEqual(resp["message"],"OK")
+		self.assertTrue(profiler.sampler.running)
+		resp = self.request({"source":"cli","cmd":"profile_start"})
+		self.assertEqual(resp["message"],"Error - Profiler Already Running")
+
+		# Burn some CPU time so there is something to sample
+		end = time.time()+0.1
+		while time.time() < end:
+			pass
+		resp = self.request({"source":"cli","cmd":"profile_stop"})
+		self.assertEqual(resp["message"],"OK")
+		self.assertFalse(profiler.sampler.running)
+		self.assertTrue(resp["samples"] > 0)
+		self.assertTrue("test_start_and_stop" in resp["data"])
+
+
+class Encoding_Test(Command_Center_Test):
+	def test_negotiated_compact_responses(self):
+		resp = self.request({"cmd":"hello","encodings":["bogus","compact",
+			"json"]})
+		self.assertEqual(resp["encoding"],"compact")
+
+		movies = [{"path":"/movies/%d.mkv" % i,"title":"Movie %d" % i}
+			for i in range(50)]
+		self.cc.db["movies"].replace(movies)
+		self.handler.prepare_response({"source":"cli","cmd":"fetch",
+			"type":"movies","id":3})
+		pkt = self.handler.out[0][0]
+		header = struct.unpack("<I",pkt[:4])[0]
+		self.assertTrue(header & libcc.COMPACT_FLAG)
+		resp = libcc.Frame_Decoder().feed(pkt)[0]
+		self.assertEqual((resp["id"],resp["data"]),(3,movies))
+
+	def test_unknown_encodings_stay_on_json(self):
+		resp = self.request({"cmd":"hello","encodings":["bogus"]})
+		self.assertEqual(resp["encoding"],"json")
+
+
+class Batch_Test(Command_Center_Test):
+	def test_errors_stay_with_their_request(self):
+		resp = self.request({"source":"cli","cmd":"batch","requests":[
+			{"cmd":"fetch","type":"devices"},
+			{"cmd":"fetch","type":"movies","limit":0},
+			{"cmd":"status","addr":"10.0.0.2"},
+			{"source":"nobody","cmd":"fetch"},
+			5,
+			{"cmd":"conv_status"}]})
+		self.assertEqual(resp["message"],"OK")
+		messages = [r["message"] for r in resp["data"]]
+		self.assertEqual(messages[0],"OK")
+		self.assertEqual(messages[1],"Error - Invalid Limit")
+		self.assertEqual(messages[2],
+			"Error - ValueError('Chromecast commands cannot be batched',)")
+		self.assertEqual(messages[3],"Source is invalid")
+		self.assertTrue(messages[4].startswith("Error - TypeError"))
+		# The requests after the errors still ran
+		self.assertEqual(messages[5],"OK")
+		self.assertEqual(resp["data"][5]["data"],[])
+
+	def test_invalid_batch(self):
+		resp = self.request({"source":"cli","cmd":"batch"})
+		self.assertEqual(resp["message"],"Error - No Requests Given")
+		resp = self.request({"source":"cli","cmd":"batch","requests":5})
+		self.assertEqual(resp["message"],"Error - Invalid Requests")
+
+
+class Version_Test(Command_Center_Test):
+	## Fetch a Collection
+	def fetch(self,kind,version=None):
+		req = {"source":"cli","cmd":"fetch","type":kind}
+		if version != None:
+			req["if_version"] = version
+		return self.request(req)
+
+	## Report a Scan
+	def scan(self,movies):
+		self.request({"source":"scanner","movies":movies,"tv":[]})
+
+	def test_not_modified(self):
+		movies = [{"path":"/movies/a.mkv","title":"A"}]
+		self.scan(movies)
+		resp = self.fetch("movies")
+		self.assertEqual(resp["message"],"OK")
+		version = resp["version"]
+
+		resp = self.fetch("movies",version)
+		self.assertEqual(resp["message"],"Not Modified")
+		self.assertEqual(resp["version"],version)
+		self.assertFalse("data" in resp)
+
+		# The same scan again changes nothing
+		self.scan([dict(m) for m in movies])
+		self.assertEqual(self.fetch("movies",version)["message"],
+			"Not Modified")
+
+		# A real change does
+		self.scan(movies+[{"path":"/movies/b.mkv","title":"B"}])
+		resp = self.fetch("movies",version)
+		self.assertEqual(resp["message"],"OK")
+		self.assertNotEqual(resp["version"],version)
+
+	## Report the Devices Found
+	def discover(self,name):
+		self.request({"source":"discoverer","devices":[{"ip":"10.0.0.2",
+			"name":name}]})
+
+	def test_devices(self):
+		self.discover("Den")
+		version = self.fetch("devices")["version"]
+		self.discover("Den")
+		self.assertEqual(self.fetch("devices",version)["message"],
+			"Not Modified")
+		self.discover("Living Room")
+		self.assertEqual(self.fetch("devices",version)["message"],"OK")
+
+	def test_encoded_once_per_version(self):
+		self.scan([{"path":"/movies/a.mkv","title":"A"}])
+		first = self.fetch("movies")["data"]
+		self.assertTrue(self.fetch("movies")["data"] is first)
+
+	def test_version_changes_with_a_restart(self):
+		version = self.fetch("movies")["version"]
+		self.restart()
+		self.assertEqual(self.fetch("movies",version)["message"],"OK")
+
+
+class Stats_Test(Command_Center_Test):
+	def test_unknown_labels_are_collapsed(self):
+		self.request({"source":"cli","cmd":"stats"})
+		# Timed in prepare_response, so go through it
+		for i in range(20):
+			self.handler.prepare_response({"source":"src%d" % i,
+				"cmd":"cmd%d" % i})
+		resp = self.request({"source":"cli","cmd":"stats"})
+		series = resp["data"]["cc_request_seconds"]
+		self.assertTrue("source=other,cmd=other" in series)
+		self.assertFalse([k for k in series if "src" in k or "cmd=cmd" in k])
+
+	def test_queue_gauges_follow_the_current_command_center(self):
+		self.restart()
+		self.cc.db["transcode_queue"].add({"path":"/movies/a.mkv",
+			"queued":0})
+		data = self.request({"source":"cli","cmd":"stats"})["data"]
+		self.assertEqual(data["cc_transcode_queue_length"],1)
+		self.assertTrue(data["cc_transcode_queue_oldest_seconds"] > 0)
+		# Registered once, however many Command Centers were made
+		names = [m.name for m in metrics.REGISTRY.metrics]
+		self.assertEqual(len(names),len(set(names)))
+
+
+if __name__ == "__main__":
+	unittest.main()
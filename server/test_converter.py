@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+#----------------------
+# Converter Tests
+#
+# Segmented transcodes run against stub encoder and prober scripts, so no
+# real avconv is needed.  Run with: python -m unittest test_converter
+#-----------------------
+
+import multiprocessing
+import converter
+import unittest
+import tempfile
+import shutil
+import stat
+import sys
+import os
+
+#-----------------
+# Stubs
+#-----------------
+
+# Prints a video keyframe every 2 seconds of a 30 second title
+STUB_AVPROBE = """
+for i in range(15):
+	print "[PACKET]"
+	print "codec_type=video"
+	print "pts_time=%d.000000" % (i*2)
+	print "flags=K_"
+	print "[/PACKET]"
+"""
+
+# Joins a concat list, or "encodes" a segment into a line recording its
+# start, length, threads, and when it ran.  Earlier segments take longer,
+# so they finish last.
+STUB_AVCONV = """
+import sys,time,os
+args = sys.argv[1:]
+out = args[-1]
+if "concat" in args:
+	listfile = args[args.index("-i")+1]
+	with open(out,"w") as f:
+		for line in open(listfile):
+			name = line.split("'")[1]
+			f.write(open(os.path.join(os.path.dirname(listfile),name)).read())
+	sys.exit(0)
+start = float(args[args.index("-ss")+1])
+length = float(args[args.index("-t")+1])
+threads = args[args.index("-threads")+1]
+began = time.time()
+sys.stderr.write("frame=  1 time=%.2f \\r" % length)
+time.sleep(0.1+(30-start)/60.0)
+with open(out,"w") as f:
+	f.write("%s %s %s %f %f\\n" % (start,length,threads,began,time.time()))
+"""
+
+
+## Write an Executable Python Script
+def write_script(path,body):
+	with open(path,"w") as f:
+		f.write("#!%s\n%s" % (sys.executable,body))
+	os.chmod(path,os.stat(path).st_mode | stat.S_IXUSR)
+
+
+class Segmented_Transcode_Test(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.saved = dict((name,getattr(converter,name)) for name in
+			["AVCONV","AVPROBE","SEGMENT_SECONDS","SEGMENT_PROCESSES",
+			"WORKERS","report_progress"])
+		converter.AVCONV = os.path.join(self.folder,"avconv")
+		converter.AVPROBE = os.path.join(self.folder,"avprobe")
+		write_script(converter.AVCONV,STUB_AVCONV)
+		write_script(converter.AVPROBE,STUB_AVPROBE)
+		converter.SEGMENT_SECONDS = 5
+		# Keep the Command Center out of it
+		converter.report_progress = lambda *args: True
+
+	def tearDown(self):
+		for name,value in self.saved.iteritems():
+			setattr(converter,name,value)
+		shutil.rmtree(self.folder)
+
+	## Transcode the Title
+	#
+	# @return - (start, length, threads, began, ended) of each segment, in
+	#		the order they were joined
+	def transcode(self):
+		outfile = os.path.join(self.folder,"out.mp4")
+		ret_code = converter.segmented_repackage("in.mkv",outfile,30.0)
+		self.assertEqual(ret_code,0)
+		self.assertFalse(os.path.exists(outfile+".parts"))
+		segments = []
+		for line in open(outfile):
+			start,length,threads,began,ended = line.split()
+			segments.append((float(start),float(length),int(threads),
+				float(began),float(ended)))
+		return segments
+
+	def test_split_at_keyframes(self):
+		self.assertEqual(converter.split_segments(range(0,30,2),30.0,5),
+			[(0.0,6),(6,12),(12,18),(18,24),(24,30.0)])
+		# Too short to split
+		self.assertEqual(converter.split_segments([0,2,4],6.0,5),
+			[(0.0,6.0)])
+
+	def test_segments_run_at_once_and_join_in_order(self):
+		converter.SEGMENT_PROCESSES = 3
+		segments = self.transcode()
+		self.assertEqual([s[:2] for s in segments],
+			[(0,6),(6,6),(12,6),(18,6),(24,6)])
+		# The first three ran together, and the first finished after
+		# the second but was still joined first
+		began = max(s[3] for s in segments[:3])
+		self.assertTrue(began < min(s[4] for s in segments[:3]))
+		self.assertTrue(segments[0][4] > segments[1][4])
+
+	def test_full_transcode_uses_threads_per_job(self):
+		saved = converter.THREADS_PER_JOB
+		converter.THREADS_PER_JOB = 8
+		try:
+			args = converter.video_audio_codecs()
+		finally:
+			converter.THREADS_PER_JOB = saved
+		self.assertEqual(args[args.index("-threads")+1],"8")
+
+	def test_pool_uses_the_jobs_share_of_cores(self):
+		cores = multiprocessing.cpu_count()
+		converter.WORKERS = cores*2
+		self.assertEqual(converter.job_cores(),1)
+		converter.WORKERS = 1
+		self.assertEqual(converter.job_cores(),cores)
+
+		# One core per segment when the pool size is left to default
+		converter.WORKERS = cores
+		self.assertEqual([s[2] for s in self.transcode()],[1]*5)
+		# A smaller pool splits the job's cores between its encoders
+		converter.WORKERS = 1
+		converter.SEGMENT_PROCESSES = 1
+		self.assertEqual([s[2] for s in self.transcode()],[cores]*5)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+#----------------------
+# Command Center Client Library Tests
+#
+# Run with: python -m unittest test_libcommand_center
+#-----------------------
+
+import libcommand_center as libcc
+import threading
+import unittest
+import tempfile
+import shutil
+import socket
+import os
+
+
+## A Server that Hangs up on every Request
+#
+# Counts the requests it was sent
+class Hang_Up_Server(threading.Thread):
+	def __init__(self,path):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+		self.sock.bind(path)
+		self.sock.listen(5)
+		self.requests = 0
+
+	def run(self):
+		while(1):
+			try:
+				conn,addr = self.sock.accept()
+			except socket.error:
+				return
+			decoder = libcc.Frame_Decoder()
+			while(1):
+				data = conn.recv(libcc.READ_SIZE)
+				msgs = decoder.feed(data)
+				if data == "" or len(msgs) > 0:
+					break
+			self.requests += len(msgs)
+			conn.close()
+
+
+class Client_Test(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder,"cc.sock")
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def test_request_that_drops_the_connection_gives_up(self):
+		server = Hang_Up_Server(self.path)
+		server.start()
+		client = libcc.CC_Client(self.path,encoding=libcc.ENCODING_JSON)
+		resp = client.request({"source":"cli","cmd":"fetch","sort":5})
+		self.assertEqual(resp["message"],"Error - Connection Lost")
+		self.assertEqual(server.requests,libcc.MAX_SENDS)
+		self.assertEqual(client.pending,{})
+		self.assertEqual(client.sends,{})
+		client.close()
+		server.sock.close()
+
+
+class Frame_Decoder_Test(unittest.TestCase):
+	def test_packet_split_across_reads(self):
+		pkt = libcc.json_to_pkt({"cmd":"fetch","type":"movies"})
+		decoder = libcc.Frame_Decoder()
+		# Split inside the header, then inside the payload
+		self.assertEqual(decoder.feed(pkt[:2]),[])
+		self.assertEqual(decoder.feed(pkt[2:9]),[])
+		self.assertEqual(len(decoder),9)
+		self.assertEqual(decoder.feed(pkt[9:]),
+			[{"cmd":"fetch","type":"movies"}])
+		self.assertEqual(len(decoder),0)
+
+	def test_pipelined_packets_in_one_read(self):
+		msgs = [{"id":i} for i in range(5)]
+		data = "".join(libcc.json_to_pkt(m) for m in msgs)
+		decoder = libcc.Frame_Decoder()
+		# Every complete packet comes out, and the partial one waits
+		self.assertEqual(decoder.feed(data[:-3]),msgs[:4])
+		self.assertEqual(decoder.feed(data[-3:]),msgs[4:])
+
+	def test_byte_at_a_time(self):
+		msgs = [{"id":1},{"id":2,"data":u"caf\xe9"}]
+		data = "".join(libcc.json_to_pkt(m) for m in msgs)
+		decoder = libcc.Frame_Decoder()
+		out = []
+		for c in data:
+			out += decoder.feed(c)
+		self.assertEqual(out,msgs)
+
+
+class Compact_Encoding_Test(unittest.TestCase):
+	## Encode a Message as a Compact Packet and Decode it again
+	def round_trip(self,msg):
+		pkt = libcc.json_to_pkt(msg,libcc.ENCODING_COMPACT)
+		self.assertEqual(libcc.pkt_to_json(pkt),(msg,len(pkt)))
+		self.assertEqual(libcc.Frame_Decoder().feed(pkt),[msg])
+		return pkt
+
+	def test_round_trip(self):
+		movies = [{"path":"/movies/%d.mkv" % i,"title":u"Movie %d" % i,
+			"transcoded":i % 2 == 0} for i in range(200)]
+		# Items with different keys, nested tables, and plain lists
+		movies[5] = {"path":"/movies/5.mkv","tags":["a","b"],
+			"files":[{"name":"x"},{"name":"y","size":2}]}
+		msg = {"source":"command_center","message":"OK","data":movies,
+			"empty":[],"nested":[[1,2],[]],"text":u"caf\xe9"}
+		pkt = self.round_trip(msg)
+		# Interned keys make it much smaller than plain JSON
+		self.assertTrue(len(pkt) < len(libcc.json_to_pkt(msg))/4)
+
+	def test_lists_that_look_like_markers(self):
+		self.round_trip({"data":[libcc.TABLE_TAG,[],[]]})
+		self.round_trip({"data":[libcc.LIST_TAG,1]})
+		self.round_trip({"data":[u"\x00other"]})
+
+	def test_pre_encoded_data(self):
+		data = [{"path":"/movies/a.mkv","title":"A"}]
+		encoded = libcc.encode_data(data,libcc.ENCODING_COMPACT)
+		pkt = libcc.json_to_pkt({"message":"OK","data":encoded},
+			libcc.ENCODING_COMPACT)
+		self.assertEqual(libcc.Frame_Decoder().feed(pkt),
+			[{"message":"OK","data":data}])
+
+
+if __name__ == "__main__":
+	unittest.main()
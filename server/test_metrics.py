@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+#----------------------
+# Metrics Tests
+#
+# Run with: python -m unittest test_metrics
+#-----------------------
+
+import metrics
+import unittest
+
+
+class Metrics_Test(unittest.TestCase):
+	def setUp(self):
+		self.registry = metrics.Registry()
+
+	def test_counter_per_label(self):
+		c = self.registry.counter("test_total","Test",["source"])
+		c.inc(1,"cli")
+		c.inc(2,"cli")
+		c.inc(1,"webui")
+		self.assertEqual(c.to_json(),{"source=cli":3,"source=webui":1})
+
+	def test_gauge_function(self):
+		g = self.registry.gauge("test_length","Test")
+		self.assertEqual(g.to_json(),None)
+		g.func = lambda: {():7}
+		self.assertEqual(g.to_json(),7)
+
+	def test_histogram_quantiles(self):
+		h = self.registry.histogram("test_seconds","Test",buckets=[1,2,4])
+		for value in [0.5]*98+[3,10]:
+			h.observe(value)
+		self.assertEqual(h.quantile(0.5),1)
+		self.assertEqual(h.quantile(0.99),4)
+		# Past the last bucket, the largest value is used
+		self.assertEqual(h.quantile(1.0),10)
+		value = h.to_json()
+		self.assertEqual((value["count"],value["max"]),(100,10))
+
+	def test_prometheus_text(self):
+		c = self.registry.counter("test_total","Test",["addr"])
+		c.inc(1,'a"b\\c')
+		h = self.registry.histogram("test_seconds","Test",buckets=[1])
+		h.observe(0.5)
+		h.observe(2)
+		lines = self.registry.to_prometheus().splitlines()
+		self.assertEqual(lines[:3],["# HELP test_total Test",
+			"# TYPE test_total counter",
+			'test_total{addr="a\\"b\\\\c"} 1.0'])
+		self.assertTrue('test_seconds_bucket{le="1"} 1' in lines)
+		self.assertTrue('test_seconds_bucket{le="+Inf"} 2' in lines)
+		self.assertTrue("test_seconds_count 2" in lines)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -10,10 +10,12 @@
 # Imported Modules
 #-------------------
 import asyncore,socket
-import re,hashlib,base64,struct
+import hashlib,base64,struct
 import os,time
-import json
+import json,zlib
 import libcommand_center as libcc
+import event_loop
+import metrics
 
 #-----------------
 # Constants
@@ -26,9 +28,337 @@ HANDSHAKE_RESPONSE_TMPL="""HTTP/1.1 101 Switching Protocols\r
 Upgrade: websocket\r
 Connection: Upgrade\r
 Sec-WebSocket-Accept: {0}\r
-\r
+{1}\r
 """
 
+# WebSocket opcodes
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# Largest payload a control frame may carry (RFC 6455, section 5.5)
+MAX_CONTROL_PAYLOAD = 125
+
+# Connections the kernel may hold waiting to be accepted.  With a short
+# queue, Chromecasts that reconnect together (after a restart, say) have
+# their connections dropped and retried seconds later.
+LISTEN_BACKLOG = 128
+
+# Reply to a request that is not a WebSocket handshake
+HANDSHAKE_ERROR = "HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n"
+
+# Largest handshake and frame accepted from a device
+MAX_HANDSHAKE_SIZE = 8192
+MAX_FRAME_SIZE = 16*1024*1024
+
+# Bytes requested from a socket per read
+READ_SIZE = 65536
+
+# WS_Handler parser states
+STATE_HANDSHAKE = "handshake"
+STATE_OPEN = "open"
+STATE_CLOSING = "closing"
+
+# Close status codes
+CLOSE_PROTOCOL_ERROR = struct.pack("!H",1002)
+CLOSE_TOO_BIG = struct.pack("!H",1009)
+
+# Set in the first frame of a compressed message
+RSV1 = 0x40
+
+# permessage-deflate: window bits the server compresses with (9 to 15), or 0
+# to turn compression off
+DEFLATE_WINDOW_BITS = 15
+# Messages shorter than this are sent uncompressed
+DEFLATE_THRESHOLD = 128
+# Keep the compression context from one message to the next.  Repeated
+# status messages then compress to a few bytes.
+DEFLATE_CONTEXT_TAKEOVER = True
+# Every flushed deflate block ends with this.  It is left off the wire.
+DEFLATE_TAIL = "\x00\x00\xff\xff"
+# Parameters a permessage-deflate offer may have
+DEFLATE_PARAMS = ["server_no_context_takeover","client_no_context_takeover",
+	"server_max_window_bits","client_max_window_bits"]
+
+# Seconds a device may be silent before it is pinged (0 turns pings off),
+# and seconds it then has to answer before it is dropped
+PING_INTERVAL = 15
+PONG_TIMEOUT = 5
+# The keepalive timer wheel: seconds per tick, and ticks per turn
+KEEPALIVE_TICK = 1.0
+KEEPALIVE_SLOTS = 64
+
+# Values of a message's "type" field that mark a player status update
+STATUS_TYPES = ["status"]
+
+# Traffic of each device.  "payload" counts message bytes before
+# compression, "wire" counts bytes sent or received on the socket.
+WS_PAYLOAD_BYTES = metrics.REGISTRY.counter("cc_websocket_payload_bytes_total",
+	"WebSocket message bytes before compression",["addr","direction"])
+WS_WIRE_BYTES = metrics.REGISTRY.counter("cc_websocket_wire_bytes_total",
+	"WebSocket bytes sent or received on the socket",["addr","direction"])
+WS_DEFLATE_SECONDS = metrics.REGISTRY.counter(
+	"cc_websocket_deflate_seconds_total",
+	"Time spent compressing and decompressing WebSocket messages",
+	["addr","direction"])
+WS_PING_SECONDS = metrics.REGISTRY.histogram("cc_websocket_ping_seconds",
+	"Time for a device to answer a keepalive ping")
+WS_DEAD_PEERS = metrics.REGISTRY.counter("cc_websocket_dead_peers_total",
+	"Devices dropped for not answering a keepalive ping")
+
+#-----------------
+# Frame Codec
+#-----------------
+
+# Translation tables that XOR every byte with a key, built when first used
+_xor_tables = [None]*256
+
+## Get the Translation Table that XORs a Byte with a Key
+def _xor_table(key):
+	table = _xor_tables[key]
+	if table == None:
+		table = _xor_tables[key] = "".join(chr(i^key) for i in range(256))
+	return table
+
+## Unmask a WebSocket Payload
+#
+# Every fourth byte is XORed with the same mask byte, so each of the four
+# strided slices is unmasked with one str.translate call.  This runs at C
+# speed instead of one Python operation per byte.
+#
+# @param mask - The 4 byte masking key
+# @param data - The masked payload
+# @return - The unmasked payload
+def unmask(mask,data):
+	out = bytearray(data)
+	for i in range(4):
+		out[i::4] = data[i::4].translate(_xor_table(ord(mask[i])))
+	return str(out)
+
+## Encode a WebSocket Frame
+#
+# Frames sent by the server are not masked.
+#
+# @param data - The payload
+# @param opcode - One of the OP_ constants
+# @param fin - False if more fragments of the message follow
+# @param rsv - Reserved bits, RSV1 for a compressed message
+# @return - The frame as a string
+def encode_frame(data,opcode=OP_TEXT,fin=True,rsv=0):
+	first = opcode | rsv | (0x80 if fin else 0)
+	size = len(data)
+	if size < 126:
+		header = struct.pack("!BB",first,size)
+	elif size < 0x10000:
+		header = struct.pack("!BBH",first,126,size)
+	else:
+		header = struct.pack("!BBQ",first,127,size)
+	return header+data
+
+## Decode a WebSocket Frame
+#
+# @param buf - Received data
+# @param offset - Where the frame starts in buf
+# @return - (fin, rsv, opcode, payload, offset after the frame), or None if
+#		the whole frame has not arrived yet
+# @throws ValueError - If the frame is larger than MAX_FRAME_SIZE
+def decode_frame(buf,offset=0):
+	if len(buf)-offset < 2:
+		return None
+	first,second = struct.unpack_from("!BB",buf,offset)
+	fin = (first & 0x80) != 0
+	rsv = first & 0x70
+	opcode = first & 0x0F
+	masked = (second & 0x80) != 0
+	size = second & 0x7F
+	index = offset+2
+
+	# Sizes 126 and 127 mean a 16 or 64 bit length follows
+	if size == 126:
+		if len(buf)-index < 2:
+			return None
+		size = struct.unpack_from("!H",buf,index)[0]
+		index += 2
+	elif size == 127:
+		if len(buf)-index < 8:
+			return None
+		size = struct.unpack_from("!Q",buf,index)[0]
+		index += 8
+	if size > MAX_FRAME_SIZE:
+		raise ValueError("WebSocket frame too large: %d bytes" % size)
+
+	mask = None
+	if masked:
+		if len(buf)-index < 4:
+			return None
+		mask = str(buf[index:index+4])
+		index += 4
+
+	if len(buf)-index < size:
+		return None
+	payload = str(buf[index:index+size])
+	if mask != None:
+		payload = unmask(mask,payload)
+	return (fin,rsv,opcode,payload,index+size)
+
+## Check if a Device Message is a Status Update
+#
+# Only the newest status update of a device is worth keeping
+def is_status(msg):
+	return isinstance(msg,dict) and msg.get("type") in STATUS_TYPES
+
+## Send one Message to many Devices
+#
+# The message is serialized once, and framed once for all the devices that
+# do not compress it.  Every frame is queued before any is written, then
+# each socket is written right away rather than on the next loop pass, so
+# the devices get the message within moments of each other.
+#
+# @param handlers - The WS_Handlers to send to
+# @param msg - A JSON object
+# @return - Seconds between the first write and the last
+def broadcast(handlers,msg):
+	data = json.dumps(msg)
+	frame = None
+	for ws in handlers:
+		if ws.compresses(data):
+			# Each connection has its own compression context
+			ws.write_buffer += ws.ws_encode(data)
+			continue
+		if frame == None:
+			frame = encode_frame(data)
+		WS_PAYLOAD_BYTES.inc(len(data),ws.addr[0],"out")
+		ws.write_buffer += frame
+
+	start = time.time()
+	for ws in handlers:
+		# A socket that failed closes itself, and any before it may have
+		if ws.connected and ws.writable():
+			ws.handle_write()
+	return time.time()-start
+
+#-----------------
+# permessage-deflate (RFC 7692)
+#-----------------
+
+## Parse a Sec-WebSocket-Extensions Header
+#
+# @param header - The header value, such as
+#		"permessage-deflate; client_max_window_bits, x-webkit-deflate-frame"
+# @return - A list of (extension name, dict of parameters), in the order
+#		they were offered.  Parameters without a value map to None.
+def parse_extensions(header):
+	offers = []
+	for offer in header.split(","):
+		parts = [part.strip() for part in offer.split(";")]
+		if parts[0] == "":
+			continue
+		params = {}
+		for part in parts[1:]:
+			if "=" in part:
+				name,value = part.split("=",1)
+				params[name.strip().lower()] = value.strip().strip('"')
+			elif part != "":
+				params[part.lower()] = None
+		offers.append((parts[0].lower(),params))
+	return offers
+
+## Check a max_window_bits Value
+#
+# @return - The window bits, or None if the value is not valid
+def _window_bits(value):
+	try:
+		bits = int(value)
+	except (TypeError,ValueError):
+		return None
+	if bits < 8 or bits > 15:
+		return None
+	return bits
+
+## Accept a permessage-deflate Offer
+#
+# Takes the first offer this server can honour.
+#
+# @param offers - The list from parse_extensions()
+# @return - (Deflate, Sec-WebSocket-Extensions response value), or
+#		(None, None) if compression is off or nothing could be accepted
+def negotiate_deflate(offers):
+	if DEFLATE_WINDOW_BITS == 0:
+		return (None,None)
+	for name,params in offers:
+		if name != "permessage-deflate":
+			continue
+		if len([p for p in params if p not in DEFLATE_PARAMS]) > 0:
+			continue
+		# The client may only offer a value for its own window
+		value = params.get("client_max_window_bits")
+		if value != None and _window_bits(value) == None:
+			continue
+
+		# The client may limit the window the server compresses with.
+		# zlib cannot write raw deflate with an 8 bit window.
+		bits = DEFLATE_WINDOW_BITS
+		if "server_max_window_bits" in params:
+			limit = _window_bits(params["server_max_window_bits"])
+			if limit == None or limit < 9:
+				continue
+			bits = min(bits,limit)
+		takeover = DEFLATE_CONTEXT_TAKEOVER and \
+			"server_no_context_takeover" not in params
+
+		response = ["permessage-deflate"]
+		if not takeover:
+			response.append("server_no_context_takeover")
+		if bits != 15 or "server_max_window_bits" in params:
+			response.append("server_max_window_bits=%d" % bits)
+		return (Deflate(bits,takeover,DEFLATE_THRESHOLD),"; ".join(response))
+	return (None,None)
+
+
+## permessage-deflate Compression State of one Connection
+class Deflate(object):
+	## Constructor
+	#
+	# @param window_bits - Window the server compresses with
+	# @param context_takeover - Keep the compression context between
+	#		messages
+	# @param threshold - Messages shorter than this are not compressed
+	def __init__(self,window_bits,context_takeover,threshold):
+		self.window_bits = window_bits
+		self.context_takeover = context_takeover
+		self.threshold = threshold
+		self.compressor = None
+		# A 15 bit window can inflate anything the client sends, and
+		# keeping the context works whether or not the client resets its
+		# own
+		self.decompressor = zlib.decompressobj(-15)
+
+	## Compress one Message
+	#
+	# @return - The payload of the message's frame
+	def compress(self,data):
+		if self.compressor == None:
+			self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+				zlib.DEFLATED,-self.window_bits)
+		data = self.compressor.compress(data)+\
+			self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		if not self.context_takeover:
+			self.compressor = None
+		# A sync flush always ends with DEFLATE_TAIL
+		return data[:-len(DEFLATE_TAIL)]
+
+	## Decompress one Message
+	#
+	# @throws ValueError - If the message is larger than MAX_FRAME_SIZE
+	# @throws zlib.error - If the data is not valid
+	def decompress(self,data):
+		data = self.decompressor.decompress(data+DEFLATE_TAIL,MAX_FRAME_SIZE)
+		if len(self.decompressor.unconsumed_tail) > 0:
+			raise ValueError("WebSocket message too large")
+		return data
 
 
 ## Async WebSocket Server
@@ -43,12 +373,20 @@ class WS_Server(asyncore.dispatcher):
 		# Create a TCP socket and listen to the WS port
 		asyncore.dispatcher.__init__(self)
 		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		# Allow a restart while old connections are in TIME_WAIT
+		self.set_reuse_addr()
 		self.bind(CHROMECAST_IP_PORT)
-		self.listen(5)
+		self.listen(LISTEN_BACKLOG)
 
 		# Save a copy of the Command Center Reference
 		self.command_center = cc
 
+		# One wheel times the keepalives of every connection
+		self.keepalive = None
+		if PING_INTERVAL > 0:
+			self.keepalive = event_loop.Timer_Wheel(KEEPALIVE_TICK,
+				KEEPALIVE_SLOTS,WS_Handler.check_alive)
+
 	## Handle New Connection
 	#
 	# When a new connection is attempted, this method handles it.  It creates
@@ -58,7 +396,8 @@ class WS_Server(asyncore.dispatcher):
 	def handle_accept(self):
 		sock, addr = self.accept()
 		# Create a WS handler from the connection socket
-		ws_sock = WS_Handler(sock,self.command_center.remove_websocket)
+		ws_sock = WS_Handler(sock,self.command_center.remove_websocket,
+				self.command_center.websocket_message,self.keepalive)
 		# Add this new socket to the Command Center Database
 		self.command_center.add_websocket(addr[0], ws_sock)
 
@@ -75,17 +414,34 @@ class WS_Handler(asyncore.dispatcher):
 	# @param db_remove - A reference to a function that removes a ws
 	# from the database.  This allows the WS to nicely erase itself 
 	# from the database
-	def __init__(self,sock,db_remove):
+	# @param on_message - Optional function called with the device
+	# address and each message received from it
+	# @param keepalive - Optional Timer_Wheel that pings the device when
+	# it goes quiet
+	def __init__(self,sock,db_remove,on_message=None,keepalive=None):
 		# Forward the new socket to the Super-class
 		asyncore.dispatcher.__init__(self,sock)
 		# Create a Read/Write buffer
 		self.write_buffer = ""
-		self.read_buffer = ""
-		# Create place to keep Recived packets that have not yet been
-		# read by the Command Center
-		self.inbox = []
+		self.read_buffer = bytearray()
+		# Parser state: STATE_HANDSHAKE, STATE_OPEN, or STATE_CLOSING
+		self.state = STATE_HANDSHAKE
+		# Fragments of a message that has not been finished yet, and
+		# the opcode of its first frame
+		self.fragments = []
+		self.fragment_opcode = None
+		self.fragment_rsv = 0
+		# Deflate state, once permessage-deflate has been negotiated
+		self.deflate = None
+		# Time the last pong arrived, the last data of any kind arrived,
+		# and the unanswered ping was sent (None if there is none)
+		self.last_pong = time.time()
+		self.last_seen = time.time()
+		self.ping_sent = None
+		self.keepalive = keepalive
 		# Save the reference to the database removal function
 		self.db_remove = db_remove
+		self.on_message = on_message
 	
 	
 	## Close handler
@@ -95,10 +451,12 @@ class WS_Handler(asyncore.dispatcher):
 	# send the rest of the data in the write-buffer
 	def handle_close(self):
 		self.write_buffer = ""
-		self.read_buffer = ""
+		self.read_buffer = bytearray()
+		if self.keepalive != None:
+			self.keepalive.cancel(self)
 		
 		# Fetch the WS IP address and remove itself from the database
-		self.db_remove(self.getpeername()[0])
+		self.db_remove(self.addr[0])
 
 		self.close()
 	
@@ -114,149 +472,251 @@ class WS_Handler(asyncore.dispatcher):
 	## Handle a Write event
 	#
 	# Sends a chunk of data from the write buffer.  Clears the amount of data
-	# sent from the beginning of the write buffer.
+	# sent from the beginning of the write buffer.  Once a close frame has
+	# gone out, the connection is closed.
 	def handle_write(self):
 		sent = self.send(self.write_buffer)
 		self.write_buffer = self.write_buffer[sent:]
+		WS_WIRE_BYTES.inc(sent,self.addr[0],"out")
+		if self.state == STATE_CLOSING and len(self.write_buffer) == 0:
+			self.handle_close()
 
 	## Handle a Read Event
-	
+	#
+	# Parses everything that has arrived: first the handshake, then every
+	# complete frame.  A partial frame is kept until the rest arrives.
 	def handle_read(self):
-		# Recv a chunk of data into the Read buffer
-		self.read_buffer += self.recv(1024)
-		# If the Read Buffer is empty, do nothing
-		if len(self.read_buffer) == 0:
+		data = self.recv(READ_SIZE)
+		if len(data) == 0 or self.state == STATE_CLOSING:
 			return
+		WS_WIRE_BYTES.inc(len(data),self.addr[0],"in")
+		self.last_seen = time.time()
+		self.read_buffer += data
 
-		# Attempt to complete a WebSocket Handshake
-		if( self.ws_handshake()):
-			# If it was a handshake, clear the buffer and return
-			self.read_buffer = ""
-			return
-		
-		else:
-			# If not a handshake, decode the WS packet. 
-			data = self.ws_decode()
-			if data == False:
-				# If the WS decode returns false, the packet
-				# is still waiting on more data.  By returning now,
-				# we can wait for more added to be added to
-				# the read buffer.
+		if self.state == STATE_HANDSHAKE:
+			if not self.ws_handshake():
 				return
+
+		offset = 0
+		while self.state == STATE_OPEN:
 			try:
-				# Attempt to convert the data to JSON 
-				obj = json.loads(data)
-				# Add the received data to the Inbox.  The 
-				# Command center will check the inbox for data
-				self.inbox.append(obj)
-					
-			except:
-				# If there was an error, something must have been
-				# corrupted.  Clear the read-buffer and try again
-				print "Issue with WS Read Buffer. Clearing it out"
-				self.read_buffer = ""
+				frame = decode_frame(self.read_buffer,offset)
+			except ValueError as e:
+				print "Closing WebSocket from %s: %s" % (self.addr[0],e)
+				self.ws_close(CLOSE_TOO_BIG)
+				break
+			if frame == None:
+				break
+			fin,rsv,opcode,payload,offset = frame
+			self.ws_frame(fin,rsv,opcode,payload)
+
+		# Drop the frames that were handled, all at once
+		if offset > 0:
+			del self.read_buffer[:offset]
+
+	## Handle one Frame
+	#
+	# Control frames are answered right away, even between the fragments
+	# of a message, but may not be fragmented themselves.  Data frames are
+	# collected until the message is complete, and a new message may not
+	# start before the last one has ended.  RSV1 is only allowed on the
+	# first frame of a data message, once compression has been negotiated.
+	def ws_frame(self,fin,rsv,opcode,payload):
+		if rsv != 0 and (rsv != RSV1 or self.deflate == None or
+				opcode not in [OP_TEXT,OP_BINARY]):
+			print "Closing WebSocket from %s: unexpected reserved bits" % (
+				self.addr[0])
+			self.ws_close(CLOSE_PROTOCOL_ERROR)
+		elif opcode >= OP_CLOSE and (not fin or
+				len(payload) > MAX_CONTROL_PAYLOAD):
+			print "Closing WebSocket from %s: invalid control frame" % (
+				self.addr[0])
+			self.ws_close(CLOSE_PROTOCOL_ERROR)
+		elif opcode == OP_PING:
+			self.write_buffer += encode_frame(payload,OP_PONG)
+		elif opcode == OP_PONG:
+			self.last_pong = time.time()
+			if self.ping_sent != None:
+				WS_PING_SECONDS.observe(self.last_pong-self.ping_sent)
+				self.ping_sent = None
+		elif opcode == OP_CLOSE:
+			# Echo the close frame, then hang up
+			self.ws_close(payload[:2])
+		elif opcode == OP_CONTINUATION:
+			if self.fragment_opcode == None:
+				print "Closing WebSocket from %s: continuation "\
+					"without a message" % self.addr[0]
+				self.ws_close(CLOSE_PROTOCOL_ERROR)
+				return
+			self.fragments.append(payload)
+			if fin:
+				self.ws_message("".join(self.fragments),self.fragment_rsv)
+				self.fragments = []
+				self.fragment_opcode = None
+		elif opcode in [OP_TEXT,OP_BINARY]:
+			if self.fragment_opcode != None:
+				print "Closing WebSocket from %s: new message before "\
+					"the last one ended" % self.addr[0]
+				self.ws_close(CLOSE_PROTOCOL_ERROR)
+			elif fin:
+				self.ws_message(payload,rsv)
+			else:
+				self.fragments = [payload]
+				self.fragment_opcode = opcode
+				self.fragment_rsv = rsv
+		else:
+			print "Closing WebSocket from %s: unknown opcode %d" % (
+				self.addr[0],opcode)
+			self.ws_close(CLOSE_PROTOCOL_ERROR)
+
+	## Handle a Complete Message
+	#
+	# A message that is not valid JSON is dropped on its own.  The frames
+	# around it are not affected.
+	#
+	# @param data - The message payload
+	# @param rsv - RSV1 if the message is compressed
+	def ws_message(self,data,rsv=0):
+		if rsv == RSV1:
+			start = time.time()
+			try:
+				data = self.deflate.decompress(data)
+			except ValueError as e:
+				print "Closing WebSocket from %s: %s" % (self.addr[0],e)
+				self.ws_close(CLOSE_TOO_BIG)
+				return
+			except zlib.error as e:
+				print "Closing WebSocket from %s: bad compressed "\
+					"message (%s)" % (self.addr[0],e)
+				self.ws_close(CLOSE_PROTOCOL_ERROR)
+				return
+			WS_DEFLATE_SECONDS.inc(time.time()-start,self.addr[0],"in")
+		WS_PAYLOAD_BYTES.inc(len(data),self.addr[0],"in")
+		try:
+			# Attempt to convert the data to JSON 
+			obj = json.loads(data)
+		except ValueError:
+			print "Dropping bad WebSocket message from %s" % self.addr[0]
+			return
+		# The Command Center routes it.  Nothing is kept here.
+		if self.on_message != None:
+			self.on_message(self.addr[0],obj)
+
+	## Start Closing the Connection
+	#
+	# Sends a close frame.  The socket is closed once it has been sent.
+	#
+	# @param code - The 2 byte close status code
+	def ws_close(self,code=""):
+		self.write_buffer += encode_frame(str(code),OP_CLOSE)
+		self.state = STATE_CLOSING
+		self.read_buffer = bytearray()
 
 	## Complete a WebSocket handshake
 	#
 	# This method completes a WebSocket handshake.  This is used to 
 	# initialize commuication between the Chromecast Browser App and the
-	# server. 
+	# server.  Frames that arrived right behind the handshake are left in
+	# the read buffer.
+	#
+	# @return - True once the handshake is done, False while waiting for
+	#		the rest of it
 	def ws_handshake(self):
-		# Get the read buffer
-		data = self.read_buffer
-		# Grab the WS Key using a RegEx (TODO Make this case-insensitive)
-		m = re.search("Sec-WebSocket-Key: (\S*)",data)
-		key = ""
-		# Check if this packet has a WebSocket key
-		if m:
-			key =  m.group(1)
-		else:
-			# If no key, this is not a handshake.  Return False
+		end = self.read_buffer.find("\r\n\r\n")
+		if end == -1:
+			if len(self.read_buffer) > MAX_HANDSHAKE_SIZE:
+				print "Closing WebSocket from %s: handshake too "\
+					"large" % self.addr[0]
+				self.handle_close()
+			return False
+		request = str(self.read_buffer[:end])
+		del self.read_buffer[:end+4]
+
+		# Header names are case-insensitive
+		headers = {}
+		for line in request.split("\r\n")[1:]:
+			if ":" in line:
+				name,value = line.split(":",1)
+				headers[name.strip().lower()] = value.strip()
+		key = headers.get("sec-websocket-key")
+		if key == None:
+			print "Closing connection from %s: not a WebSocket "\
+				"handshake" % self.addr[0]
+			self.write_buffer = HANDSHAKE_ERROR
+			self.state = STATE_CLOSING
 			return False
+
 		# Generate a Respone key.  This follows the WebSocket definition
 		resp_key = base64.b64encode(hashlib.sha1(
 			key+"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest())
 
+		# Accept compression if the device offers it
+		extensions = ""
+		offers = parse_extensions(headers.get("sec-websocket-extensions",""))
+		self.deflate,accepted = negotiate_deflate(offers)
+		if accepted != None:
+			extensions = "Sec-WebSocket-Extensions: %s\r\n" % accepted
+
 		# Put this response key into the response template
-		resp =  HANDSHAKE_RESPONSE_TMPL.format(resp_key)
+		resp =  HANDSHAKE_RESPONSE_TMPL.format(resp_key,extensions)
 		
 		# Add this response to the Write buffer for sending
-		self.write_buffer = resp
-		# Return true to communicate that this was a handshake packet
+		self.write_buffer += resp
+		self.state = STATE_OPEN
+		if self.keepalive != None:
+			self.keepalive.schedule(self,PING_INTERVAL)
 		return True
 
-	## WebSocket Decode
+	## Keepalive Timeout
 	#
-	# This function decodes WebSocket data into Plain Text data
-	def ws_decode(self):
-		p = self.read_buffer
-		# Ignore Byte 0 for new (assume we are always recieving text)
-		# Convert Byte 1 to an unsigned char
-		size = struct.unpack("<B",p[1])[0]
-		# Remove the first bit to get the packet size
-		size = size - 0x80
-		# We will use 'index' to keep track of where we are in 'p'
-		index = 2 
-
-		# Size 126 and 127 are special cases that the packet is large
-		if size == 126:
-			# Convert Bytes 2 and 3 to an unsigned int
-			index = 4 # Move the index
-			size = struct.unpack("<H",p[2:3])[0]
-		elif size == 127:
-			# Convert Bytes 2 to 9 into an unsigned long
-			index = 10 # Move the Index
-			size = struct.unpack("<Q",p[2:9])[0]
-
-		# Grab the Mask
-		mask = p[index:index+4]
-		# Grab the Payload
-		payload = p[index+4:]
-
-		# If the Payload is too small, return false.  This will force the
-		# handler to wait for more data before continuing to decode
-		if len(payload) < size:
-			return False
+	# Called by the keepalive wheel.  A device that has been quiet for
+	# PING_INTERVAL is pinged.  If nothing at all arrives within
+	# PONG_TIMEOUT of the ping, the device is gone (for example, it
+	# dropped off Wi-Fi) and it is removed from the database instead of
+	# waiting for TCP to notice.
+	def check_alive(self):
+		if self.state != STATE_OPEN:
+			return
+		now = time.time()
+		if self.ping_sent != None:
+			if self.last_seen < self.ping_sent:
+				print "Dropping WebSocket from %s: no answer to ping" % (
+					self.addr[0])
+				WS_DEAD_PEERS.inc()
+				self.handle_close()
+				return
+			# Other data arrived, which is proof enough
+			self.ping_sent = None
 
-		# Unmask the payload 4 bytes at a time
-		decoded = ""
-		for i in range(size):
-			j = i%4
-			# XOR the mask and the payload byte by byte
-			decoded += chr(ord(mask[j])^ord(payload[i]))
-		# Remove this portion of the payload from the read buffer
-		self.read_buffer = self.read_buffer[index+4+size:]
-		# Return the decoded string
-		return decoded	
+		quiet = now-self.last_seen
+		if quiet < PING_INTERVAL:
+			self.keepalive.schedule(self,PING_INTERVAL-quiet)
+		else:
+			self.write_buffer += encode_frame("",OP_PING)
+			self.ping_sent = now
+			self.keepalive.schedule(self,PONG_TIMEOUT)
+
+	## Check if a Message would be Compressed
+	#
+	# @param data - The message text
+	def compresses(self,data):
+		return self.deflate != None and len(data) >= self.deflate.threshold
 
 	## Encode a Websocket packet
 	#
-	# This packet converts a string of text into a WebSocket packet
+	# This packet converts a string of text into a WebSocket packet.  It is
+	# compressed if permessage-deflate was negotiated and it is long enough.
 	def ws_encode(self,data):
-		# Send a single text packet
-		packet = "\x81"
-		# Always Use the extended packet (i dont care about the
-		# added 8 bytes of overhead)
-		packet += struct.pack('<B',len(data))
-		# Payload
-		packet += data
-		# We will not mask the output data.  
-
-		return packet
+		WS_PAYLOAD_BYTES.inc(len(data),self.addr[0],"out")
+		if not self.compresses(data):
+			# Send a single unmasked text frame
+			return encode_frame(data)
+		start = time.time()
+		data = self.deflate.compress(data)
+		WS_DEFLATE_SECONDS.inc(time.time()-start,self.addr[0],"out")
+		return encode_frame(data,OP_TEXT,True,RSV1)
 	
 
-	## Receive a Message from the Inbox
-	#
-	# The Command Center will use this method to receive data from the 
-	# WebSocket proxy.  It will remove 1 item from the Inbox list
-	def recv_msg(self):
-		if len(self.inbox) > 0:
-			# If Inbox is not empty, remove 1 item and return
-			return self.inbox.pop(0)
-		else:
-			# If inbox is empty, let em know
-			return {"error":"Inbox Empty"}
-
 	## Add a message to the Write Buffer
 	#
 	# This message takes a JSON object, converts it to a string, encodes